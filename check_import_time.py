@@ -0,0 +1,70 @@
+"""
+Check how long it takes to import lib/functions.py, using python -X importtime
+
+Heavy packages (pyodbc, matplotlib, ebmdatalab, IPython, pyarrow, polars) should only be imported by the functions
+which use them, so that notebooks filtering codelists and worker processes start quickly. This fails if any of
+them is imported with the module, or if the module's own import time (excluding pandas and numpy, which almost
+everything needs) is over budget.
+
+Usage: python check_import_time.py [budget in ms]
+"""
+
+import os
+import subprocess
+import sys
+
+
+MODULE = "functions"
+BUDGET_MS = 50
+ALLOWED = ["pandas", "numpy"]
+LAZY = ["pyodbc", "matplotlib", "ebmdatalab", "IPython", "pyarrow", "sketches", "memory", "parallel", "export", "render", "hll", "rollup", "summary_table", "strata", "hierarchy", "polars", "polars_engine"]
+
+
+def import_times(module):
+
+    '''
+    Import a module in a fresh interpreter, after the allowed packages
+
+    Outputs:
+    times (dict): cumulative import time (us) of the allowed packages and the module
+    imported (list): top level packages imported with the module
+    '''
+
+    code = (f"import sys; import {', '.join(ALLOWED)}; before = set(sys.modules); import {module}; "
+            "print(' '.join(set(m.split('.')[0] for m in sys.modules) - set(m.split('.')[0] for m in before)))")
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib"))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode!=0:
+        sys.exit(proc.stderr)
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if name.strip() in ALLOWED + [module] and name[1:]==name.strip(): # top level imports only
+                times[name.strip()] = int(cumulative)
+    return times, proc.stdout.split()
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv)>1 else BUDGET_MS
+    times, imported = import_times(MODULE)
+
+    own_ms = times[MODULE]/1000
+    total_ms = sum(times.values())/1000
+    lazy = sorted(set(imported) & set(LAZY))
+    print(f"import {MODULE}: {total_ms:.0f} ms in total, {own_ms:.0f} ms excluding {', '.join(ALLOWED)} (budget {budget:.0f} ms)")
+
+    failed = False
+    if lazy:
+        print(f"FAIL: imported at module level: {', '.join(lazy)}")
+        failed = True
+    if own_ms>budget:
+        print("FAIL: over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
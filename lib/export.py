@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Export of decile series and classifications to a Parquet dataset
+
+Each plotting_all run can write its results to two tables, partitioned by topic and end date
+(hive-style folders, e.g. deciles/topic=cvd/end_date=20201231/high_level.parquet, with one file per
+codelist type):
+
+- deciles: monthly percentiles for each code charted (and the top child code, if charted)
+- summary: practice coverage, medians and IDRs at key months, and the peak/recovery classifications
+
+Schemas are fixed, so consumers can read just the columns and partitions they need (see read_results).
+Re-running a topic and codelist type for the same end date replaces its file.
+"""
+
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+DECILES_SCHEMA = pa.schema([("codelist_type", pa.string()),
+                            ("first_digits", pa.string()),
+                            ("parent_code", pa.string()),
+                            ("month", pa.date32()),
+                            ("percentile", pa.int32()),
+                            ("value", pa.float64())])
+
+SUMMARY_SCHEMA = pa.schema([("codelist_type", pa.string()),
+                            ("first_digits", pa.string()),
+                            ("description", pa.string()),
+                            ("digits", pa.int32()),
+                            ("child_code", pa.string()),
+                            ("practice_count_thou", pa.float64()),
+                            ("practices_percent", pa.float64()),
+                            ("total_events", pa.float64()),
+                            ("endmonth", pa.date32()),
+                            ("feb_median", pa.float64()),
+                            ("apr_median", pa.float64()),
+                            ("endmonth_median", pa.float64()),
+                            ("feb_idr", pa.float64()),
+                            ("apr_idr", pa.float64()),
+                            ("endmonth_idr", pa.float64()),
+                            ("peak", pa.float64()),
+                            ("recovery", pa.float64()),
+                            ("april_position", pa.string()),
+                            ("endmonth_position", pa.string()),
+                            ("overall_position", pa.string())])
+
+SCHEMAS = {"deciles": DECILES_SCHEMA, "summary": SUMMARY_SCHEMA}
+
+
+def result_tables(code, desc, digits, result):
+
+    '''
+    Convert a single code's result into rows for the deciles and summary tables
+
+    Inputs:
+    code (str): full or truncated CTV3 code
+    desc (str): code description
+    digits (int): number of digits in code
+    result (dict): output of compute_code / compute_precomputed (or compact_result)
+
+    Outputs:
+    deciles (dataframe): deciles rows (code, plus top child code if present)
+    summary (dict): summary row
+    '''
+
+    frames = [result["deciles"].assign(first_digits=code, parent_code=code)]
+    child = result["child"]
+    if child is not None:
+        frames.append(child["deciles"].assign(first_digits=child["code"], parent_code=code))
+    deciles = pd.concat(frames, ignore_index=True)[DECILES_SCHEMA.names[1:]]
+
+    summary = {"first_digits": code,
+               "description": desc,
+               "digits": digits,
+               "child_code": child["code"] if child is not None else None,
+               "practice_count_thou": result["practice_count"],
+               "practices_percent": result["practices_percent"],
+               "total_events": result["total_events"]}
+    for name in SUMMARY_SCHEMA.names[len(summary)+1:]:
+        summary[name] = result["stats"][name]
+    return deciles, summary
+
+
+def write_results(tables, path, topic, end_date, codelist_type=None):
+
+    '''
+    Write results to the Parquet dataset, replacing any previous results for the same topic, end date and codelist type
+
+    Inputs:
+    tables (list): (deciles, summary) pairs from result_tables
+    path (str): root folder of dataset
+    topic (str): topic name (partition)
+    end_date (str): end date of study period (partition)
+    codelist_type (str): e.g. "High level" or "Detailed"
+    '''
+
+    if codelist_type is None:
+        codelist_type = "All"
+    deciles = pd.concat([t[0] for t in tables], ignore_index=True) if tables else pd.DataFrame(columns=DECILES_SCHEMA.names[1:])
+    summary = pd.DataFrame([t[1] for t in tables], columns=SUMMARY_SCHEMA.names[1:])
+
+    for name, df in [("deciles", deciles), ("summary", summary)]:
+        df.insert(0, "codelist_type", codelist_type)
+        folder = os.path.join(path, name, f"topic={topic}", f"end_date={end_date}")
+        os.makedirs(folder, exist_ok=True)
+        table = pa.Table.from_pandas(df, schema=SCHEMAS[name], preserve_index=False)
+        pq.write_table(table, os.path.join(folder, codelist_type.lower().replace(" ", "_") + ".parquet"))
+
+
+def read_results(path, name, topic=None, end_date=None, columns=None):
+
+    '''
+    Read results from the Parquet dataset, only reading the partitions and columns needed
+
+    Inputs:
+    path (str): root folder of dataset
+    name (str): "deciles" or "summary"
+    topic (str): optional topic to select
+    end_date (str): optional end date to select ("YYYYMMDD")
+    columns (list): optional columns to read
+
+    Output:
+    (dataframe): results, including "topic" and "end_date" columns
+    '''
+
+    filters = []
+    if topic is not None:
+        filters.append(("topic", "=", topic))
+    if end_date is not None:
+        filters.append(("end_date", "=", int(end_date))) # partition values of digits only are read as integers
+    dataset = pq.ParquetDataset(os.path.join(path, name), filters=filters or None)
+    return dataset.read(columns=columns).to_pandas()
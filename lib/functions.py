@@ -6,32 +6,192 @@ Created on Tue Sep  8 10:05:39 2020
 """
 
 # Import packages
-import pyodbc
+# (heavier packages - pyodbc, matplotlib, IPython, pyarrow and the other lib modules - are imported
+# in the functions which use them, so that importing this module stays fast, e.g. in worker processes.
+# See check_import_time.py)
 import pandas as pd
 import os
-from IPython.display import display, Markdown
-from contextlib import contextmanager
-from datetime import date, datetime
-from dateutil.relativedelta import relativedelta
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, timedelta
 import re # allows case-insensitivity for keyword filtering
 
 import numpy as np
-from ebmdatalab import charts
-import matplotlib.pyplot as plt
 
 import json
 
+# engine for the dataframe transforms (process_df, join_concept_descriptions, all_pracs, filter_codelists and the
+# per-code extracts in plotting_all): "pandas", or "polars" to run them as Polars lazy queries (see polars_engine.py)
+ENGINE = os.environ.get("DATAFRAME_ENGINE", "pandas")
+
+def display(*objs, **kwargs):
+    from IPython.display import display as ipython_display
+    ipython_display(*objs, **kwargs)
+
+
+def Markdown(data):
+    from IPython.display import Markdown as ipython_markdown
+    return ipython_markdown(data)
 
 
 # Set up SQL connection ensuring that it is closed after each use
 @contextmanager
 def closing_connection(dbconn):
+    import pyodbc
     cnxn = pyodbc.connect(dbconn)
     try:
         yield cnxn
     finally:
         cnxn.close()
-        
+
+
+# Queries are built with "?" placeholders for values (dates, thresholds) and return (sql, params), so that the
+# query text is the same for every run and topic and SQL Server can reuse its cached plans. Codelists are staged
+# in a temp table (see stage_codelist) rather than written into the query text.
+def sql_date(date_str):
+
+    '''
+    Convert a "YYYYMMDD" date to a date to bind as a query parameter
+    '''
+
+    return datetime.strptime(date_str, "%Y%m%d").date()
+
+
+def stage_codelist(connection, subset, children=None):
+
+    '''
+    Stage a codelist in a temp table (#codelist), replacing any codelist staged before on the connection, for
+    queries to match codes against (see code_filter_sql)
+
+    Inputs:
+    connection: open database connection
+    subset (dataframe): codelist containing "first_digits" and "digits" columns (codes matched on their first digits),
+                        or None (no codes, e.g. before staging the code lookup for every code)
+    children (list): optional full-length codes to match exactly (e.g. top child codes for pushdown_sql). Codes already
+                     in the codelist are matched on prefix only (avoids counting events twice)
+    '''
+
+    if children is None:
+        children = []
+    rows = []
+    if subset is not None:
+        rows = [(code, int(digits), 0) for code, digits in zip(subset["first_digits"], subset["digits"])]
+        rows += [(code, len(code), 1) for code in children if code not in list(subset["first_digits"])]
+
+    connection.execute('''-- codelist (created outside of any parameterised statement, so it lasts for the session)
+    IF OBJECT_ID('tempdb..#codelist') IS NULL
+        CREATE TABLE #codelist (code VARCHAR(5) NOT NULL, digits INT NOT NULL, exact BIT NOT NULL);
+    TRUNCATE TABLE #codelist;
+    ''')
+    if rows:
+        cursor = connection.cursor()
+        cursor.fast_executemany = True
+        cursor.executemany("INSERT INTO #codelist (code, digits, exact) VALUES (?, ?, ?)", rows)
+
+
+def stage_code_lookup(connection, end_date, codelist=True):
+
+    '''
+    Stage the code lookup (#codes) for events_sql and the other events queries to join on. Staged once per codelist:
+    when extracting one category at a time, only #codelist is restaged for each (events_sql restricts the lookup to it)
+
+    Inputs:
+    connection: open database connection
+    end_date (str): end date of study period
+    codelist (bool): only codes matching the codelist staged by stage_codelist, otherwise every code
+    '''
+
+    for sql, params in code_lookup_sql(end_date, codelist):
+        connection.execute(sql, *params)
+
+
+def code_lookup_sql(end_date, codelist=True):
+
+    '''
+    Queries staging the code lookup (#codes): the distinct codes recorded in CodedEvent during the study period, each
+    with its code up to the first dot, so that the events queries join on CTV3Code (seeking the code index for each
+    code and date range) and group by a stored column, rather than evaluating an expression on the code of every event.
+    Codes are found from the events of the study period (a seek of the (CTV3Code, ConsultationDate) index for each
+    codelist code) rather than from CTV3Dictionary, so that events recorded with codes missing from the dictionary are
+    still counted
+
+    Inputs:
+    end_date (str): end date of study period
+    codelist (bool): only codes matching the codelist staged by stage_codelist (each codelist code is a range seek
+                     on the code index), otherwise every code
+
+    Output:
+    list of (sql, params) to execute in turn
+    '''
+
+    code_filter = """
+        AND EXISTS (SELECT 1 FROM #codelist c WHERE CTV3Code LIKE c.code + '%'
+        AND (c.exact = 0 OR REPLACE(CTV3Code, '.', '') = c.code))""" if codelist else ""
+
+    sql_table = '''-- code lookup
+    IF OBJECT_ID('tempdb..#codes') IS NULL
+        CREATE TABLE #codes (CTV3Code VARCHAR(50) NOT NULL PRIMARY KEY, first_digits VARCHAR(50) NOT NULL);
+    TRUNCATE TABLE #codes;
+    '''
+
+    sql_fill = f'''INSERT INTO #codes (CTV3Code, first_digits)
+    SELECT
+    CTV3Code,
+    CASE WHEN CHARINDEX('.',CTV3Code) > 0
+    THEN LEFT(CTV3Code,CHARINDEX('.',CTV3Code)-1)
+    ELSE CTV3Code END AS first_digits
+    FROM (
+        SELECT DISTINCT CTV3Code FROM CodedEvent
+        WHERE
+        ConsultationDate >= '20190101'
+        AND ConsultationDate <= ?{code_filter}
+    ) e
+    '''
+    return [(sql_table, []), (sql_fill, [sql_date(end_date)])]
+
+
+# calendar table, which sweep_sql also stages (so it is replaced if staging_sql runs after it on the same connection)
+CALENDAR_TABLE = '''IF OBJECT_ID('tempdb..#calendar') IS NULL
+        CREATE TABLE #calendar (period_start DATE NOT NULL PRIMARY KEY, next_start DATE NOT NULL);
+    TRUNCATE TABLE #calendar;
+    '''
+
+
+def calendar_sql(end_date, period="month"):
+
+    '''
+    Query filling the calendar table (#calendar) with the periods of the study (from 2019) up to the end date. The
+    periods are generated on the server from the first period and the end date, so the query text is the same
+    whatever the end date
+
+    Inputs:
+    end_date (str): end date of study period
+    period (str): "month", or "week" (weeks starting on Monday)
+
+    Output:
+    (sql, params) to execute (after the table is created by staging_sql or sweep_sql)
+    '''
+
+    if period=="month":
+        start = date(2019, 1, 1)
+    elif period=="week":
+        start = date(2019, 1, 1) - timedelta(days=date(2019, 1, 1).weekday())
+    else:
+        raise ValueError(f"unknown period {period}")
+
+    sql = f'''-- calendar of periods, generated from the first period up to the end date
+    WITH periods AS (
+        SELECT CAST(? AS DATE) AS period_start
+        UNION ALL
+        SELECT DATEADD({period}, 1, period_start) FROM periods WHERE DATEADD({period}, 1, period_start) <= ?
+    )
+    INSERT INTO #calendar (period_start, next_start)
+    SELECT period_start, DATEADD({period}, 1, period_start)
+    FROM periods
+    OPTION (MAXRECURSION 0);
+    '''
+    return sql, [start, sql_date(end_date)]
+
+
 def load_concept(filename, codes):
     
     '''
@@ -74,6 +234,10 @@ def process_df(df, codes):
     Output:
     df (dataframe): processed dataframe
     '''
+
+    if ENGINE=="polars":
+        from polars_engine import process_df as polars_process_df
+        return polars_process_df(df, codes)
     
     # create/amend columns
     df["2020 events (mill)"] = round(df["events"]/1000000, 2)
@@ -100,6 +264,10 @@ def join_concept_descriptions(df, concepts, concepts2, concepts3):
     Output:
     df (dataframe): processed dataframe
     '''
+
+    if ENGINE=="polars":
+        from polars_engine import join_concept_descriptions as polars_join
+        return polars_join(df, concepts, concepts2, concepts3)
     
     df["first_digits"] = df["first_digits"].str.replace(".","")
 
@@ -136,18 +304,143 @@ def join_concept_descriptions(df, concepts, concepts2, concepts3):
 
 
 
-def get_subcodes(codelist, code_dict, digits, end_date, threshold, dbconn):
+def discovery_sql(level, end_date, threshold, approx=False, shortlist=False, summary=None):
+
+    '''
+    Query ranking codes by frequency of appearance in 2020, with the number of patients for each
+
+    Inputs:
+    level (str): "level2" (first 2 digits), "level3" (first 3 digits) or "uxy" (full codes beginning U, X or Y)
+    end_date (str): end date of study period
+    threshold (int): lower limit for activity numbers
+    approx (bool): count patients using APPROX_COUNT_DISTINCT (SQL Server 2019+), which avoids the large hash/sort
+                   spills of COUNT(DISTINCT) over a year of events. Its error is within 2% with 97% probability, so
+                   exact counts should be fetched for the codes which are published (see exact_patients)
+    shortlist (bool): restrict to the codes (dots removed) staged by stage_codelist, e.g. a shortlist to fetch exact
+                      counts for
+    summary (str): optional summary table to rank codes from instead of CodedEvent (see summary_table.py). Patients
+                   are not counted, so exact counts should be fetched for the codes which are published (see exact_patients)
+
+    Outputs:
+    sql (str): sql query returning "first_digits", "events", "patients" (plus "latest_date" for level2) and "level",
+               so that exact counts can be fetched for each code from the level it came from
+    params (list): query parameters
+    '''
+
+    if level=="level2":
+        group = "LEFT(CTV3Code,2)"
+        condition = """CAST(LEFT(CTV3Code,1) AS VARCHAR) NOT IN ('.', '0', 'X', 'Y', 'U')
+    AND CAST(LEFT(CTV3Code,2) AS VARCHAR) NOT IN ('49') -- remove semen analysis"""
+    elif level=="level3":
+        group = "LEFT(CTV3Code,3)"
+        condition = """CAST(LEFT(CTV3Code,1) AS VARCHAR) NOT IN ('.', '0', 'U', 'X','Y')
+    AND CAST(LEFT(CTV3Code,2) AS VARCHAR) NOT IN ('49') -- remove semen analysis"""
+    elif level=="uxy":
+        group = "CTV3Code"
+        condition = "CAST(LEFT(CTV3Code,1) AS VARCHAR) IN ('U', 'X', 'Y')"
+    else:
+        raise ValueError(f"unknown level {level}")
+
+    patients = "APPROX_COUNT_DISTINCT(Patient_ID)" if approx else "COUNT(DISTINCT Patient_ID)"
+    latest = ", MAX(CAST(ConsultationDate AS DATE)) AS latest_date" if level=="level2" else ""
+    top = "TOP 500 " if not shortlist else ""
+    if shortlist:
+        condition += f"\n    AND REPLACE({group},'.','') IN (SELECT code FROM #codelist)"
+    if summary is not None:
+        from summary_table import summary_discovery_sql
+        return summary_discovery_sql(summary, level, end_date, threshold, group, condition, top)
+
+    sql = f'''select {top}{group} AS first_digits, COUNT(Patient_ID) as events, {patients} as patients{latest}, '{level}' AS level
+    FROM CodedEvent
+    WHERE
+    ConsultationDate IS NOT NULL
+    AND {condition}
+    AND ConsultationDate >= '20200101'
+    AND ConsultationDate <= ?
+    GROUP BY {group}
+    HAVING COUNT(Patient_ID) > ?
+    ORDER BY {"first_digits" if level=="level2" else "events DESC"}'''
+    return sql, [sql_date(end_date), int(threshold)]
+
+
+def exact_patients(df, end_date, threshold, dbconn):
+
+    '''
+    Replace approximate patient counts (see discovery_sql) with exact counts for a shortlist of codes
+
+    Each code is counted by the query of the level it was discovered at (its "level"), rather than by its length
+    once dots are removed (e.g. "22." from level3 is every code beginning "22.", not every code beginning "22").
+
+    Inputs:
+    df (dataframe): codelist (after process_df) with "first_digits", "level" and "patients" columns
+    end_date (str): end date of study period
+    threshold (int): lower limit for activity numbers
+    dbconn (str): SQL credentials
+
+    Output:
+    df (dataframe): codelist with exact "patients" and "2020 Patient count (mill)"
+    '''
+
+    if "level" not in df.columns:
+        raise ValueError("codelist has no discovery level (see discovery_sql)")
+    exact = []
+    with closing_connection(dbconn) as connection:
+        for level, subset in df.groupby("level", sort=False):
+            stage_codelist(connection, subset)
+            sql, params = discovery_sql(level, end_date, threshold, shortlist=True)
+            exact.append(pd.read_sql(sql, connection, params=params))
+
+    df = df.copy()
+    if len(exact)==0:
+        return df
+    exact = pd.concat(exact, ignore_index=True)
+    exact["first_digits"] = exact["first_digits"].str.replace(".", "", regex=False)
+    patients = df[["level", "first_digits"]].merge(exact[["level", "first_digits", "patients"]], how="left",
+                                                   on=["level", "first_digits"])["patients"]
+    df["patients"] = patients.fillna(df["patients"]).values
+    df["2020 Patient count (mill)"] = round(df["patients"]/1000000, 2)
+    return df
+
+
+def code_counts(events, digits, approx=False):
+
+    '''
+    Local equivalent of the discovery queries for an events extract held in memory (e.g. an offline backend), with
+    patients counted exactly or using HyperLogLog (see hll.py, error about 0.8%)
+
+    Inputs:
+    events (dataframe): "CTV3Code" and "Patient_ID" columns, one row per event
+    digits (int): number of digits to group codes by (None for full codes)
+    approx (bool): count patients using HyperLogLog
+
+    Output:
+    df (dataframe): "first_digits", "events" and "patients"
+    '''
+
+    codes = events["CTV3Code"] if digits is None else events["CTV3Code"].str[:digits]
+    df = codes.value_counts().rename("events").rename_axis("first_digits").reset_index()
+    if approx:
+        from hll import hll_count_distinct
+        patients = hll_count_distinct(codes.values, events["Patient_ID"].values)
+    else:
+        patients = events["Patient_ID"].groupby(codes.values).nunique()
+    df["patients"] = df["first_digits"].map(patients)
+    return df
+
+
+def get_subcodes(codelist, code_dict, digits, end_date, threshold, dbconn, summary=None):
     
     '''
     Find top full length codes within the parent codes to help with interpretation
     
     Inputs:
-    codelist (tuple): list of "first_digits" 
+    codelist (list): "first_digits" of codes
     code_dict (dataframe): lookup table for code descriptions
     digits (int): number of digits of the codes listed in the codelist
     end_date (str): end date of study period
     threshold (int): lower limit for activity numbers 
     dbconn (str): SQL credentials
+    summary (str): optional summary table to count events from instead of CodedEvent (see summary_table.py)
     
     Outputs:
     df_out (dataframe): dataframe containing list of top 50 full-length codes for each code in codelist
@@ -159,19 +452,24 @@ def get_subcodes(codelist, code_dict, digits, end_date, threshold, dbconn):
     COUNT(Patient_ID) as events
     FROM CodedEvent 
     WHERE 
-    LEFT(CTV3Code,{digits}) in {codelist} 
+    {code_filter_sql()}
     AND ConsultationDate >= '20200101'
-    AND ConsultationDate < '{end_date}'
+    AND ConsultationDate < ?
 
     GROUP BY CTV3Code
-    HAVING COUNT(Patient_ID) > {threshold}'''
+    HAVING COUNT(Patient_ID) > ?'''
 
     df_out = pd.DataFrame()
     with closing_connection(dbconn) as connection:
-        out = pd.read_sql(sql1, connection)
+        stage_codelist(connection, pd.DataFrame({"first_digits": list(codelist), "digits": digits}))
+        from summary_table import find_summary, summary_subcodes_sql
+        summary = find_summary(connection, summary)
+        params = [sql_date(end_date), int(threshold)]
+        if summary is not None: # summary table of events per code, practice and month
+            sql1, params = summary_subcodes_sql(summary, end_date, threshold)
+        out = pd.read_sql(sql1, connection, params=params)
         
-        # turn codelist string to list and iterate over each item
-        codelist = codelist.replace("(","").replace(")","").replace("'","").replace(" ","").split(",")
+        # iterate over each code
         for code in codelist:
             out1 = out.loc[out["first_digits"].str[:len(code)]==code].sort_values(by="events", ascending=False).head(50)
             out1["parent_code"] = code
@@ -187,28 +485,64 @@ def get_subcodes(codelist, code_dict, digits, end_date, threshold, dbconn):
 
 
 
-def plot_charts(out, outer_percentiles):
-    charts.deciles_chart(
-        out,
-        period_column='month',
-        column='value',
-        #title=Title,
-        ylabel="rate per 1000",
-        show_outer_percentiles=outer_percentiles,
-        show_legend=True
-    )
-    
-    # Now add a single line against the deciles
+def top_subcodes(df0, codelist, code_dict, end_date, threshold):
 
-    #df_subject = pd.DataFrame(np.random.normal(0.6, 0.05, 37), columns=['val'])
-    #df_subject['month'] = out["month"].drop_duplicates()
-    #df_subject.set_index('month')
+    '''
+    Find top full length codes within the parent codes from an events extract already fetched for plotting_all,
+    rather than scanning CodedEvent again (see get_subcodes). As the extract is monthly and only includes
+    currently registered patients, events are counted from January 2020 up to the end of the month containing
+    end_date, for currently registered patients only.
 
-    #plt.plot(df_subject['month'], df_subject['val'], 'r--')
-    plt.show()
-    
-    
-def all_pracs(df0, df, code):
+    Inputs:
+    df0 (dataframe): events extract with full length codes ("first_digits") and monthly practice counts
+    codelist (list): list of "first_digits" (parent codes)
+    code_dict (dataframe): lookup table for code descriptions
+    end_date (str): end date of study period
+    threshold (int): lower limit for activity numbers
+
+    Outputs:
+    df_out (dataframe): dataframe containing list of top 50 full-length codes for each code in codelist
+    '''
+
+    # events per full length code in 2020, above the threshold
+    out = df0.loc[(df0["month"]>=date(2020,1,1)) & (df0["month"]<=datetime.strptime(end_date, "%Y%m%d").date())]
+    out = out.groupby("first_digits")[["numerator"]].sum().reset_index().rename(columns={"numerator": "events"})
+    out = out.loc[out["events"]>threshold].sort_values(by="events", ascending=False)
+
+    frames = []
+    for code in codelist:
+        out1 = out.loc[out["first_digits"].str[:len(code)]==code].head(50).copy()
+        out1["parent_code"] = code
+        frames.append(out1)
+    if not frames: # empty codelist
+        return pd.DataFrame(columns=["first_digits", "parent_code", "2020 events (thou)", "Description"])
+    df_out = pd.concat(frames, ignore_index=True)
+
+    df_out["2020 events (thou)"] = (df_out["events"].astype("float")/1000).round(1)
+    df_out = df_out.drop("events", 1)
+
+    # merge with codelist to get description
+    df_out = df_out.merge(code_dict[["first_digits", "Description"]], on="first_digits", how="left")
+    df_out = df_out.loc[~df_out['Description'].fillna("").str.contains('Erectile')] # exclude erectile dysfuntion
+    return df_out
+
+
+def plot_deciles(deciles, title=None):
+
+    '''
+    Plot a decile chart from percentiles which have already been calculated, in the same style as
+    ebmdatalab's deciles_chart (dashed deciles, solid median) but reusing one figure (see render.py)
+
+    Inputs:
+    deciles (dataframe): "month", "percentile" (10, 20 ... 90) and "value" columns
+    title (str): optional chart title
+    '''
+
+    from render import render_deciles
+    render_deciles(deciles, title=title)
+
+
+def all_pracs(df0, df, code, months=None):
     
     '''
     Expand filtered dataframe (df) to include all relevant practices every month. Relevant practices are those ever using the current code during the covered period. This ensures that deciles represent true trends rather than appearing to change when there is simply a change in the number of practices using the code over time. 
@@ -217,21 +551,32 @@ def all_pracs(df0, df, code):
     df0 (dataframe): full time series data for all codes in codelist 
     df (dataframe): df0 filtered to a single code
     code (str): full or truncated CTV3 code
+    months (list): optional months to include (defaults to all months in df0, e.g. when df0 is only part of the extract)
         
     Output:
-    out (dataframe): time series data at practice level to plot decile charts
+    out (dataframe): time series data at practice level to plot decile charts. The denominator is each practice's list
+                     size as given in df0 (at the end date) in every month; code_series replaces it with each month's
+                     list size when monthly list sizes are used (see apply_listsizes)
     practice_count_thou (float): number of practices included
     practices_percent (float): percent of all practices included
     '''
 
+    if ENGINE=="polars":
+        from polars_engine import all_pracs as polars_all_pracs
+        return polars_all_pracs(df0, df, code, months)
+
     # cross join all practices and months to make sure they all appear under the current code
     # all months 
-    cross = df0[["month"]].drop_duplicates()
+    if months is None:
+        cross = df0[["month"]].drop_duplicates()
+    else:
+        cross = pd.DataFrame({"month": months})
     cross["first_digits"] = code
     cross["key"] = 1
 
     # all practices which have used the current code, and their list size (denominator) 
-    # note this has been calculated based on current registrations so does not vary by month
+    # note this is the list size in df0 (at the end date), repeated in every month including any months not in df0;
+    # monthly list sizes (monthly_denominators) are applied afterwards by code_series
     cross2 = df.copy()
     cross2 = cross2[["Practice_ID","denominator"]].drop_duplicates()
     cross2["key"] = 1
@@ -248,256 +593,1534 @@ def all_pracs(df0, df, code):
 
 
 
-def plotting_all(codelist, code_dict, h, threshold, end_date, dbconn, second_chart=False):
-    
+def registration_changes(reg, end_date):
+
     '''
-    Extract data and plot a series of decile charts
-    
+    Turn registration periods into +1 / -1 changes in practice list size per month, counting patients registered
+    at the end of each month (or at end_date in the last month). Local equivalent of listsize_changes_sql.
+
     Inputs:
-    codelist (dataframe): list of codes
-    code_dict (dataframe): lookup table for code descriptions
-    h (int): No of charts to plot
-    threshold (int): lower limit for activity number (global variable)
+    reg (dataframe): "Practice_ID", "StartDate" and "EndDate" columns (one row per registration)
     end_date (str): end date of study period
-    dbconn (str): SQL credentials
-    second_chart (bool): opt in to display the trend for the top code within each parent code (e.g. useful for path)
-        
+
+    Output:
+    changes (dataframe): "Practice_ID", "month" and "change" columns
+    '''
+
+    start = np.datetime64("2019-01-01")
+    end = np.datetime64(datetime.strptime(end_date, "%Y%m%d").date())
+    starts = reg["StartDate"].values.astype("datetime64[D]")
+    ends = reg["EndDate"].values.astype("datetime64[D]")
+    # registrations live at the end of at least one month in the period
+    live = (starts<=end) & (ends>=np.datetime64("2019-01-31"))
+    practices, starts, ends = reg["Practice_ID"].values[live], starts[live], ends[live]
+
+    # +1 in the month a registration starts (or the first month), -1 in the month after it ends
+    # (the month containing the day after it ends), unless it is still live at end_date
+    ended = ends<end
+    months = np.concatenate([np.maximum(starts, start).astype("datetime64[M]"),
+                             (ends[ended] + np.timedelta64(1, "D")).astype("datetime64[M]")])
+    changes = pd.DataFrame({"Practice_ID": np.concatenate([practices, practices[ended]]),
+                            "month": months,
+                            "change": np.concatenate([np.ones(len(starts), int), -np.ones(ended.sum(), int)])})
+    changes = changes.groupby(["Practice_ID", "month"])["change"].sum().reset_index()
+    changes["month"] = changes["month"].dt.date
+    return changes
+
+
+def listsize_changes_sql(end_date):
+
+    '''
+    Query returning changes in practice list size per month (+1 for each registration starting, -1 for each
+    ending), from which every month's list size can be calculated in one cumulative sum (see monthly_listsizes)
+    rather than one COUNT(DISTINCT) per month. Patients are counted as registered at the end of each month
+    (or at end_date in the last month).
+
+    Inputs:
+    end_date (str): end date of study period
+
     Outputs:
-    Header text, charts and tables
+    sql (str): sql query returning "Practice_ID", "month" and "change"
+    params (list): query parameters
     '''
-    
-    #######
-    # sql queries necessary for plotting:
-    sql1 = f'''-- patient registrations
+
+    sql = '''-- registration starts (+1) and ends (-1) per practice and month
+    SELECT Practice_ID, month, SUM(change) AS change
+    FROM (
+        SELECT
+        Organisation_ID AS Practice_ID,
+        CASE WHEN StartDate < '20190101' THEN CAST('20190101' AS DATE)
+            ELSE DATEFROMPARTS(YEAR(StartDate),MONTH(StartDate),1) END AS month,
+        1 AS change
+        FROM RegistrationHistory
+        WHERE StartDate <= ? AND EndDate >= '20190131' -- live at the end of at least one month
+        UNION ALL
+        SELECT
+        Organisation_ID AS Practice_ID,
+        DATEFROMPARTS(YEAR(DATEADD(day,1,EndDate)),MONTH(DATEADD(day,1,EndDate)),1) AS month,
+        -1 AS change
+        FROM RegistrationHistory
+        WHERE StartDate <= ? AND EndDate >= '20190131'
+        AND EndDate < ? -- not still live at end date
+    ) c
+    GROUP BY Practice_ID, month'''
+    return sql, [sql_date(end_date)]*3
+
+
+def monthly_listsizes(changes, months):
+
+    '''
+    Calculate every practice's list size in every month from changes in list size, in one cumulative sum
+
+    Inputs:
+    changes (dataframe): output of listsize_changes_sql / registration_changes
+    months (list): months to include (first day of each month, ascending)
+
+    Output:
+    listsizes (dataframe): list size with one row per practice ("Practice_ID" index) and one column per month
+    '''
+
+    practices, rows = np.unique(changes["Practice_ID"].values, return_inverse=True)
+    cols = np.searchsorted(np.array(months, dtype="datetime64[D]"), changes["month"].values.astype("datetime64[D]"), side="right") - 1
+    keep = cols<len(months) # changes before the first month are part of its list size
+    sizes = np.zeros((len(practices), len(months)), dtype=int)
+    np.add.at(sizes, (rows[keep], np.maximum(cols[keep], 0)), changes["change"].values[keep])
+    listsizes = pd.DataFrame(np.cumsum(sizes, axis=1), index=pd.Index(practices, name="Practice_ID"), columns=months)
+    return listsizes
+
+
+def apply_listsizes(out, listsizes):
+
+    '''
+    Replace the denominator (list size at end date) in a practice-level series with each month's list size
+
+    Inputs:
+    out (dataframe): practice-level series (see all_pracs)
+    listsizes (dataframe): output of monthly_listsizes
+
+    Output:
+    out (dataframe): series with monthly denominators (NaN where a practice had no registered patients)
+    '''
+
+    sizes = listsizes.stack()
+    denominator = sizes.reindex(pd.MultiIndex.from_arrays([out["Practice_ID"], out["month"]])).values
+    out["denominator"] = np.where(denominator>0, denominator, np.nan)
+    return out
+
+
+def staging_sql(end_date, preview=None, period="month"):
+
+    '''
+    Queries to stage patient registrations (#reg) and practice list sizes (#listsize) in temp tables
+
+    Inputs:
+    end_date (str): end date of study period
+    preview (float): optional fraction of practices (e.g. 0.1) to restrict both tables to. Practices are split
+                     into ten strata by list size and the same fraction is taken from each, choosing practices
+                     by a hash of their ID so that the same sample is drawn every run. Every query joining
+                     #reg or #listsize is then restricted to the sample.
+    period (str): period of the calendar table (#calendar) which events are bucketed by: "month" or "week"
+
+    Output:
+    list of (sql, params) to execute in turn
+    '''
+
+    # temp tables are created before being filled, as tables created by a parameterised statement are dropped
+    # when it finishes
+    sql_tables = '''-- staging tables
+    CREATE TABLE #reg (Patient_ID BIGINT, Practice_ID INT, registration_date_rank INT);
+    CREATE TABLE #listsize (Practice_ID INT, list_size INT);
+    ''' + CALENDAR_TABLE
+
+    sql1 = '''-- patient registrations
+    INSERT INTO #reg (Patient_ID, Practice_ID, registration_date_rank)
     SELECT
     Patient_ID,
     Organisation_ID AS Practice_ID,
     ROW_NUMBER() OVER (partition by Patient_ID ORDER BY StartDate DESC, EndDate DESC) AS registration_date_rank -- row_num gives unique results
-    INTO #reg
     FROM RegistrationHistory
-    WHERE 
-    StartDate <= '{end_date}' AND
-    EndDate >= '{end_date}'; -- registrations which were live at the end of the study period
+    WHERE
+    StartDate <= ? AND
+    EndDate >= ?; -- registrations which were live at the end of the study period
     '''
-    
-    sql2 = f'''-- practice list size
+
+    sql2 = '''-- practice list size
+    INSERT INTO #listsize (Practice_ID, list_size)
     SELECT
     Organisation_ID AS Practice_ID,
     COUNT(DISTINCT Patient_ID) AS list_size
-    INTO #listsize
     FROM RegistrationHistory
-    WHERE StartDate <= '{end_date}' AND
-    EndDate >= '{end_date}' -- registrations which were live at the end of the study period
+    WHERE StartDate <= ? AND
+    EndDate >= ? -- registrations which were live at the end of the study period
     GROUP BY Organisation_ID
     '''
-    ##### create subset of codelist up to maximum number provided
-    subset = codelist.head(h)
-    
-    ###### set up sql string to query database for codes of varying lengths
-    listcodes = {}
-    for n in np.arange(1, 6, 1):
-        inter = subset.loc[subset["digits"]==n]
-        listcodes[n] = str(tuple(inter["first_digits"])).replace(",)",")")     
-
-    out_string = ""
-
-    for i in listcodes:
-        if len(listcodes[i])>4:
-            out_string = " OR ".join([out_string,f"CAST(LEFT(CTV3Code,{i}) AS VARCHAR) IN {listcodes[i]}"]).strip(" OR ") # strip OR from start
-    ######
-    
-    #### sql query for extracting data for all codes in codelist into temp table
-    sql3 = f'''select 
-        CASE WHEN CHARINDEX('.',CTV3Code) > 0
-        THEN LEFT(CTV3Code,CHARINDEX('.',CTV3Code)-1) 
-        ELSE CTV3Code END AS first_digits, 
-        DATEFROMPARTS(YEAR(ConsultationDate),MONTH(ConsultationDate),1) AS month, 
+
+    # calendar of periods, which events are joined to by date range rather than converting every event's date
+    sql_calendar = calendar_sql(end_date, period)
+
+    end = sql_date(end_date)
+    staging = [(sql_tables, []), (sql1, [end, end]), (sql2, [end, end]), sql_calendar]
+    if preview is None:
+        return staging
+
+    sql_sample = '''-- stratified sample of practices (same fraction of each tenth by list size, chosen by hash of practice ID)
+    CREATE TABLE #sample (Practice_ID INT);
+    '''
+
+    sql_sample_fill = '''INSERT INTO #sample (Practice_ID)
+    SELECT Practice_ID
+    FROM (
+        SELECT
+        Practice_ID,
+        ROW_NUMBER() OVER (PARTITION BY stratum ORDER BY HASHBYTES('SHA1', CAST(Practice_ID AS VARCHAR(20)))) AS hash_rank,
+        COUNT(*) OVER (PARTITION BY stratum) AS stratum_size
+        FROM (
+            SELECT Practice_ID, NTILE(10) OVER (ORDER BY list_size, Practice_ID) AS stratum
+            FROM #listsize
+        ) s
+    ) r
+    WHERE hash_rank <= CEILING(?*stratum_size);
+    DELETE FROM #listsize WHERE Practice_ID NOT IN (SELECT Practice_ID FROM #sample);
+    DELETE FROM #reg WHERE Practice_ID NOT IN (SELECT Practice_ID FROM #sample);
+    '''
+    return staging + [(sql_sample, []), (sql_sample_fill, [float(preview)])]
+
+
+def code_filter_sql():
+
+    '''
+    Build sql condition matching CTV3 codes beginning with any code in the codelist staged by stage_codelist
+    (codes may be 1-5 digits), or equal to any code staged to match exactly
+
+    Output:
+    out_string (str): sql condition
+    '''
+
+    out_string = """EXISTS (SELECT 1 FROM #codelist c WHERE LEFT(CTV3Code, c.digits) = c.code
+        AND (c.exact = 0 OR REPLACE(CTV3Code, '.', '') = c.code))"""
+    return out_string
+
+
+def events_sql(subset, end_date, summary=None):
+
+    '''
+    Query to extract monthly event counts per practice for all codes in a codelist. Codes are returned in full
+    (up to the first dot) so they can be grouped up to each code in the codelist locally
+
+    Inputs:
+    subset (dataframe): codelist containing "first_digits" and "digits" columns, staged by stage_codelist (the code
+                        lookup may be staged for a larger codelist, e.g. when extracting one category at a time, and
+                        is restricted to the staged codelist), or None for every code in the lookup (staged with
+                        stage_code_lookup(connection, end_date, codelist=False), e.g. to roll up every level of the
+                        hierarchy locally, see rollup.py)
+    end_date (str): end date of study period
+    summary (str): optional summary table to extract from instead of CodedEvent (see summary_table.py)
+
+    Outputs:
+    sql3 (str): sql query (requires #reg, #listsize and #calendar from staging_sql, and #codes from
+                stage_code_lookup). "month" is the start of each period of the calendar (weeks if staged weekly)
+    params (list): query parameters
+    '''
+
+    if summary is not None:
+        from summary_table import summary_events_sql
+        return summary_events_sql(summary, subset, end_date)
+
+    # the lookup is restricted to the staged codelist once per code rather than once per event
+    code_filter = "" if subset is None else '''
+        AND EXISTS (SELECT 1 FROM #codelist f WHERE LEFT(k.CTV3Code, f.digits) = f.code)'''
+
+    #### sql query for extracting data for all codes in codelist: codes are matched (and grouped) through the code
+    #### lookup and dates through the calendar, so neither is computed for each event
+    sql3 = f'''select
+        k.first_digits,
+        c.period_start AS month,
         r.Practice_ID,
         COUNT(e.Patient_ID) as numerator,
         l.list_size as denominator
         FROM CodedEvent e
+        INNER JOIN #codes k ON e.CTV3Code = k.CTV3Code{code_filter}
+        INNER JOIN #calendar c ON e.ConsultationDate >= c.period_start AND e.ConsultationDate < c.next_start
         INNER JOIN #reg r ON e.Patient_ID = r.Patient_ID AND r.registration_date_rank = 1
         INNER JOIN #listsize l ON r.Practice_ID = l.Practice_ID
-        WHERE 
-        ConsultationDate IS NOT NULL 
-        AND ({out_string})
-        AND ConsultationDate >= '20190101' 
-        AND ConsultationDate <= '{end_date}'
-        GROUP BY 
-        CASE WHEN CHARINDEX('.',CTV3Code) > 0
-            THEN LEFT(CTV3Code,CHARINDEX('.',CTV3Code)-1) 
-            ELSE CTV3Code END, 
-            DATEFROMPARTS(YEAR(ConsultationDate), MONTH(ConsultationDate), 1), 
-            r.Practice_ID, l.list_size
+        WHERE
+        e.ConsultationDate >= '20190101'
+        AND e.ConsultationDate <= ?
+        GROUP BY k.first_digits, c.period_start, r.Practice_ID, l.list_size
         ORDER BY month'''
+    return sql3, [sql_date(end_date)]
 
-    ######
-    
-    ##### find top full-length codes appearing within parent codes at level 2 and level 3 respectively
-    d = np.where(subset["digits"].max()==5, 3, 2)
-    c = subset.loc[subset["digits"]==d] # select only codes with the min number of digits 
-                                        # (either all are 2, or there is a mix of 3 & 5, where only the 3-digit ones need a list of sub codes producing)
-    c = str(tuple(subset["first_digits"])).replace(",)",")") 
-    subcodes = get_subcodes(c, code_dict, d, end_date, threshold, dbconn) 
-    subcodes = subcodes.loc[~subcodes['Description'].str.contains('Erectile')] # exclude erectile dysfuntion
-    now = datetime.now()
-    subcodes.to_csv(os.path.join("..","output",f"subcodes_l{d}_{end_date}_{now}.csv"), index=False)
-    #####
-    
-    
-    ##### list of activity categories to group by
-    cats = subset.groupby("concept_desc")[["2020 events (mill)"]].sum().sort_values(by="2020 events (mill)", ascending=False).reset_index()
-    cats = cats.loc[~cats["concept_desc"].isin(["Additional values","Unit"])]
-    cats = cats.concept_desc
-    #####
 
-    ##################
-    # run sql queries:
-    with closing_connection(dbconn) as connection:
-        connection.execute(sql1) # patient registrations
-        connection.execute(sql2) # practice list size
-        df0 = pd.read_sql(sql3, connection) # events  
-            
-                    
-        for cat in cats:
-            subset_cat = subset.copy().loc[subset["concept_desc"]==cat]
-            total_events = round(subset_cat["2020 events (mill)"].sum(),2)
-            # fill any missing descriptions
-            subset_cat["Description"] = subset_cat["Description"].fillna("Unknown")
-            display(Markdown(f"# --- \n # Category: {cat}"))
-            display(Markdown(f"Total events: {total_events} m"))
-            display(Markdown(f"## Contents:"))
-            display(subset_cat[["first_digits", "Description", "2020 events (mill)", "2020 Patient count (mill)"]].drop_duplicates())
-            
-            for code, digits, desc, e_mill, pts in zip(subset_cat.first_digits, subset_cat.digits, subset_cat.Description, subset_cat["2020 events (mill)"], subset_cat["patients"]):
-                # extract time series data for each code
-                df = df0.copy().loc[df0["first_digits"].str[:len(code)]==code]
-                # group data to all full codes that begin with current code
-                df["first_digits"] = df["first_digits"].str[:len(code)]
-                df = df.groupby(["month","first_digits", "Practice_ID","denominator"]).sum().reset_index()
-
-                desc = desc.replace("'","") # replace apostrophes 
-                
-                if len(df)>0:
-                    out, practice_count, practices_percent = all_pracs(df0, df, code)
-                    out["value"] = 1000*out["numerator"]/out["denominator"]
-                    
-                    endmonth = out["month"].max()
-                    endmonth_2019 = endmonth + relativedelta(years=-1)
-                    endmonthname = endmonth.strftime("%B")
-                    
-                    # classify changes occurring between timepoints
-                    clfy = pd.Series(dtype="float64")
-                    clfy2 = pd.Series(dtype="float64")
-                    for d in [date(2019,4,1), endmonth_2019, date(2020,2,1), date(2020,4,1), endmonth]:
-                        clfy[d] = out.loc[out["month"]==d]["value"].median()
-                    for d in [date(2020,2,1), date(2020,4,1), endmonth]:
-                        clfy[str(d)+"_IDR"] = out.loc[out["month"]==d]["value"].quantile(0.9) - out.loc[out["month"]==d]["value"].quantile(0.1)
-                    def pct_change(clfy, a, b): # calculate percentage change between two columns
-                        if clfy[b]>0: # if denominator is non-zero calculate as normal
-                            out = 100*(clfy[a]-clfy[b])/clfy[b]
-                        else: # if denominator is zero:
-                            if clfy[a]>0: # if numerator is non-zero set increase to 100%
-                                out = 100
-                            else:
-                                out = 0
-                        return (out)
-
-                    clfy2["peak"] = pct_change(clfy, date(2020,4,1), date(2019,4,1))
-                    clfy2["recovery"] = pct_change(clfy, endmonth, endmonth_2019)
-
-                    ##### categories for drop / rise / recovery 
-                    ###################################################################### 
-                    condlist = [(clfy2["peak"]>15), ## increase
-                                ((clfy2["peak"]<15)&(clfy2["peak"]>-15)), ## no change
-                                (clfy2["peak"]>-60), # small drop
-                                (clfy2["peak"]<-60)] # large drop
-                    choicelist = ["Increase", "No change", "Small drop", "Large drop"]
-                    clfy2["april_position"] = np.select(condlist, choicelist, default="Other") 
-
-                    condlist = [(clfy2["recovery"]>15), ## increase
-                                ((clfy2["recovery"]<15)&(clfy2["recovery"]>-15)), ## no change
-                                (clfy2["recovery"]>-60), # small drop
-                                (clfy2["recovery"]<-60)] # large drop
-                    choicelist = ["Increase", "No change", "Small drop", "Large drop"]
-                    clfy2[f"{endmonthname}_position"] = np.select(condlist, choicelist, default="Other") 
-
-                    condlist = [((clfy2["april_position"]=="Increase")|(clfy2[f"{endmonthname}_position"]=="Increase")), ## increase
-                                 ((clfy2["april_position"]=="No change")), ## no change
-                                 ((clfy2[f"{endmonthname}_position"]=="Small drop")|(clfy2[f"{endmonthname}_position"]=="Large drop")), # sustained drop
-                                 ((clfy2["peak"]<-15) & (clfy2["recovery"]>-15))] # drop with recovery
-                    choicelist = ["Increase", "No change", "Sustained drop", "Recovered"]
-                    clfy2["overall_position"] = np.select(condlist, choicelist, default="Other") 
-
-                    feb_median = round(clfy[date(2020,2,1)],1)
-                    apr_median = round(clfy[date(2020,4,1)],1)
-                    endmonth_median = round(clfy[endmonth],1)
-                    feb_idr = round(clfy["2020-02-01_IDR"],1)
-                    apr_idr = round(clfy["2020-04-01_IDR"],1)
-                    endmonth_idr = round(clfy[f"{endmonth}_IDR"],1)
-                    peak = round(clfy2["peak"],1)
-                    recovery = round(clfy2["recovery"],1)
-                    april_position = clfy2["april_position"]
-                    endmonth_position = clfy2[f"{endmonthname}_position"]
-                    pos = clfy2["overall_position"]
-                    ######################################################################
-                    
-                    e_mill = round(e_mill, 2)
-                    if pts>1000000:
-                        pt_count = str(round(pts/1000000, 2))+ "m"
-                    else:
-                        pt_count = str(round(pts/1000, 1))+ "k"
-                        
-                    Title = f'''"{code}" - {desc} \n ### (Practices included: {practice_count}k ({practices_percent}%); 2020 patients: {pt_count}; 2020 events: {e_mill}m)'''
-                    display(Markdown(f"## {Title}"))
-                    
-                    total_events = round(out["numerator"].sum(), 1)
-
-                    if total_events>10:
-                        display(Markdown(f"Feb median: {feb_median} (IDR {feb_idr}), April median: {apr_median} (IDR {apr_idr}), {endmonthname} median: {endmonth_median} (IDR {endmonth_idr})"))
-                        display(Markdown(f"Change in median from 2019: April {peak}% ({april_position}); {endmonthname} {recovery}%, ({endmonth_position}); Overall classification: **{pos}**"))
-                        
-                        plot_charts(out, outer_percentiles=False)
-                        
-                        if (digits==2) | (digits==3):   ## display top 5 codes within each parent code
-                            display(Markdown(f"Top 'child' codes represented within parent code above:"))
-                            subs = subcodes.copy().loc[subcodes["parent_code"]==code].drop("parent_code",1).head(5)
-                            display(subs)
-                            if second_chart==True:
-                                top_test = subs.head(1)
-                                if (len(top_test)==0):
-                                    pass
-                                else:
-                                    code2 = top_test["first_digits"].values[0]
-                                    desc2 = top_test["Description"].values[0]
-
-                                    df2 = df0.loc[df0["first_digits"].str[:len(code2)]==code2]
-                                    df2, _, _ = all_pracs(df0, df2, code2)
-
-                                    if (code2!=code):
-                                        out = df2.copy()
-                                        out["value"] = 1000*df2["numerator"]/df2["denominator"]
-
-                                        # title
-                                        display(Markdown(f"### Trend in top child code: {code2} - {desc2}"))
-
-                                        total_events = out["numerator"].sum()
-                                        plot_charts(out, outer_percentiles=False)
-                                    else:
-                                    	pass
-                            else:
-                                pass
-                    else:
-                        display (Markdown(f"### {desc}: _Too few events to plot_"))
-                        pass
+def estimate_sql(subset, end_date, summary=None):
 
-                else:
-                    pass
-                
+    '''
+    Cheap pre-query counting matching events per month (no joins or distinct counts), giving the months covered
+    and an upper bound on the number of rows events_sql will return
 
-            
-    
-def filter_codelists(df, keywords=None, concepts=None, eventcount=False, in_or_out="out", codelist_type=None):
+    Inputs:
+    subset (dataframe): codelist containing "first_digits" and "digits" columns, staged by stage_codelist and
+                        stage_code_lookup (requires #calendar from staging_sql)
+    end_date (str): end date of study period
+    summary (str): optional summary table to count from instead of CodedEvent (see summary_table.py)
+
+    Outputs:
+    sql (str): sql query returning "month" and "events"
+    params (list): query parameters
+    '''
+
+    if summary is not None:
+        from summary_table import summary_estimate_sql
+        return summary_estimate_sql(summary, end_date)
+
+    sql = '''select
+        c.period_start AS month,
+        COUNT_BIG(*) AS events
+        FROM CodedEvent e
+        INNER JOIN #codes k ON e.CTV3Code = k.CTV3Code
+        INNER JOIN #calendar c ON e.ConsultationDate >= c.period_start AND e.ConsultationDate < c.next_start
+        WHERE
+        e.ConsultationDate >= '20190101'
+        AND e.ConsultationDate <= ?
+        GROUP BY c.period_start
+        ORDER BY month'''
+    return sql, [sql_date(end_date)]
+
+
+def pushdown_sql(end_date):
+
+    '''
+    Queries to calculate practice-level rates and their deciles server-side, so that only one row per code and month
+    is returned rather than one row per code, practice and month. As in all_pracs, each code's rates include zeros for
+    every month for all practices which have ever used the code during the period covered.
+
+    Inputs:
+    end_date (str): end date of study period
+
+    Outputs:
+    staging (list): (sql, params) to execute in turn (after staging_sql, and stage_codelist with the codelist, codes
+                    matched on prefix, and top child codes for the second chart, matched exactly)
+    sql_deciles (str): query returning "first_digits", "month", "p10"-"p90", "practices" and "numerator"
+    sql_practices (str): query returning total number of practices included in the extract
+    '''
+
+    sql_create = '''-- events per code, practice and month
+    CREATE TABLE #events (first_digits VARCHAR(5), month DATE, Practice_ID INT, numerator INT);
+    '''
+
+    sql_events = '''INSERT INTO #events (first_digits, month, Practice_ID, numerator)
+    SELECT
+    c.code AS first_digits,
+    m.period_start AS month,
+    r.Practice_ID,
+    COUNT(e.Patient_ID) AS numerator
+    FROM CodedEvent e
+    INNER JOIN #codelist c ON LEFT(e.CTV3Code, c.digits) = c.code
+    INNER JOIN #calendar m ON e.ConsultationDate >= m.period_start AND e.ConsultationDate < m.next_start
+    INNER JOIN #reg r ON e.Patient_ID = r.Patient_ID AND r.registration_date_rank = 1
+    WHERE
+    (c.exact = 0 OR REPLACE(e.CTV3Code, '.', '') = c.code)
+    AND e.ConsultationDate >= '20190101'
+    AND e.ConsultationDate <= ?
+    GROUP BY c.code, m.period_start, r.Practice_ID
+    '''
+
+    sql_practices = '''-- practices which have used each code, and all months covered
+    SELECT DISTINCT first_digits, Practice_ID INTO #code_practices FROM #events;
+    SELECT DISTINCT month INTO #months FROM #events;
+    '''
+
+    percentiles = ",\n    ".join([f"PERCENTILE_CONT({p/10}) WITHIN GROUP (ORDER BY value) OVER (PARTITION BY first_digits, month) AS p{10*p}"
+                                  for p in range(1, 10)])
+
+    sql_deciles = f'''-- deciles of practice-level rates (including zeros) per code and month
+    SELECT DISTINCT
+    first_digits,
+    month,
+    {percentiles},
+    COUNT(*) OVER (PARTITION BY first_digits, month) AS practices,
+    SUM(numerator) OVER (PARTITION BY first_digits, month) AS numerator
+    FROM (
+        SELECT
+        p.first_digits,
+        m.month,
+        p.Practice_ID,
+        COALESCE(e.numerator, 0) AS numerator,
+        1000.0*COALESCE(e.numerator, 0)/l.list_size AS value
+        FROM #code_practices p
+        CROSS JOIN #months m
+        INNER JOIN #listsize l ON p.Practice_ID = l.Practice_ID
+        LEFT JOIN #events e ON e.first_digits = p.first_digits AND e.month = m.month AND e.Practice_ID = p.Practice_ID
+    ) rates
+    ORDER BY first_digits, month'''
+
+    sql_total = '''-- total practices included in extract
+    SELECT COUNT(DISTINCT Practice_ID) AS practices FROM #events'''
+
+    return [(sql_create, []), (sql_events, [sql_date(end_date)]), (sql_practices, [])], sql_deciles, sql_total
+
+
+def plan_codelists(codelists):
+
+    '''
+    Combine several codelists (e.g. high level and detailed) into one list of codes to extract at the finest
+    granularity needed. Codes already covered by a shorter code in the combined list are dropped, since events_sql
+    returns full length codes which are grouped up to each code locally.
+
+    Inputs:
+    codelists (list): codelists (dataframes) containing "first_digits" and "digits" columns
+
+    Output:
+    plan (dataframe): combined codelist ("first_digits" and "digits")
+    '''
+
+    codes = pd.concat([c[["first_digits", "digits"]] for c in codelists]).drop_duplicates()
+    codes = codes.sort_values(by=["digits", "first_digits"])
+    keep = []
+    for code in codes["first_digits"]:
+        if not any(code[:len(k)]==k for k in keep):
+            keep.append(code)
+    plan = codes.loc[codes["first_digits"].isin(keep)].reset_index(drop=True)
+    return plan
+
+
+def extract_events(codelists, end_date, dbconn, summary=None):
+
+    '''
+    Run a single events extraction covering several codelists, to pass to plotting_all for each of them
+
+    Inputs:
+    codelists (list): codelists (dataframes, already cut down to the number of charts to plot)
+    end_date (str): end date of study period
+    dbconn (str): SQL credentials
+    summary (str): optional summary table to extract events from instead of CodedEvent (see summary_table.py)
+
+    Output:
+    df0 (dataframe): events extract (see events_sql), with the summary table recorded in df0.attrs["summary"] so that
+                     plotting_all labels its charts
+    '''
+
+    plan = plan_codelists(codelists)
+    with closing_connection(dbconn) as connection:
+        for sql, params in staging_sql(end_date): # patient registrations and practice list size
+            connection.execute(sql, *params)
+        from summary_table import find_summary
+        summary = find_summary(connection, summary)
+        stage_codelist(connection, plan)
+        if summary is None:
+            stage_code_lookup(connection, end_date)
+        sql, params = events_sql(plan, end_date, summary)
+        df0 = pd.read_sql(sql, connection, params=params) # events
+    if summary is not None:
+        df0.attrs["summary"] = summary
+    return df0
+
+
+def restrict_extract(df0, codes):
+
+    '''
+    Restrict an events extract to full codes beginning with any of the given codes, so that months and practice
+    totals are the same as if the extract had been run for those codes alone
+
+    Inputs:
+    df0 (dataframe): events extract
+    codes (list): full or truncated CTV3 codes
+
+    Output:
+    (dataframe): restricted extract
+    '''
+
+    distinct = pd.Series(df0["first_digits"].unique())
+    matches = distinct.loc[distinct.apply(lambda x: any(x[:len(c)]==c for c in codes))]
+    return df0.loc[df0["first_digits"].isin(matches)].reset_index(drop=True)
+
+
+def sweep_sql(subset, end_dates):
+
+    '''
+    Queries to extract events once for several end dates (snapshots). Each patient's registration at each end date is
+    staged with a bitmask of the snapshots it applies to (bit i for end_dates[i]), so patients whose practice is the same
+    at every end date only appear once, and events are grouped by practice and bitmask. As in events_sql, codes and
+    months are found through the code lookup and the calendar rather than computed for each event.
+
+    Inputs:
+    subset (dataframe): codelist containing "first_digits" and "digits" columns
+    end_dates (list): end dates to compare ("YYYYMMDD", in ascending order). All but the latest must be the last day of
+                      a month, as snapshots are split from the extract by month
+
+    Outputs:
+    staging (list): (sql, params) to execute in turn (after stage_codelist and stage_code_lookup with the codelist,
+                    up to the latest end date)
+    sql_events (tuple): (sql, params) of query returning "first_digits", "month", "Practice_ID", "snapshots" (bitmask)
+                        and "numerator"
+    sql_listsize (tuple): (sql, params) of query returning "Practice_ID", "snapshot" (bit) and "list_size"
+    '''
+
+    for end_date in end_dates[:-1]:
+        d = datetime.strptime(end_date, "%Y%m%d")
+        if (d + timedelta(days=1)).day!=1:
+            raise ValueError(f"end date {end_date} is not the last day of a month")
+
+    sql_snapshots = '''-- end dates and their bits, and the calendar up to the latest
+    CREATE TABLE #snapshots (end_date DATE, snapshot INT);
+    ''' + CALENDAR_TABLE
+    # end dates are bound as one comma-separated parameter, so the query text is the same however many there are
+    sql_snapshots_fill = '''INSERT INTO #snapshots (end_date, snapshot)
+    SELECT end_date, POWER(2, ROW_NUMBER() OVER (ORDER BY end_date) - 1) AS snapshot
+    FROM (SELECT CAST(value AS DATE) AS end_date FROM STRING_SPLIT(?, ',')) d;
+    '''
+    params = [",".join(end_dates)]
+
+    sql_reg = '''-- patient registrations live at each end date, with a bitmask of the end dates
+    SELECT Patient_ID, Practice_ID, SUM(snapshot) AS snapshots
+    INTO #reg_sweep
+    FROM (
+        SELECT
+        Patient_ID,
+        Organisation_ID AS Practice_ID,
+        d.snapshot,
+        ROW_NUMBER() OVER (partition by Patient_ID, d.snapshot ORDER BY StartDate DESC, EndDate DESC) AS registration_date_rank
+        FROM RegistrationHistory
+        CROSS JOIN #snapshots d
+        WHERE
+        StartDate <= d.end_date AND
+        EndDate >= d.end_date
+    ) r
+    WHERE registration_date_rank = 1
+    GROUP BY Patient_ID, Practice_ID
+    '''
+
+    sql_listsize = '''-- practice list size at each end date
+    SELECT
+    Organisation_ID AS Practice_ID,
+    d.snapshot,
+    COUNT(DISTINCT Patient_ID) AS list_size
+    FROM RegistrationHistory
+    CROSS JOIN #snapshots d
+    WHERE StartDate <= d.end_date AND
+    EndDate >= d.end_date
+    GROUP BY Organisation_ID, d.snapshot'''
+
+    sql_events = '''select
+        k.first_digits,
+        c.period_start AS month,
+        r.Practice_ID,
+        r.snapshots,
+        COUNT(e.Patient_ID) as numerator
+        FROM CodedEvent e
+        INNER JOIN #codes k ON e.CTV3Code = k.CTV3Code
+        INNER JOIN #calendar c ON e.ConsultationDate >= c.period_start AND e.ConsultationDate < c.next_start
+        INNER JOIN #reg_sweep r ON e.Patient_ID = r.Patient_ID
+        WHERE
+        e.ConsultationDate >= '20190101'
+        AND e.ConsultationDate <= ?
+        GROUP BY k.first_digits, c.period_start, r.Practice_ID, r.snapshots
+        ORDER BY month'''
+    staging = [(sql_snapshots, []), (sql_snapshots_fill, params), calendar_sql(end_dates[-1]), (sql_reg, [])]
+    return staging, (sql_events, [sql_date(end_dates[-1])]), (sql_listsize, [])
+
+
+def snapshot_extract(extract, listsizes, i, end_date):
+
+    '''
+    Split the events extract for a single end date out of a sweep extract
+
+    Inputs:
+    extract (dataframe): output of the sweep_sql events query
+    listsizes (dataframe): output of the sweep_sql list size query
+    i (int): position of end date in end_dates
+    end_date (str): end date
+
+    Output:
+    df0 (dataframe): events extract in the same form as events_sql for this end date
+    '''
+
+    end = datetime.strptime(end_date, "%Y%m%d").date()
+    df = extract.loc[((extract["snapshots"] & 2**i)>0) & (extract["month"]<=end)]
+    # patients registered at the same practice are split by their other snapshots, so add them back together
+    df = df.groupby(["first_digits", "month", "Practice_ID"])["numerator"].sum().reset_index()
+    sizes = listsizes.loc[listsizes["snapshot"]==2**i, ["Practice_ID", "list_size"]].rename(columns={"list_size": "denominator"})
+    df0 = df.merge(sizes, on="Practice_ID", how="inner")
+    return df0
+
+
+def sweep_table(subset, sweep_results):
+
+    '''
+    Compare the medians, changes and classifications of each code between end dates
+
+    Inputs:
+    subset (dataframe): codelist
+    sweep_results (dict): results (see compute_results) keyed by end date
+
+    Output:
+    table (dataframe): one row per code, with columns for each end date
+    '''
+
+    cols = [("endmonth_median", "latest median"), ("peak", "April change (%)"), ("recovery", "latest change (%)"), ("overall_position", "classification")]
+    table = subset[["first_digits", "Description"]].copy().reset_index(drop=True)
+    for end_date, results in sweep_results.items():
+        for stat, label in cols:
+            table[f"{label} {end_date}"] = [results[code]["stats"][stat] if results.get(code) is not None else None for code in table["first_digits"]]
+    classifications = table[[f"classification {end_date}" for end_date in sweep_results]]
+    table["classification changed"] = classifications.nunique(axis=1, dropna=False)>1
+    return table
+
+
+def pushdown_results(wide, code, practices_total):
+
+    '''
+    Reshape server-side deciles for a single code into the same form as calculate_deciles
+
+    Inputs:
+    wide (dataframe): output of the pushdown_sql deciles query
+    code (str): code to select
+    practices_total (int): total number of practices included in extract
+
+    Outputs:
+    deciles (dataframe): "month", "percentile" and "value" columns
+    practice_count_thou (float): number of practices included
+    practices_percent (float): percent of all practices included
+    total_events (float): sum of events across all months
+    (None if code is not in extract)
+    '''
+
+    df = wide.loc[wide["first_digits"]==code]
+    if len(df)==0:
+        return None
+    deciles = df.melt(id_vars=["month"], value_vars=[f"p{10*p}" for p in range(1, 10)], var_name="percentile")
+    deciles["percentile"] = deciles["percentile"].str[1:].astype(int)
+
+    practice_count = df["practices"].max()
+    practice_count_thou = round(practice_count/1000, 1)
+    practices_percent = round(100*practice_count/practices_total, 1)
+    total_events = df["numerator"].sum()
+    return deciles, practice_count_thou, practices_percent, total_events
+
+
+def code_series(df0, code, months=None, listsizes=None):
+
+    '''
+    Extract practice-level time series for a single code from the full extract
+
+    Inputs:
+    df0 (dataframe): full time series data for all codes in codelist, or rolled up to every prefix (see rollup_cube)
+    code (str): full or truncated CTV3 code
+    months (list): optional months to include (see all_pracs)
+    listsizes (dataframe): optional list size for each practice and month (see monthly_listsizes) to use as the
+                           denominator instead of list size at the end date
+
+    Outputs:
+    out (dataframe): time series data at practice level including "value" (rate per 1000), or None if code not used
+    practice_count_thou (float): number of practices included
+    practices_percent (float): percent of all practices included
+    '''
+
+    if ENGINE=="polars": # filter, group and expand to all practices in one query
+        from polars_engine import code_series as polars_code_series
+        out, practice_count, practices_percent = polars_code_series(df0, code, months)
+        if out is None:
+            return None, 0, 0
+    else:
+        if "digits" in df0.columns: # already rolled up, so the code's rows are already grouped
+            df = df0.loc[(df0["digits"]==len(code)) & (df0["first_digits"]==code)].drop(columns="digits")
+        else:
+            # extract time series data for each code
+            df = df0.copy().loc[df0["first_digits"].str[:len(code)]==code]
+            # group data to all full codes that begin with current code
+            df["first_digits"] = df["first_digits"].str[:len(code)]
+            df = df.groupby(["month","first_digits", "Practice_ID","denominator"]).sum().reset_index()
+
+        if len(df)==0:
+            return None, 0, 0
+
+        out, practice_count, practices_percent = all_pracs(df0, df, code, months)
+    if listsizes is not None:
+        out = apply_listsizes(out, listsizes)
+    out["value"] = 1000*out["numerator"]/out["denominator"]
+    return out, practice_count, practices_percent
+
+
+def calculate_deciles(out):
+
+    '''
+    Calculate deciles of practice-level rates for each month
+
+    Inputs:
+    out (dataframe): time series data at practice level (from all_pracs) including "value" column
+
+    Output:
+    deciles (dataframe): "month", "percentile" (10, 20 ... 90) and "value" columns
+    '''
+
+    deciles = out.groupby("month")["value"].quantile([p/10 for p in range(1, 10)]).reset_index()
+    deciles = deciles.rename(columns={"level_1":"percentile"})
+    deciles["percentile"] = (100*deciles["percentile"]).round().astype(int)
+    return deciles
+
+
+def pct_change(clfy, a, b):
+
+    '''
+    Calculate percentage change between two items in a series
+    '''
+
+    if clfy[b]>0: # if denominator is non-zero calculate as normal
+        out = 100*(clfy[a]-clfy[b])/clfy[b]
+    else: # if denominator is zero:
+        if clfy[a]>0: # if numerator is non-zero set increase to 100%
+            out = 100
+        else:
+            out = 0
+    return (out)
+
+
+def classify_position(change):
+
+    '''
+    Categorise percentage change(s) in median as increase / no change / small drop / large drop
+
+    Inputs:
+    change (float or array): percentage change
+
+    Output:
+    (array): classification(s)
+    '''
+
+    condlist = [(change>15), ## increase
+                ((change<15)&(change>-15)), ## no change
+                (change>-60), # small drop
+                (change<-60)] # large drop
+    choicelist = ["Increase", "No change", "Small drop", "Large drop"]
+    return np.select(condlist, choicelist, default="Other")
+
+
+def classify_overall(peak, recovery, april_position, endmonth_position):
+
+    '''
+    Categorise overall change as increase / no change / sustained drop / recovered
+
+    Inputs:
+    peak, recovery (float or array): percentage change in median at April and the latest month compared with 2019
+    april_position, endmonth_position (str or array): outputs of classify_position
+
+    Output:
+    (array): classification(s)
+    '''
+
+    condlist = [((april_position=="Increase")|(endmonth_position=="Increase")), ## increase
+                 ((april_position=="No change")), ## no change
+                 ((endmonth_position=="Small drop")|(endmonth_position=="Large drop")), # sustained drop
+                 ((peak<-15) & (recovery>-15))] # drop with recovery
+    choicelist = ["Increase", "No change", "Sustained drop", "Recovered"]
+    return np.select(condlist, choicelist, default="Other")
+
+
+def percentile_at(deciles, month, percentile):
+
+    '''
+    Look up a single percentile value for a given month (NaN if month not present)
+    '''
+
+    value = deciles.loc[(deciles["month"]==month) & (deciles["percentile"]==percentile), "value"]
+    if len(value)==0:
+        return np.nan
+    return value.iloc[0]
+
+
+def classify_changes(deciles):
+
+    '''
+    Calculate medians and inter-decile ranges (IDR) at key timepoints and classify the changes occurring between them
+
+    Inputs:
+    deciles (dataframe): "month", "percentile" and "value" columns (from calculate_deciles or computed server-side)
+
+    Output:
+    stats (dict): medians, IDRs, percentage changes and classifications
+    '''
+
+    from dateutil.relativedelta import relativedelta
+    endmonth = deciles["month"].max()
+    endmonth_2019 = endmonth + relativedelta(years=-1)
+    endmonthname = endmonth.strftime("%B")
+
+    # classify changes occurring between timepoints
+    clfy = pd.Series(dtype="float64")
+    for d in [date(2019,4,1), endmonth_2019, date(2020,2,1), date(2020,4,1), endmonth]:
+        clfy[d] = percentile_at(deciles, d, 50)
+    for d in [date(2020,2,1), date(2020,4,1), endmonth]:
+        clfy[str(d)+"_IDR"] = percentile_at(deciles, d, 90) - percentile_at(deciles, d, 10)
+
+    peak = pct_change(clfy, date(2020,4,1), date(2019,4,1))
+    recovery = pct_change(clfy, endmonth, endmonth_2019)
+
+    ##### categories for drop / rise / recovery
+    april_position = str(classify_position(peak))
+    endmonth_position = str(classify_position(recovery))
+    pos = str(classify_overall(peak, recovery, april_position, endmonth_position))
+
+    stats = {"endmonth": endmonth,
+             "endmonthname": endmonthname,
+             "feb_median": round(clfy[date(2020,2,1)],1),
+             "apr_median": round(clfy[date(2020,4,1)],1),
+             "endmonth_median": round(clfy[endmonth],1),
+             "feb_idr": round(clfy["2020-02-01_IDR"],1),
+             "apr_idr": round(clfy["2020-04-01_IDR"],1),
+             "endmonth_idr": round(clfy[f"{endmonth}_IDR"],1),
+             "peak": round(peak,1),
+             "recovery": round(recovery,1),
+             "april_position": april_position,
+             "endmonth_position": endmonth_position,
+             "overall_position": pos}
+    return stats
+
+
+def display_code(code, desc, e_mill, pts, digits, result, subcodes, label=None):
+
+    '''
+    Display header text, summary statistics, decile chart(s) and top child codes for a single code
+
+    Inputs:
+    code (str): full or truncated CTV3 code
+    desc (str): code description
+    e_mill (float): 2020 events (millions)
+    pts (int): 2020 patient count
+    digits (int): number of digits in code
+    result (dict): output of compute_code / pushdown results for this code
+    subcodes (dataframe): top full length codes within each parent code
+    label (str): optional label for the chart(s) (e.g. for previews)
+    '''
+
+    desc = desc.replace("'","") # replace apostrophes
+
+    e_mill = round(e_mill, 2)
+    if pts>1000000:
+        pt_count = str(round(pts/1000000, 2))+ "m"
+    else:
+        pt_count = str(round(pts/1000, 1))+ "k"
+
+    Title = f'''"{code}" - {desc} \n ### (Practices included: {result["practice_count"]}k ({result["practices_percent"]}%); 2020 patients: {pt_count}; 2020 events: {e_mill}m)'''
+    display(Markdown(f"## {Title}"))
+
+    if result["total_events"]>10:
+        s = result["stats"]
+        endmonthname = s["endmonthname"]
+        display(Markdown(f"Feb median: {s['feb_median']} (IDR {s['feb_idr']}), April median: {s['apr_median']} (IDR {s['apr_idr']}), {endmonthname} median: {s['endmonth_median']} (IDR {s['endmonth_idr']})"))
+        display(Markdown(f"Change in median from 2019: April {s['peak']}% ({s['april_position']}); {endmonthname} {s['recovery']}%, ({s['endmonth_position']}); Overall classification: **{s['overall_position']}**"))
+
+        plot_deciles(result["deciles"], label) # deciles are always calculated, so no need to recalculate them from "out"
+
+        if (digits==2) | (digits==3):   ## display top 5 codes within each parent code
+            display(Markdown(f"Top 'child' codes represented within parent code above:"))
+            subs = subcodes.copy().loc[subcodes["parent_code"]==code].drop("parent_code",1).head(5)
+            display(subs)
+            child = result["child"]
+            if child is not None:
+                # title
+                display(Markdown(f"### Trend in top child code: {child['code']} - {child['desc']}"))
+                plot_deciles(child["deciles"], label)
+    else:
+        display (Markdown(f"### {desc}: _Too few events to plot_"))
+
+
+def top_child(subcodes, code):
+
+    '''
+    Find the top full length code within a parent code (None if there are none)
+    '''
+
+    top_test = subcodes.loc[subcodes["parent_code"]==code].head(1)
+    if len(top_test)==0:
+        return None, None
+    return top_test["first_digits"].values[0], top_test["Description"].values[0]
+
+
+def compute_code(df0, code, digits, subcodes, second_chart=False, months=None, listsizes=None):
+
+    '''
+    Calculate practice-level time series, deciles and classification for a single code
+
+    Inputs:
+    df0 (dataframe): full time series data for all codes in codelist
+    code (str): full or truncated CTV3 code
+    digits (int): number of digits in code
+    subcodes (dataframe): top full length codes within each parent code
+    second_chart (bool): also calculate the trend for the top code within the parent code
+    months (list): optional months to include (see all_pracs)
+    listsizes (dataframe): optional monthly list sizes to use as denominators (see code_series)
+
+    Output:
+    result (dict): practice-level series, deciles, practice coverage and classification (None if code not used)
+    '''
+
+    out, practice_count, practices_percent = code_series(df0, code, months, listsizes)
+    if out is None:
+        return None
+
+    deciles = calculate_deciles(out)
+    result = {"out": out,
+              "deciles": deciles,
+              "practice_count": practice_count,
+              "practices_percent": practices_percent,
+              "total_events": round(out["numerator"].sum(), 1),
+              "stats": classify_changes(deciles),
+              "child": None}
+
+    if second_chart==True and ((digits==2) | (digits==3)):
+        code2, desc2 = top_child(subcodes, code)
+        if (code2 is not None) and (code2!=code):
+            df2 = df0.loc[df0["first_digits"].str[:len(code2)]==code2]
+            df2, _, _ = all_pracs(df0, df2, code2, months)
+            if listsizes is not None:
+                df2 = apply_listsizes(df2, listsizes)
+            out2 = df2.copy()
+            out2["value"] = 1000*df2["numerator"]/df2["denominator"]
+            result["child"] = {"code": code2, "desc": desc2, "out": out2, "deciles": calculate_deciles(out2)}
+    return result
+
+
+def compact_result(result):
+
+    '''
+    Drop the practice-level series from a result (keeping deciles and classifications to display),
+    recording the number of practices so their percentage can be recalculated across a whole extract
+    '''
+
+    if result is None:
+        return None
+    result["practices"] = result["out"]["Practice_ID"].nunique()
+    result["out"] = None
+    if result["child"] is not None:
+        result["child"]["out"] = None
+    return result
+
+
+def compute_results(df0, subset, subcodes, second_chart=False, months=None, workers=None, listsizes=None):
+
+    '''
+    Calculate compact results (see compact_result) for every code in a codelist
+
+    Inputs:
+    df0 (dataframe): events extract
+    subset (dataframe): codelist containing "first_digits" and "digits" columns
+    subcodes (dataframe): top full length codes within each parent code
+    second_chart (bool): also calculate the trend for the top code within each parent code
+    months (list): optional months to include (see all_pracs)
+    workers (int): optional number of processes to share the work between (see parallel.py)
+    listsizes (dataframe): optional monthly list sizes to use as denominators (see code_series)
+
+    Output:
+    results (dict): results keyed by code
+    '''
+
+    if workers is not None:
+        from parallel import compute_parallel
+        return compute_parallel(df0, subset, subcodes, second_chart, months, workers, listsizes)
+
+    results = {}
+    for code, digits in zip(subset["first_digits"], subset["digits"]):
+        results[code] = compact_result(compute_code(df0, code, digits, subcodes, second_chart, months, listsizes))
+    return results
+
+
+def month_range(end_date):
+
+    '''
+    All months from January 2019 (start of study period) up to the month containing end_date
+    '''
+
+    from dateutil.relativedelta import relativedelta
+    end = datetime.strptime(end_date, "%Y%m%d").date()
+    months = []
+    month = date(2019,1,1)
+    while month<=end:
+        months.append(month)
+        month = month + relativedelta(months=1)
+    return months
+
+
+def stream_results(subset, cats, code_dict, end_date, threshold, connection, second_chart=False, workers=None, listsizes=None, summary=None):
+
+    '''
+    Extract and calculate results one category at a time, in display order
+
+    Inputs:
+    subset (dataframe): codelist
+    cats (series): categories, in display order
+    code_dict (dataframe): lookup table for code descriptions
+    end_date (str): end date of study period
+    threshold (int): lower limit for activity number
+    connection: open database connection with #reg and #listsize staged (see staging_sql), and the code lookup for
+                the whole codelist (see stage_code_lookup, not needed for a summary table)
+    second_chart (bool): also calculate the trend for the top code within each parent code
+    workers (int): optional number of processes to calculate each code's results in parallel
+    listsizes (dataframe): optional monthly list sizes to use as denominators (see code_series)
+    summary (str): optional summary table to extract events from (see summary_table.py)
+
+    Yields:
+    cat (str): category
+    subcodes_cat (dataframe): top full length codes within each parent code in the category
+    results_cat (dict): compact results keyed by code
+    '''
+
+    practices_total = pd.read_sql("SELECT COUNT(*) AS practices FROM #listsize", connection)["practices"][0]
+    months = month_range(end_date)
+    for cat in cats:
+        subset_cat = subset.loc[subset["concept_desc"]==cat]
+        stage_codelist(connection, subset_cat) # the code lookup is restricted to each category's codelist
+        sql, params = events_sql(subset_cat, end_date, summary)
+        df0 = pd.read_sql(sql, connection, params=params) # events
+        subcodes_cat = top_subcodes(df0, subset_cat["first_digits"], code_dict, end_date, threshold)
+        results_cat = compute_results(df0, subset_cat, subcodes_cat, second_chart, months, workers, listsizes)
+        df0 = None
+        for result in results_cat.values():
+            if result is not None:
+                result["practices_percent"] = round(100*result["practices"]/practices_total, 1)
+        yield cat, subcodes_cat, results_cat
+
+
+def compute_precomputed(lookup, code, digits, subcodes, second_chart=False):
+
+    '''
+    Equivalent of compute_code for deciles which have already been calculated (server-side, see pushdown_sql, or from sketches)
+
+    Inputs:
+    lookup (function): returns deciles, practice count, practice percent and total events for a code (or None if code not present)
+    code (str): full or truncated CTV3 code
+    digits (int): number of digits in code
+    subcodes (dataframe): top full length codes within each parent code
+    second_chart (bool): also look up the trend for the top code within the parent code
+
+    Output:
+    result (dict): deciles, practice coverage and classification (None if code not used)
+    '''
+
+    res = lookup(code)
+    if res is None:
+        return None
+
+    deciles, practice_count, practices_percent, total_events = res
+    result = {"out": None,
+              "deciles": deciles,
+              "practice_count": practice_count,
+              "practices_percent": practices_percent,
+              "total_events": round(total_events, 1),
+              "stats": classify_changes(deciles),
+              "child": None}
+
+    if second_chart==True and ((digits==2) | (digits==3)):
+        code2, desc2 = top_child(subcodes, code)
+        if (code2 is not None) and (code2!=code):
+            res2 = lookup(code2)
+            if res2 is not None:
+                result["child"] = {"code": code2, "desc": desc2, "out": None, "deciles": res2[0]}
+    return result
+
+
+def exact_deciles(df0, codes):
+
+    '''
+    Calculate exact deciles for each code from an events extract (e.g. to assess the error of sketches using sketch_error)
+
+    Inputs:
+    df0 (dataframe): full time series data for all codes in codelist
+    codes (list): full or truncated CTV3 codes
+
+    Output:
+    exact (dict): deciles for each code
+    '''
+
+    exact = {}
+    for code in codes:
+        out, _, _ = code_series(df0, code)
+        if out is not None:
+            exact[code] = calculate_deciles(out)
+    return exact
+
+
+def categories(subset):
+
+    '''
+    List of activity categories to group charts by, in descending order of 2020 events
+
+    Inputs:
+    subset (dataframe): codelist
+
+    Output:
+    cats (series): categories
+    '''
+
+    cats = subset.groupby("concept_desc")[["2020 events (mill)"]].sum().sort_values(by="2020 events (mill)", ascending=False).reset_index()
+    cats = cats.loc[~cats["concept_desc"].isin(["Additional values","Unit"])]
+    cats = cats.concept_desc
+    return cats
+
+
+# ways of getting the data for plotting_all, which each replace the standard extraction (only one can be used)
+SOURCES = ["df0", "sketches", "pushdown", "sweep", "strata", "stream"]
+# options of plotting_all and the other options they cannot be used with
+UNSUPPORTED = {"preview": ["df0", "sketches", "sweep"],
+               "monthly_denominators": ["pushdown", "sketches", "sweep", "strata", "hierarchy"],
+               "summary": ["df0", "pushdown", "sketches", "sweep", "strata"],
+               "workers": ["pushdown", "sketches", "strata", "hierarchy"],
+               "second_chart": ["strata", "hierarchy"],
+               "export_path": ["strata", "hierarchy"],
+               "hierarchy": ["pushdown", "sketches", "stream", "strata", "memory_budget"]}
+
+
+def check_modes(options):
+
+    '''
+    Check that the options given to plotting_all can be used together
+
+    Inputs:
+    options (dict): value of each option of plotting_all (options which are None or False are not used)
+
+    Output:
+    Raises a ValueError listing any options which cannot be used together
+    '''
+
+    used = [name for name, value in options.items() if value is not None and value is not False]
+    sources = [name for name in SOURCES if name in used]
+    conflicts = []
+    if len(sources)>1:
+        conflicts.append(" and ".join(sources))
+    for name, others in UNSUPPORTED.items():
+        if name in used:
+            conflicts += [f"{name} and {other}" for other in others if other in used]
+    if conflicts:
+        raise ValueError(f"Options cannot be used together: {'; '.join(conflicts)}")
+
+
+def plotting_all(codelist, code_dict, h, threshold, end_date, dbconn, second_chart=False, pushdown=False, sketches=None, memory_budget=None, workers=None, df0=None, stream=False, export_path=None, topic=None, codelist_type=None, sweep=None, monthly_denominators=False, preview=None, strata=None, hierarchy=None, summary=None):
+
+    '''
+    Extract data and plot a series of decile charts
+
+    Inputs:
+    codelist (dataframe): list of codes
+    code_dict (dataframe): lookup table for code descriptions
+    h (int): No of charts to plot
+    threshold (int): lower limit for activity number (global variable)
+    end_date (str): end date of study period
+    dbconn (str): SQL credentials
+    second_chart (bool): opt in to display the trend for the top code within each parent code (e.g. useful for path).
+                         Not used with strata or hierarchy
+    pushdown (bool): calculate practice-level rates and deciles server-side and only return one row per percentile,
+                     code and month (much less data transferred, e.g. over a slow connection)
+    sketches (dict): optional persisted sketches (see sketches.py) to calculate deciles from instead of extracting events
+    memory_budget (float): optional memory budget (MB). The size of the extract is estimated first and if it is
+                           over budget, events are extracted and processed one category at a time. Peak memory
+                           for each stage is reported at the end
+    workers (int): optional number of processes to calculate each code's series and classification in parallel
+                   (df0 is shared between them rather than copied). Not used with pushdown, sketches, strata or
+                   hierarchy
+    df0 (dataframe): optional events extract already fetched (e.g. by extract_events for both the high level and
+                     detailed lists), used instead of extracting events again
+    stream (bool): extract, calculate and display one category at a time, so the first charts appear as soon as
+                   the first category's data has arrived (practice percentages are then of all practices with
+                   registered patients, as the practices in the whole extract are not known up front)
+    export_path (str): optional root folder of a Parquet dataset to write the deciles and classifications to
+                       (see export.py), partitioned by topic and end_date. Not used with strata or hierarchy
+    topic (str): topic name to export results under
+    codelist_type (str): e.g. "High level" or "Detailed", to export results for each codelist separately
+    sweep (list): optional earlier end dates to compare with end_date. Events are extracted once, up to end_date, with
+                  each patient's registration at every end date, and each snapshot is split from it locally. Charts are
+                  displayed for end_date, followed by a table comparing the classifications at each end date
+    monthly_denominators (bool): use each practice's list size in each month as the denominator, rather than its list
+                                 size at end_date (events are still attributed to patients' practices at end_date).
+                                 Not used with pushdown, sketches, sweep, strata or hierarchy
+    preview (float): optional fraction of practices (e.g. 0.1) to sample (stratified by list size, the same sample
+                     every run) when iterating on a codelist. All queries and charts are restricted to the sample and
+                     the charts are labelled as previews. Not used with df0, sketches or sweep
+    strata (list): optional patient characteristics to break the charts down by: "age_band" and/or "sex". Events are
+                   extracted once with each patient's age band and sex (see strata.py), and each code's charts for
+                   every stratum are displayed side by side with a table of their classifications. Not used with df0,
+                   pushdown, sketches, sweep or stream
+    hierarchy (list): optional levels of the organisational hierarchy to also chart each code across: "stp" and/or
+                      "region". The practice-level extract is summed up to each level (see hierarchy.py) and each code's
+                      charts across practices and across areas are displayed side by side. Each area's denominator
+                      is the total list size of all its practices. Not used with pushdown, sketches, stream, strata,
+                      memory_budget (which may extract one category at a time) or export_path
+    summary (str): optional summary table (see summary_table.py) to extract events from instead of CodedEvent. Events
+                   are attributed to patients' practices at the time of each event rather than at end_date, so
+                   numerators differ for patients who moved practice, and every chart is labelled with the summary
+                   table (as are the charts of a df0 extracted from one by extract_events). Not used with df0,
+                   pushdown, sketches, sweep or strata
+
+    Options which are not used together (see check_modes) raise a ValueError before anything is extracted.
+
+    Outputs:
+    Header text, charts and tables
+    '''
+
+    check_modes({"second_chart": second_chart, "pushdown": pushdown, "sketches": sketches, "memory_budget": memory_budget,
+                 "workers": workers, "df0": df0, "stream": stream, "export_path": export_path, "sweep": sweep,
+                 "monthly_denominators": monthly_denominators, "preview": preview, "strata": strata,
+                 "hierarchy": hierarchy, "summary": summary})
+
+    ##### create subset of codelist up to maximum number provided
+    subset = codelist.head(h)
+
+    ##### find top full-length codes appearing within parent codes at level 2 and level 3 respectively
+    d = np.where(subset["digits"].max()==5, 3, 2)
+    now = datetime.now()
+    subcodes_file = os.path.join("..","output",f"subcodes_l{d}_{end_date}_{now}.csv")
+    if (sketches is not None) or pushdown:
+        # no events extract with full length codes to find them from, so query separately
+        subcodes = get_subcodes(list(subset["first_digits"]), code_dict, d, end_date, threshold, dbconn, summary)
+        subcodes = subcodes.loc[~subcodes['Description'].str.contains('Erectile')] # exclude erectile dysfuntion
+        subcodes.to_csv(subcodes_file, index=False)
+    # (otherwise calculated from the events extract below)
+    #####
+
+
+    ##### list of activity categories to group by
+    cats = categories(subset)
+    #####
+
+    label = None
+    if preview is not None:
+        label = f"Preview: {round(100*preview)}% sample of practices"
+        display(Markdown(f"**{label}** (stratified by list size)"))
+
+    # memory tracking for each stage (only in memory budget mode)
+    report = []
+    if memory_budget is not None:
+        from memory import estimate_mb, track_memory, memory_report
+    def track(stage):
+        if memory_budget is None:
+            return nullcontext()
+        return track_memory(stage, report)
+
+    ##################
+    # run sql queries:
+    lookup = None
+    results = None
+    displayed = False
+    tables = [] if export_path is not None else None
+    listsizes = None
+    staged = False # whether #listsize is staged
+    with closing_connection(dbconn) as connection:
+        from summary_table import find_summary, summary_label
+        summary = find_summary(connection, summary) # summary table of events per code, practice and month, if opted into
+        source = summary if df0 is None else df0.attrs.get("summary") # a shared extract records its summary table
+        if source is not None:
+            # every chart is labelled, as events are attributed to practices at the time of each event
+            source = summary_label(source)
+            display(Markdown(f"**{source}** (events attributed to practices at the time of each event, not at the end date)"))
+            label = source if label is None else f"{label}; {source}"
+        if monthly_denominators:
+            with track("monthly list sizes"):
+                sql, params = listsize_changes_sql(end_date)
+                changes = pd.read_sql(sql, connection, params=params)
+                listsizes = monthly_listsizes(changes, month_range(end_date))
+        if df0 is not None:
+            # shared extract, cut down to this codelist
+            df0 = restrict_extract(df0, list(subset["first_digits"]))
+            subcodes = top_subcodes(df0, subset["first_digits"], code_dict, end_date, threshold)
+            subcodes.to_csv(subcodes_file, index=False)
+            if workers is not None:
+                with track("calculate"):
+                    results = compute_results(df0, subset, subcodes, second_chart, workers=workers, listsizes=listsizes)
+        elif sketches is not None:
+            # deciles from persisted sketches, no events extraction needed
+            from sketches import sketch_results
+            lookup = lambda code: sketch_results(sketches, code)
+        elif pushdown:
+            for sql, params in staging_sql(end_date, preview): # patient registrations and practice list size
+                connection.execute(sql, *params)
+            staged = True
+            # top child codes are only needed for the second chart
+            children = []
+            if second_chart==True:
+                for code in subset.loc[subset["digits"].isin([2,3]), "first_digits"]:
+                    code2, _ = top_child(subcodes, code)
+                    if code2 is not None:
+                        children.append(code2)
+            stage_codelist(connection, subset, children)
+            staging, sql_deciles, sql_total = pushdown_sql(end_date)
+            for sql, params in staging:
+                connection.execute(sql, *params)
+            wide = pd.read_sql(sql_deciles, connection) # deciles
+            practices_total = pd.read_sql(sql_total, connection)["practices"][0]
+            lookup = lambda code: pushdown_results(wide, code, practices_total)
+        elif sweep is not None:
+            end_dates = sorted(set(sweep + [end_date]))
+            stage_codelist(connection, subset)
+            stage_code_lookup(connection, end_dates[-1])
+            staging, sql_events, sql_listsize = sweep_sql(subset, end_dates)
+            for sql, params in staging:
+                connection.execute(sql, *params)
+            with track("extract"):
+                extract = pd.read_sql(sql_events[0], connection, params=sql_events[1]) # events for all snapshots
+                snapshot_sizes = pd.read_sql(sql_listsize[0], connection, params=sql_listsize[1])
+            sweep_results = {}
+            with track("calculate"):
+                for i, e in enumerate(end_dates):
+                    if e!=end_date:
+                        sweep_results[e] = compute_results(snapshot_extract(extract, snapshot_sizes, i, e), subset, subcodes=None, workers=workers)
+                df0 = snapshot_extract(extract, snapshot_sizes, end_dates.index(end_date), end_date)
+                extract = None
+            subcodes = top_subcodes(df0, subset["first_digits"], code_dict, end_date, threshold)
+            subcodes.to_csv(subcodes_file, index=False)
+            results = compute_results(df0, subset, subcodes, second_chart, workers=workers)
+            sweep_results[end_date] = results
+            sweep_results = {e: sweep_results[e] for e in end_dates}
+        elif strata is not None:
+            from strata import strata_staging_sql, strata_events_sql, strata_listsize_sql, combined_extract, display_strata
+            for sql, params in staging_sql(end_date, preview) + strata_staging_sql(end_date): # registrations, practices and strata
+                connection.execute(sql, *params)
+            staged = True
+            with track("extract"):
+                stage_codelist(connection, subset)
+                stage_code_lookup(connection, end_date)
+                sql, params = strata_events_sql(end_date)
+                extract = pd.read_sql(sql, connection, params=params) # events for every stratum
+                sizes = pd.read_sql(strata_listsize_sql(), connection)
+            subcodes = top_subcodes(combined_extract(extract, sizes), subset["first_digits"], code_dict, end_date, threshold)
+            subcodes.to_csv(subcodes_file, index=False)
+            with track("calculate and display"):
+                display_strata(subset, cats, extract, sizes, list(strata), label)
+            displayed = True
+        elif stream:
+            for sql, params in staging_sql(end_date, preview): # patient registrations and practice list size
+                connection.execute(sql, *params)
+            staged = True
+            stage_codelist(connection, subset)
+            if summary is None:
+                stage_code_lookup(connection, end_date) # once for the whole codelist
+            # display each category as soon as its data has been extracted
+            subcodes = []
+            with track("extract, calculate and display"):
+                for cat, subcodes_cat, results_cat in stream_results(subset, cats, code_dict, end_date, threshold, connection, second_chart, workers, listsizes, summary):
+                    display_all(subset, [cat], subcodes_cat, second_chart, results=results_cat, tables=tables, label=label)
+                    subcodes.append(subcodes_cat)
+            pd.concat(subcodes, ignore_index=True).to_csv(subcodes_file, index=False)
+            displayed = True
+        else:
+            for sql, params in staging_sql(end_date, preview): # patient registrations and practice list size
+                connection.execute(sql, *params)
+            staged = True
+            stage_codelist(connection, subset)
+            if summary is None:
+                stage_code_lookup(connection, end_date) # once, for the estimate and every category
+
+            chunked = False
+            if memory_budget is not None:
+                with track("estimate"):
+                    sql, params = estimate_sql(subset, end_date, summary)
+                    estimate = pd.read_sql(sql, connection, params=params)
+                months = list(estimate["month"])
+                estimated = round(estimate_mb(estimate["events"].sum()), 1)
+                chunked = estimated>memory_budget
+                display(Markdown(f"Estimated peak memory: {estimated} MB (budget: {memory_budget} MB)" + ("; extracting one category at a time" if chunked else "")))
+
+            if chunked:
+                # extract and process each category in turn, keeping only deciles and classifications
+                results = {}
+                practices = set()
+                subcodes = []
+                for cat in cats:
+                    subset_cat = subset.loc[subset["concept_desc"]==cat]
+                    with track(f"extract and calculate: {cat}"):
+                        stage_codelist(connection, subset_cat) # the code lookup is restricted to each category's codelist
+                        sql, params = events_sql(subset_cat, end_date, summary)
+                        df0 = pd.read_sql(sql, connection, params=params) # events
+                        practices.update(df0["Practice_ID"].unique())
+                        subcodes_cat = top_subcodes(df0, subset_cat["first_digits"], code_dict, end_date, threshold)
+                        subcodes.append(subcodes_cat)
+                        results.update(compute_results(df0, subset_cat, subcodes_cat, second_chart, months, workers, listsizes))
+                        df0 = None
+                subcodes = pd.concat(subcodes, ignore_index=True)
+                # percent of practices across the whole extract, as in all_pracs
+                for result in results.values():
+                    if result is not None:
+                        result["practices_percent"] = round(100*result["practices"]/len(practices), 1)
+            else:
+                with track("extract"):
+                    sql, params = events_sql(subset, end_date, summary)
+                    df0 = pd.read_sql(sql, connection, params=params) # events
+                subcodes = top_subcodes(df0, subset["first_digits"], code_dict, end_date, threshold)
+                if workers is not None:
+                    with track("calculate"):
+                        results = compute_results(df0, subset, subcodes, second_chart, workers=workers, listsizes=listsizes)
+            subcodes.to_csv(subcodes_file, index=False)
+
+        if hierarchy is not None:
+            from hierarchy import organisation_sql, hierarchy_cube, display_hierarchy
+            if not staged:
+                # list sizes of all practices at end_date (not staged for a shared extract or sweep)
+                for sql, params in staging_sql(end_date):
+                    connection.execute(sql, *params)
+            orgs = pd.read_sql(organisation_sql(hierarchy), connection) # practice list sizes and areas
+            with track("calculate and display"):
+                display_hierarchy(subset, cats, df0, hierarchy_cube(df0, orgs, list(hierarchy)), label)
+            displayed = True
+
+        if not displayed:
+            with track("calculate and display"):
+                display_all(subset, cats, subcodes, second_chart, df0=df0, lookup=lookup, results=results, tables=tables, listsizes=listsizes, label=label)
+
+    if sweep is not None:
+        display(Markdown("## Comparison of end dates"))
+        display(sweep_table(subset, sweep_results))
+
+    if export_path is not None:
+        from export import write_results
+        write_results(tables, export_path, topic, end_date, codelist_type)
+
+    if memory_budget is not None:
+        display(Markdown("## Peak memory"))
+        display(memory_report(report, memory_budget))
+
+
+def display_all(subset, cats, subcodes, second_chart, df0=None, lookup=None, results=None, tables=None, listsizes=None, label=None):
+
+    '''
+    Display header text, tables and charts for each category and code
+
+    Inputs:
+    subset (dataframe): codelist to display
+    cats (series): categories to display, in order
+    subcodes (dataframe): top full length codes within each parent code
+    second_chart (bool): display the trend for the top code within each parent code
+    df0 (dataframe): events extract to calculate results from, or
+    lookup (function): precomputed deciles for each code (see compute_precomputed), or
+    results (dict): results already calculated for each code
+    tables (list): optional list to append each code's rows for export to (see export.result_tables)
+    listsizes (dataframe): optional monthly list sizes to use as denominators when calculating from df0 (see code_series)
+    label (str): optional label for each chart (e.g. for previews)
+    '''
+
+    for cat in cats:
+        subset_cat = subset.copy().loc[subset["concept_desc"]==cat]
+        total_events = round(subset_cat["2020 events (mill)"].sum(),2)
+        # fill any missing descriptions
+        subset_cat["Description"] = subset_cat["Description"].fillna("Unknown")
+        display(Markdown(f"# --- \n # Category: {cat}"))
+        display(Markdown(f"Total events: {total_events} m"))
+        display(Markdown(f"## Contents:"))
+        display(subset_cat[["first_digits", "Description", "2020 events (mill)", "2020 Patient count (mill)"]].drop_duplicates())
+
+        for code, digits, desc, e_mill, pts in zip(subset_cat.first_digits, subset_cat.digits, subset_cat.Description, subset_cat["2020 events (mill)"], subset_cat["patients"]):
+            if results is not None:
+                result = results.get(code)
+            elif lookup is not None:
+                result = compute_precomputed(lookup, code, digits, subcodes, second_chart)
+            else:
+                result = compute_code(df0, code, digits, subcodes, second_chart, listsizes=listsizes)
+
+            if result is not None:
+                display_code(code, desc, e_mill, pts, digits, result, subcodes, label)
+                if tables is not None:
+                    from export import result_tables
+                    tables.append(result_tables(code, desc, digits, result))
+
+
+def load_topics(filename="topics.json"):
+
+    '''
+    Load topic definitions (keywords, concepts and exclusion lists for each topic)
+
+    Inputs:
+    filename (str): file name for topics file in data folder
+
+    Output:
+    topics (dict): topic definitions keyed by topic name
+    '''
+
+    with open(os.path.join("..","data",filename)) as f:
+        topics = json.load(f)
+    return topics
+
+
+def topic_codelists(topic):
+
+    '''
+    Load and filter the high level and detailed codelists for a topic, as in each decile_charts notebook
+
+    Inputs:
+    topic (dict): topic definition (see data/topics.json)
+
+    Output:
+    lists (dict): "highlevel" and "detailed" codelists (cut down to the number of charts to plot) and whether to
+                  display the trend in the top child code for each
+    '''
+
+    highlevel, detailed = load_filter_codelists(topic["end_date"], keywords=topic["keywords"], concepts=topic["concepts"])
+
+    lists = {}
+    for level, codelist, codelist_type in [("highlevel", highlevel, "High level"), ("detailed", detailed, "Detailed")]:
+        spec = topic[level]
+        codelist = filter_codelists(codelist, concepts=spec["exclude_concepts"], keywords=spec["exclude_keywords"],
+                                    codelist_type=codelist_type, eventcount=True, in_or_out="out")
+        # replace all concepts with single topic
+        codelist["concept_desc"] = topic["concept_desc"]
+        lists[level] = (codelist.head(spec["charts"]), spec["second_chart"])
+    return lists
+
+
+def plotting_topics(topics, code_dict, threshold, dbconn, workers=None, export_path=None, summary=None):
+
+    '''
+    Extract data once for several topics and plot each topic's decile charts. Events for the union of all the topics'
+    codelists are extracted once (per end date), and codes shared between topics are only processed once. Practice
+    percentages are relative to all practices in the combined extract.
+
+    Inputs:
+    topics (dict): topic definitions (see load_topics)
+    code_dict (dataframe): lookup table for code descriptions
+    threshold (int): lower limit for activity number (global variable)
+    dbconn (str): SQL credentials
+    workers (int): optional number of processes to calculate each code's results in parallel
+    export_path (str): optional root folder of a Parquet dataset to write each topic's results to (see export.py)
+    summary (str): optional summary table to extract events from instead of CodedEvent (see summary_table.py). Every
+                   chart is labelled with it, as events are attributed to practices at the time of each event
+
+    Outputs:
+    Header text, charts and tables for each topic
+    '''
+
+    now = datetime.now()
+    for end_date in sorted(set(topic["end_date"] for topic in topics.values())):
+        names = [name for name, topic in topics.items() if topic["end_date"]==end_date]
+        lists = {name: topic_codelists(topics[name]) for name in names}
+        subsets = [subset for name in names for subset, _ in lists[name].values()]
+
+        # single extraction and calculation for all codes across topics
+        df0 = extract_events(subsets, end_date, dbconn, summary)
+        codes = pd.concat([subset[["first_digits", "digits"]] for subset in subsets]).drop_duplicates(subset="first_digits")
+        subcodes = top_subcodes(df0, codes["first_digits"], code_dict, end_date, threshold)
+        subcodes.to_csv(os.path.join("..","output",f"subcodes_topics_{end_date}_{now}.csv"), index=False)
+        results = compute_results(df0, codes, subcodes, second_chart=True, workers=workers)
+        label = None
+        if summary is not None:
+            from summary_table import summary_label
+            label = summary_label(summary)
+            display(Markdown(f"**{label}** (events attributed to practices at the time of each event, not at the end date)"))
+        df0 = None
+
+        # fan out to each topic
+        for name in names:
+            display(Markdown(f"# Topic: {topics[name]['title']}"))
+            for level, codelist_type in [("highlevel", "High level"), ("detailed", "Detailed")]:
+                subset, second_chart = lists[name][level]
+                if len(subset)==0:
+                    continue
+                display(Markdown(f"# {codelist_type} codes"))
+                if second_chart:
+                    subset_results = results
+                else:
+                    subset_results = {code: (dict(result, child=None) if result is not None else None) for code, result in results.items()}
+                tables = [] if export_path is not None else None
+                display_all(subset, categories(subset), subcodes, second_chart, results=subset_results, tables=tables, label=label)
+                if export_path is not None:
+                    from export import write_results
+                    write_results(tables, export_path, name, end_date, codelist_type)
+
+
+def filter_codelists(df, keywords=None, concepts=None, eventcount=False, in_or_out="out", codelist_type=None):
     
     '''
     Filter codelists to items of interest based on keywords and/or concepts
@@ -513,6 +2136,30 @@ def filter_codelists(df, keywords=None, concepts=None, eventcount=False, in_or_o
     out (df): filtered codelist
     '''    
     
+    if ENGINE=="polars":
+        from polars_engine import filter_codelists as polars_filter
+        filtered_list = polars_filter(df, keywords, concepts, in_or_out)
+    else:
+        filtered_list = filter_codelist_frame(df, keywords, concepts, in_or_out)
+
+    if codelist_type is None:
+        codelist_type = ""
+
+    display(Markdown(f"{codelist_type} codes: {len(filtered_list)}"))
+    
+    if eventcount == True:
+        total_events = filtered_list["2020 events (mill)"].sum().round(2)
+        display(Markdown(f"Event count: {total_events} million"))
+    
+    return filtered_list
+
+
+def filter_codelist_frame(df, keywords=None, concepts=None, in_or_out="out"):
+
+    '''
+    Filter a codelist by keywords and/or concepts (see filter_codelists), without displaying it
+    '''
+
     full_list = df.copy()
     
     # setup empty dataframe
@@ -547,18 +2194,7 @@ def filter_codelists(df, keywords=None, concepts=None, eventcount=False, in_or_o
                 filtered_list = full_list.loc[~full_list["concept_desc"].isin(concepts_out)]
                 
 
-    filtered_list = filtered_list.drop_duplicates().sort_values(by="2020 events (mill)", ascending=False)
-    
-    if codelist_type is None:
-        codelist_type = ""
-
-    display(Markdown(f"{codelist_type} codes: {len(filtered_list)}"))
-    
-    if eventcount == True:
-        total_events = filtered_list["2020 events (mill)"].sum().round(2)
-        display(Markdown(f"Event count: {total_events} million"))
-    
-    return filtered_list
+    return filtered_list.drop_duplicates().sort_values(by="2020 events (mill)", ascending=False)
 
 
 def load_filter_codelists(end_date, keywords=None, concepts=None, in_or_out="in"):
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Decile charts across areas of the organisational hierarchy (practice -> STP -> region)
+
+Practices are mapped to their STP and region once (from the Organisation table), and the practice-level events
+extract is summed up to each level: numerators are summed per code, month and area, and each area's denominator is
+the total list size of all its practices with registered patients (from #listsize), not only those in the extract. Each level of the cube has the same columns as the extract
+(with the area in "Practice_ID"), so its series, deciles and classifications are calculated exactly as for practices
+(see compute_code), without querying events again.
+
+Used by plotting_all(..., hierarchy=["stp", "region"]), which displays each code's charts for every level side by side.
+"""
+
+import pandas as pd
+
+from functions import display, Markdown, compute_code
+
+
+# column of the Organisation table for each level, and its name in charts (it has no CCG column, see hierarchy_cube)
+LEVELS = {"stp": ("STPCode", "STPs"), "region": ("Region", "Regions")}
+UNKNOWN = "Unknown"
+
+
+def organisation_sql(levels):
+
+    '''
+    Query for the list size of every practice and its area at each level
+
+    Inputs:
+    levels (list): levels of the hierarchy (keys of LEVELS)
+
+    Output:
+    sql (str): query returning "Practice_ID", "list_size" and a column for each level (requires #listsize from
+               staging_sql)
+    '''
+
+    columns = ",\n    ".join(f"o.{LEVELS[level][0]} AS {level}" for level in levels)
+    sql = f'''select
+    l.Practice_ID,
+    l.list_size,
+    {columns}
+    FROM #listsize l
+    LEFT JOIN Organisation o ON l.Practice_ID = o.Organisation_ID'''
+    return sql
+
+
+def hierarchy_cube(df0, orgs, levels):
+
+    '''
+    Sum a practice-level events extract up each level of the hierarchy. There is no CCG level between practices and
+    STPs, as the Organisation table in this schema has no CCG column (only STPCode and Region)
+
+    Inputs:
+    df0 (dataframe): events extract ("first_digits", "month", "Practice_ID", "numerator" and "denominator")
+    orgs (dataframe): output of organisation_sql
+    levels (list): levels of the hierarchy (keys of LEVELS)
+
+    Output:
+    cube (dict): extract for each level, with the area code in "Practice_ID" and the total list size of all its
+                 practices as "denominator" (practices without an area are grouped as "Unknown")
+    '''
+
+    # every practice with registered patients, and any in the extract which were not (with their extract list size)
+    practices = df0[["Practice_ID", "denominator"]].drop_duplicates("Practice_ID").rename(columns={"denominator": "list_size"})
+    practices = pd.concat([orgs[["Practice_ID", "list_size"] + levels],
+                           practices.loc[~practices["Practice_ID"].isin(orgs["Practice_ID"])]], ignore_index=True)
+    practices[levels] = practices[levels].fillna(UNKNOWN).astype(str)
+
+    # the mapping is joined once; each level is then one group-by of the extract
+    mapped = df0[["first_digits", "month", "Practice_ID", "numerator"]].merge(practices[["Practice_ID"] + levels], on="Practice_ID")
+    cube = {}
+    for level in levels:
+        denominators = practices.groupby(level)["list_size"].sum()
+        df = mapped.groupby(["first_digits", "month", level])["numerator"].sum().reset_index()
+        df["denominator"] = df[level].map(denominators)
+        cube[level] = df.rename(columns={level: "Practice_ID"})
+    return cube
+
+
+def hierarchy_table(results):
+
+    '''
+    Table of medians and classifications for each level of a code
+    '''
+
+    rows = []
+    for name, result in results.items():
+        s = result["stats"]
+        rows.append({"Level": name,
+                     "Units": result["units"],
+                     "Feb median": s["feb_median"],
+                     "April median": s["apr_median"],
+                     f"{s['endmonthname']} median": s["endmonth_median"],
+                     "April change (%)": s["peak"],
+                     f"{s['endmonthname']} change (%)": s["recovery"],
+                     "Classification": s["overall_position"]})
+    return pd.DataFrame(rows)
+
+
+def display_hierarchy(subset, cats, df0, cube, label=None):
+
+    '''
+    Display a table of classifications and decile charts across practices and across the areas of each level side by
+    side, for each category and code
+
+    Inputs:
+    subset (dataframe): codelist to display
+    cats (series): categories to display, in order
+    df0 (dataframe): practice-level events extract
+    cube (dict): output of hierarchy_cube
+    label (str): optional label for each chart (e.g. for previews)
+    '''
+
+    from render import render_panels
+
+    extracts = {"Practices": df0}
+    extracts.update({LEVELS[level][1]: extract for level, extract in cube.items()})
+    for cat in cats:
+        subset_cat = subset.loc[subset["concept_desc"]==cat]
+        display(Markdown(f"# --- \n # Category: {cat}"))
+        display(Markdown(f"Total events: {round(subset_cat['2020 events (mill)'].sum(), 2)} m"))
+
+        for code, digits, desc in zip(subset_cat["first_digits"], subset_cat["digits"], subset_cat["Description"].fillna("Unknown")):
+            desc = desc.replace("'","") # replace apostrophes
+            results = {}
+            for name, extract in extracts.items():
+                result = compute_code(extract, code, digits, None)
+                if result is not None and result["total_events"]>10:
+                    result["units"] = result["out"]["Practice_ID"].nunique()
+                    results[name] = result
+            display(Markdown(f"## \"{code}\" - {desc}"))
+            if not results:
+                display(Markdown(f"### {desc}: _Too few events to plot_"))
+                continue
+            display(hierarchy_table(results))
+            titles = [name if label is None else f"{name} ({label})" for name in results]
+            render_panels([(r["deciles"], t) for r, t in zip(results.values(), titles)], len(results))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Memory tracking for plotting_all's memory budget mode
+
+Peak memory is recorded per stage both for python allocations (tracemalloc, which includes
+numpy/pandas arrays) and for the whole process (resident set size, sampled in a background thread).
+"""
+
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+# rough size of one row of the events extract in a dataframe (code and month are python objects),
+# and how many copies of it coexist while a code is filtered, grouped and expanded in all_pracs
+BYTES_PER_ROW = 200
+COPIES = 3
+
+
+def current_rss():
+
+    '''
+    Current resident set size of this process in bytes (None where /proc is not available, e.g. Windows)
+    '''
+
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def estimate_mb(rows):
+
+    '''
+    Estimate peak memory (MB) needed to process an events extract with a given number of rows
+    '''
+
+    return rows*BYTES_PER_ROW*COPIES/1e6
+
+
+@contextmanager
+def track_memory(stage, report, interval=0.1):
+
+    '''
+    Record peak memory during a stage
+
+    Inputs:
+    stage (str): name of stage
+    report (list): list to append results to (see memory_report)
+    interval (float): seconds between RSS samples
+    '''
+
+    started = tracemalloc.is_tracing()
+    if not started:
+        tracemalloc.start()
+    if hasattr(tracemalloc, "reset_peak"): # python 3.9+, otherwise peak is since tracing started
+        tracemalloc.reset_peak()
+
+    peak_rss = [current_rss()]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            rss = current_rss()
+            if rss is not None and rss>peak_rss[0]:
+                peak_rss[0] = rss
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        rss = current_rss()
+        if rss is not None and rss>peak_rss[0]:
+            peak_rss[0] = rss
+        _, peak_python = tracemalloc.get_traced_memory()
+        if not started:
+            tracemalloc.stop()
+        report.append({"stage": stage,
+                       "seconds": round(time.time()-t0, 1),
+                       "peak python (MB)": round(peak_python/1e6, 1),
+                       "peak RSS (MB)": round(peak_rss[0]/1e6, 1) if peak_rss[0] is not None else None})
+
+
+def memory_report(report, budget):
+
+    '''
+    Summarise actual versus budgeted peak memory. The budget is compared with python allocations
+    (RSS also includes the interpreter, libraries and anything else held by the notebook)
+
+    Inputs:
+    report (list): stages recorded by track_memory
+    budget (float): memory budget (MB)
+
+    Output:
+    report (dataframe)
+    '''
+
+    df = pd.DataFrame(report)
+    df["budget (MB)"] = budget
+    df["within budget"] = df["peak python (MB)"]<=budget
+    return df
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel per-code processing for plotting_all
+
+The events extract (df0) is placed once in shared memory as numpy columns (codes and months are
+factorised to integers). Worker processes attach to it without copying, select the rows for each
+code and return only the deciles and classifications, which are displayed in order by the main process.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+INT_COLUMNS = ["Practice_ID", "numerator", "denominator"]
+
+# shared extract, set in each worker process by attach_frame
+_shared = {}
+
+
+def share_frame(df0):
+
+    '''
+    Copy an events extract into shared memory
+
+    Inputs:
+    df0 (dataframe): events extract ("first_digits", "month", "Practice_ID", "numerator", "denominator")
+
+    Outputs:
+    spec (dict): names, dtypes and lengths of shared memory blocks, plus code and month lookups
+    blocks (list): shared memory blocks (to be closed and unlinked by the caller)
+    '''
+
+    codes, code_values = pd.factorize(df0["first_digits"])
+    months, month_values = pd.factorize(df0["month"])
+    columns = {"first_digits": codes.astype("int32"), "month": months.astype("int32")}
+    for col in INT_COLUMNS + [c for c in ["digits"] if c in df0.columns]: # digits if rolled up (see rollup.py)
+        columns[col] = df0[col].values.astype("int64")
+
+    spec = {"length": len(df0), "columns": {}, "codes": list(code_values), "months": list(month_values),
+            "practices_total": df0["Practice_ID"].nunique()}
+    blocks = []
+    for col, values in columns.items():
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        spec["columns"][col] = (block.name, values.dtype.str)
+        blocks.append(block)
+    return spec, blocks
+
+
+def attach_frame(spec):
+
+    '''
+    Worker initializer: attach to the shared extract (zero-copy numpy views)
+    '''
+
+    _shared.clear()
+    _shared["spec"] = spec
+    _shared["blocks"] = []
+    for col, (name, dtype) in spec["columns"].items():
+        block = shared_memory.SharedMemory(name=name)
+        if spec["unregister"]:
+            # the main process owns (and unlinks) the blocks, so stop this process's own
+            # resource tracker from unlinking them when the worker exits (not needed when forked,
+            # as the tracker is then shared with the main process)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, "shared_memory")
+        _shared["blocks"].append(block)
+        _shared[col] = np.ndarray((spec["length"],), dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def code_rows(code):
+
+    '''
+    Rebuild the rows of the shared extract for all full codes beginning with a given code
+    '''
+
+    spec = _shared["spec"]
+    # match the (few) distinct codes rather than every row
+    matches = [i for i, c in enumerate(spec["codes"]) if c[:len(code)]==code]
+    rows = np.isin(_shared["first_digits"], matches)
+
+    df = pd.DataFrame({"first_digits": np.array(spec["codes"], dtype=object)[_shared["first_digits"][rows]],
+                       "month": np.array(spec["months"], dtype=object)[_shared["month"][rows]]})
+    for col in spec["columns"]:
+        if col not in df.columns:
+            df[col] = _shared[col][rows]
+    return df
+
+
+def compute_worker(args):
+
+    '''
+    Worker: calculate compact results for a single code from the shared extract
+    '''
+
+    from functions import compute_code, compact_result
+
+    code, digits, subcodes, second_chart, months, listsizes = args
+    spec = _shared["spec"]
+    if months is None:
+        months = spec["months"]
+
+    result = compact_result(compute_code(code_rows(code), code, digits, subcodes, second_chart, months, listsizes))
+    if result is not None:
+        # percent of all practices in the (whole) extract, as in all_pracs
+        result["practices_percent"] = round(100*result["practices"]/spec["practices_total"], 1)
+    return code, result
+
+
+def compute_parallel(df0, subset, subcodes, second_chart=False, months=None, workers=None, listsizes=None):
+
+    '''
+    Calculate results for every code in a codelist using a pool of worker processes sharing df0
+
+    Inputs:
+    df0 (dataframe): events extract
+    subset (dataframe): codelist containing "first_digits" and "digits" columns
+    subcodes (dataframe): top full length codes within each parent code
+    second_chart (bool): also calculate the trend for the top code within each parent code
+    months (list): optional months to include (see all_pracs)
+    workers (int): number of processes (defaults to the number of cpus)
+    listsizes (dataframe): optional monthly list sizes to use as denominators (see functions.code_series)
+
+    Output:
+    results (dict): compact results keyed by code
+    '''
+
+    context = multiprocessing.get_context()
+    spec, blocks = share_frame(df0)
+    spec["unregister"] = context.get_start_method()!="fork"
+    try:
+        tasks = [(code, digits, subcodes, second_chart, months, listsizes) for code, digits in zip(subset["first_digits"], subset["digits"])]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=attach_frame, initargs=(spec,)) as pool:
+            results = dict(pool.map(compute_worker, tasks))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return results
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Polars versions of the dataframe transforms in functions.py
+
+process_df, join_concept_descriptions, filter_codelists and the per-code extract (code_series and all_pracs) are
+chains of pandas filters, merges and renames, each making an intermediate copy. Here each is one Polars LazyFrame
+query, so the filters and joins are optimised together and run across all cores, and only the result is
+materialised (and converted back to pandas for the rest of the analysis).
+
+They return the same results as the pandas functions (see tests/test_polars_engine.py) and are used instead of them
+when the DATAFRAME_ENGINE environment variable (or functions.ENGINE) is "polars" (Polars is in requirements.txt).
+"""
+
+import pandas as pd
+import polars as pl
+
+
+# df0 most recently converted by code_series, so each full extract is only converted once
+_extract = {}
+
+
+def to_polars(df):
+
+    '''
+    Convert a pandas dataframe to a Polars LazyFrame
+    '''
+
+    return pl.from_pandas(df).lazy()
+
+
+def to_pandas(frame):
+
+    '''
+    Convert a Polars dataframe back to pandas, keeping dates (e.g. months read by read_sql) as date objects
+    '''
+
+    df = frame.to_pandas()
+    for col, dtype in frame.schema.items():
+        if dtype==pl.Date:
+            df[col] = frame[col].to_list()
+    return df
+
+
+def process_df(df, codes):
+
+    '''
+    Polars version of functions.process_df
+    '''
+
+    codes = to_polars(codes[["first_digits", "Description"]]).with_row_index("_r1")
+    codes_l1 = codes.select(pl.col("first_digits").alias("first_digit"),
+                            pl.col("first_digits").alias("first_digits_L1"),
+                            pl.col("Description").alias("Description_L1"),
+                            pl.col("_r1").alias("_r2"))
+
+    frame = (to_polars(df).with_row_index("_row")
+             .with_columns((pl.col("events")/1000000).round(2).alias("2020 events (mill)"),
+                           (pl.col("patients")/1000000).round(2).alias("2020 Patient count (mill)"),
+                           pl.col("first_digits").str.slice(0, 1).alias("first_digit"))
+             .with_columns(pl.col("first_digits").str.replace_all(".", "", literal=True))
+             .with_columns(pl.col("first_digits").str.len_chars().alias("digits"))
+             .join(codes, on="first_digits", how="left")
+             .join(codes_l1, on="first_digit", how="left")
+             # merges keep the order of the left rows (then of matching right rows)
+             .sort(["_row", "_r1", "_r2"])
+             .drop(["_row", "_r1", "_r2"]))
+    return to_pandas(frame.collect())
+
+
+def join_concept_descriptions(df, concepts, concepts2, concepts3):
+
+    '''
+    Polars version of functions.join_concept_descriptions
+    '''
+
+    frame = (to_polars(df).with_row_index("_row")
+             .with_columns(pl.col("first_digits").str.replace_all(".", "", literal=True)))
+
+    # join level 1, 2 and 3 concepts
+    for level, table in [(1, concepts), (2, concepts2), (3, concepts3)]:
+        table = (to_polars(table[["descendant_clean", "concept_desc"]].drop_duplicates())
+                 .with_row_index(f"_r{level}")
+                 .rename({"descendant_clean": "first_digits", "concept_desc": f"concept_desc_L{level}"}))
+        frame = frame.join(table, on="first_digits", how="left")
+
+    l1 = pl.col("concept_desc_L1")
+    concept = (pl.when(pl.col("first_digit").is_in(["Y", "9"])).then(pl.lit("Administration"))
+               .otherwise(l1.fill_null("Other")))
+    concept = pl.when(l1=="Clinical findings").then(pl.col("Description_L1")).otherwise(concept)
+    labs = pl.col("concept_desc_L3").is_in(["Laboratory test", "Laboratory test observations"]).fill_null(False)
+    concept = pl.when(labs | (pl.col("first_digit")=="4")).then(pl.lit("Laboratory procedures")).otherwise(concept)
+
+    frame = (frame.with_columns(concept.alias("concept_desc"))
+             .sort(["_row", "_r1", "_r2", "_r3"])
+             .drop(["_row", "_r1", "_r2", "_r3",
+                    "first_digits_L1", "Description_L1", "concept_desc_L1", "concept_desc_L2", "concept_desc_L3"]))
+    return to_pandas(frame.collect())
+
+
+def filter_codelists(df, keywords=None, concepts=None, in_or_out="out"):
+
+    '''
+    Polars version of the filtering in functions.filter_codelists (which displays the result): the keyword and
+    concept filters are combined into a single condition
+
+    Output:
+    filtered_list (dataframe): filtered codelist, keeping the index of df
+    '''
+
+    columns = list(df.columns)
+    frame = to_polars(df.rename_axis("_index").reset_index())
+    descriptions = pl.col("Description").fill_null("")
+
+    keep = None
+    if keywords:
+        if in_or_out=="in":
+            keep = pl.any_horizontal([descriptions.str.contains(f"(?i){k}") for k in keywords])
+        else:
+            keep = ~pl.any_horizontal([descriptions.str.to_lowercase().str.contains(k.lower(), literal=True) for k in keywords])
+
+    # as in the pandas version, if the keyword filter leaves no codes then it is ignored
+    if concepts:
+        in_concepts = pl.col("concept_desc").is_in(concepts).fill_null(False)
+        if in_or_out=="in":
+            keep = in_concepts if keep is None else keep | in_concepts
+        else:
+            keep = ~in_concepts if keep is None else pl.when(keep.any()).then(keep & ~in_concepts).otherwise(~in_concepts)
+    elif keep is not None:
+        keep = pl.when(keep.any()).then(keep).otherwise(pl.lit(True))
+
+    if keep is not None:
+        frame = frame.filter(keep)
+    frame = (frame.unique(subset=columns, keep="first", maintain_order=True)
+             .sort("2020 events (mill)", descending=True, nulls_last=True, maintain_order=True))
+    filtered_list = to_pandas(frame.collect()).set_index("_index")
+    filtered_list.index.name = df.index.name
+    return filtered_list
+
+
+def extract_frame(df0):
+
+    '''
+    Full extract as a LazyFrame (converted once for each df0), with its months and number of practices
+    '''
+
+    if _extract.get("df0") is not df0:
+        frame = pl.from_pandas(df0)
+        _extract.update({"df0": df0,
+                         "frame": frame.lazy(),
+                         "months": frame.select(pl.col("month").unique(maintain_order=True)),
+                         "practices": frame["Practice_ID"].n_unique()})
+    return _extract
+
+
+def practice_months(extract, df, code, months=None):
+
+    '''
+    Lazy equivalent of all_pracs: every practice using the code (df), every month, filled with zeros
+    '''
+
+    if months is None:
+        cross = extract["months"].lazy()
+    else:
+        cross = to_polars(pd.DataFrame({"month": months})) # converted as the extract's months are
+    cross = cross.with_columns(pl.lit(code).alias("first_digits")).with_row_index("_month")
+    practices = df.select(["Practice_ID", "denominator"]).unique(maintain_order=True).with_row_index("_practice")
+    keys = ["first_digits", "month", "Practice_ID", "denominator"]
+    out = (cross.join(practices, how="cross")
+           .join(df, on=keys, how="left")
+           .sort(["_month", "_practice"]).drop(["_month", "_practice"]))
+    return out.with_columns(pl.exclude(keys).fill_null(0))
+
+
+def practice_counts(out, extract):
+
+    '''
+    Number of practices (thousands) and percent of all practices in a practice-level series
+    '''
+
+    practice_count = out["Practice_ID"].nunique()
+    return round(practice_count/1000, 1), round(100*practice_count/extract["practices"], 1)
+
+
+def all_pracs(df0, df, code, months=None):
+
+    '''
+    Polars version of functions.all_pracs
+    '''
+
+    extract = extract_frame(df0)
+    out = to_pandas(practice_months(extract, to_polars(df), code, months).collect())
+    return (out,) + practice_counts(out, extract)
+
+
+def code_series(df0, code, months=None):
+
+    '''
+    Polars version of the per-code extract in functions.code_series: the prefix filter, grouping and expansion to
+    all practices and months (all_pracs) as one query on the full extract
+
+    Outputs:
+    out (dataframe): time series data at practice level (without "value"), or None if code not used
+    practice_count_thou (float): number of practices included
+    practices_percent (float): percent of all practices included
+    '''
+
+    extract = extract_frame(df0)
+    frame = extract["frame"]
+    keys = ["month", "first_digits", "Practice_ID", "denominator"]
+    if "digits" in df0.columns: # already rolled up
+        df = frame.filter((pl.col("digits")==len(code)) & (pl.col("first_digits")==code)).drop("digits")
+    else:
+        df = (frame.filter(pl.col("first_digits").str.slice(0, len(code))==code)
+              .with_columns(pl.col("first_digits").str.slice(0, len(code)))
+              .group_by(keys).agg(pl.exclude(keys).sum())
+              .sort(keys)) # as grouped by pandas
+
+    out = to_pandas(practice_months(extract, df, code, months).collect())
+    if len(out)==0:
+        return None, 0, 0
+    return (out,) + practice_counts(out, extract)
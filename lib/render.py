@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Fast decile chart renderer
+
+Draws decile charts in the style of ebmdatalab's deciles_chart (dashed deciles, solid median, legend),
+but from percentiles which have already been calculated and reusing a single figure for every chart:
+the eight decile lines are one LineCollection and the median is one line, which are updated in place
+for each chart rather than building a new figure, axes and nine separate lines each time.
+
+Everything except the lines and the y axis (month labels, grid, legend) is only drawn when the months
+change, and kept as a background image which each chart is drawn on top of. The figure is not managed
+by pyplot, so it is rendered to a PNG explicitly and not closed after each cell.
+
+render_panels draws several charts (e.g. for subgroups) on the same y axis scale and shows them side by side.
+"""
+
+from io import BytesIO
+
+import matplotlib.dates as mdates
+import matplotlib.image as mimage
+import numpy as np
+from IPython.display import display, Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+
+# size of a deciles_chart figure once its legend and rotated month labels are included (as saved
+# with bbox_inches="tight"), so nothing needs to be measured for each chart
+FIGSIZE = (7.5, 5.2)
+DPI = 100
+
+# figure, axes and artists reused for every chart
+_template = {}
+
+
+def chart_template():
+
+    '''
+    Create (once) the figure, axes, decile lines, median line and legend reused by render_deciles
+    '''
+
+    if _template:
+        return _template
+
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+
+    # seaborn "whitegrid" style, as set by deciles_chart
+    ax.set_facecolor("white")
+    ax.grid(True, color="0.9")
+    ax.set_axisbelow(True)
+    for spine in ax.spines.values():
+        spine.set_color("0.8")
+
+    deciles = LineCollection([], colors="b", linestyles="--", linewidths=1, label="decile")
+    ax.add_collection(deciles)
+    median, = ax.plot([], [], "b-", linewidth=1.5, label="median")
+
+    ax.set_ylabel("rate per 1000", size=15, alpha=0.6)
+    ax.tick_params(labelsize=12)
+    ax.tick_params(axis="x", labelrotation=90)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%B %Y"))
+    ax.xaxis.set_major_locator(mdates.MonthLocator())
+    ax.legend(handles=[deciles, median], bbox_to_anchor=(1.1, 0.8), loc="center left", ncol=1, fontsize=12, borderaxespad=0.0)
+    fig.subplots_adjust(left=0.09, right=0.75, bottom=0.32, top=0.97)
+
+    _template.update({"fig": fig, "ax": ax, "deciles": deciles, "median": median,
+                      "months": None, "background": None})
+    return _template
+
+
+def draw_background(t, x, title):
+
+    '''
+    Draw the parts of the chart which only depend on the months (and title), and keep them as the background
+    '''
+
+    ax = t["ax"]
+    ax.set_title(title if title is not None else "", size=15)
+    t["fig"].subplots_adjust(top=0.97 if title is None else 0.92) # room for the title
+    if len(x)>1:
+        ax.set_xlim([x[0], x[-1]])
+    changing = [ax.yaxis, t["deciles"], t["median"]]
+    for artist in changing:
+        artist.set_visible(False)
+    t["fig"].canvas.draw()
+    t["background"] = t["fig"].canvas.copy_from_bbox(t["fig"].bbox)
+    for artist in changing:
+        artist.set_visible(True)
+    t["months"] = (tuple(x), title)
+
+
+def decile_arrays(deciles):
+
+    '''
+    Convert long format deciles into arrays
+
+    Inputs:
+    deciles (dataframe): "month", "percentile" (10, 20 ... 90) and "value" columns
+
+    Outputs:
+    x (array): months as matplotlib date numbers
+    values (array): one row per percentile (10 to 90), one column per month
+    '''
+
+    wide = deciles.pivot(index="month", columns="percentile", values="value").sort_index()
+    x = mdates.date2num(list(wide.index))
+    values = wide[list(range(10, 100, 10))].values.T
+    return x, values
+
+
+def draw_deciles(deciles, title=None, ymax=None):
+
+    '''
+    Draw a decile chart on the reused figure
+
+    Inputs:
+    deciles (dataframe): "month", "percentile" (10, 20 ... 90) and "value" columns
+    title (str): optional title
+    ymax (float): optional top of the y axis (e.g. the same for charts shown together), otherwise the highest value
+
+    Output:
+    image (array): the chart (RGBA), copied from the figure
+    '''
+
+    t = chart_template()
+    ax = t["ax"]
+    x, values = decile_arrays(deciles)
+
+    others = np.delete(values, 4, axis=0) # every decile except the median
+    t["deciles"].set_segments([np.column_stack([x, v]) for v in others])
+    t["median"].set_data(x, values[4])
+
+    if ymax is None:
+        ymax = np.nanmax(values) if values.size else 0
+    ax.set_ylim([0, ymax*1.05 if ymax>0 else 1])
+
+    if t["months"]!=(tuple(x), title):
+        draw_background(t, x, title)
+    canvas = t["fig"].canvas
+    canvas.restore_region(t["background"])
+    ax.draw_artist(ax.yaxis)
+    ax.draw_artist(t["deciles"])
+    ax.draw_artist(t["median"])
+    return np.array(canvas.buffer_rgba())
+
+
+def show_image(image, path=None):
+
+    '''
+    Display an image (RGBA array) as a PNG, or save it
+    '''
+
+    if path is not None:
+        mimage.imsave(path, image, format="png")
+    else:
+        buffer = BytesIO()
+        mimage.imsave(buffer, image, format="png")
+        display(Image(data=buffer.getvalue(), format="png"))
+
+
+def render_deciles(deciles, path=None, title=None):
+
+    '''
+    Draw a decile chart on the reused figure and display it (or save it)
+
+    Inputs:
+    deciles (dataframe): "month", "percentile" (10, 20 ... 90) and "value" columns
+    path (str): optional file to save the chart (png) to instead of displaying it
+    title (str): optional title (e.g. to label previews)
+    '''
+
+    show_image(draw_deciles(deciles, title), path)
+
+
+def render_panels(panels, columns=3, path=None):
+
+    '''
+    Draw decile charts side by side on the same y axis scale, and display them (or save them) as one image
+
+    Inputs:
+    panels (list): (deciles, title) for each chart
+    columns (int): charts per row
+    path (str): optional file to save the charts (png) to instead of displaying them
+    '''
+
+    ymax = max(deciles["value"].max() for deciles, _ in panels)
+    images = [draw_deciles(deciles, title, ymax) for deciles, title in panels]
+    columns = min(columns, len(images))
+    blank = np.full_like(images[0], 255)
+    rows = []
+    for i in range(0, len(images), columns):
+        row = images[i:i+columns]
+        rows.append(np.hstack(row + [blank]*(columns-len(row))))
+    show_image(np.vstack(rows), path)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Hierarchical rollup of CTV3 codes by prefix
+
+CTV3 codes are hierarchical by prefix (22 > 22K > 22K1 ...), so counts for any level of the hierarchy can be
+derived from one aggregate of full codes rather than a separate scan for each level. Full codes are sorted
+once, which makes every prefix of a given length a contiguous run of rows, and each level is then a single
+segmented reduction (np.add.reduceat for event counts; HyperLogLog registers, see hll.py, are kept sparse and each
+prefix's are merged by a group-by maximum):
+
+    stage_code_lookup(connection, end_date, codelist=False)     # every code (after staging_sql)
+    sql, params = cube_sql(end_date)                            # full code x month, all events
+    cube = pd.read_sql(sql, connection, params=params)
+    sql, params = sketch_sql(end_date)                          # patient registers per full code (only those set)
+    registers = sketch_registers(pd.read_sql(sql, connection, params=params))
+    level2 = discovery_table(cube, registers, "level2", threshold)
+    level3 = discovery_table(cube, registers, "level3", threshold)
+
+As in discovery_sql, codes shorter than a level (e.g. "22" in level3, "22." in the query) are a group of their own.
+
+rollup_cube turns a full-code extract (e.g. from events_sql or extract_events) into one with a row for every prefix,
+which code_series can read directly instead of grouping the full codes for each code charted.
+"""
+
+import numpy as np
+import pandas as pd
+
+from functions import sql_date
+from hll import sparse_estimate
+
+
+LENGTHS = [1, 2, 3, 4, 5]
+# register bits of the patient sketches: 4096 registers per code, about 1.6% standard error (enough to rank codes,
+# exact counts are fetched for the codes published, see exact_patients)
+SKETCH_P = 12
+
+
+def cube_sql(end_date):
+
+    '''
+    Query counting all events in 2020 per full code and month (not restricted to registered patients, as in
+    discovery_sql), to roll up to every level with discovery_table
+
+    Inputs:
+    end_date (str): end date of study period
+
+    Outputs:
+    sql (str): sql query (requires #calendar from staging_sql and #codes from stage_code_lookup) returning
+               "first_digits" (full codes, dots removed), "month" and "numerator"
+    params (list): query parameters
+    '''
+
+    sql = '''select
+        k.first_digits,
+        c.period_start AS month,
+        COUNT(e.Patient_ID) as numerator
+        FROM CodedEvent e
+        INNER JOIN #codes k ON e.CTV3Code = k.CTV3Code
+        INNER JOIN #calendar c ON e.ConsultationDate >= c.period_start AND e.ConsultationDate < c.next_start
+        WHERE
+        e.ConsultationDate >= '20200101'
+        AND e.ConsultationDate <= ?
+        GROUP BY k.first_digits, c.period_start'''
+    return sql, [sql_date(end_date)]
+
+
+def sketch_sql(end_date, p=SKETCH_P):
+
+    '''
+    Query building HyperLogLog registers of the patients with each full code in 2020, so that distinct patients can be
+    counted for any prefix without another scan (registers of child codes are merged by taking their maximum)
+
+    Inputs:
+    end_date (str): end date of study period
+    p (int): register bits (2^p registers per code, up to 16)
+
+    Outputs:
+    sql (str): sql query (requires #codes from stage_code_lookup) returning "first_digits" (full codes up to the
+               first dot, as in cube_sql), "register" and "rank" (only registers which are set)
+    params (list): query parameters
+    '''
+
+    sql = f'''-- HyperLogLog registers of patients per code: the first {p} bits of a hash of Patient_ID choose the
+    -- register, which keeps the position of the first 1 bit in the next 48 bits
+    SELECT first_digits, register, MAX(rank) AS rank
+    FROM (
+        SELECT
+        first_digits,
+        CAST(SUBSTRING(h,1,2) AS INT) / {2**(16-p)} AS register,
+        CASE WHEN w = 0 THEN 49 ELSE 48 - FLOOR(LOG(w, 2)) END AS rank
+        FROM (
+            SELECT
+            k.first_digits,
+            HASHBYTES('SHA2_256', CAST(e.Patient_ID AS VARCHAR(20))) AS h,
+            CAST(SUBSTRING(HASHBYTES('SHA2_256', CAST(e.Patient_ID AS VARCHAR(20))),3,6) AS BIGINT) AS w
+            FROM CodedEvent e
+            INNER JOIN #codes k ON e.CTV3Code = k.CTV3Code
+            WHERE
+            e.ConsultationDate >= '20200101'
+            AND e.ConsultationDate <= ?
+        ) e
+    ) s
+    GROUP BY first_digits, register'''
+    return sql, [sql_date(end_date)]
+
+
+def sketch_registers(rows):
+
+    '''
+    Sparse registers from the output of sketch_sql (only registers which are set, rather than 2^p per code)
+
+    Inputs:
+    rows (dataframe): "first_digits", "register" and "rank"
+
+    Output:
+    registers (dataframe): "first_digits" (str), "register" and "rank" (uint8), sorted by code and register
+    '''
+
+    registers = pd.DataFrame({"first_digits": rows["first_digits"].values.astype(str),
+                              "register": rows["register"].values.astype(np.int64),
+                              "rank": rows["rank"].values.astype(np.uint8)})
+    return registers.sort_values(["first_digits", "register"]).reset_index(drop=True)
+
+
+def prefix_patients(registers, lengths=LENGTHS, shorter=False, p=SKETCH_P):
+
+    '''
+    Approximate distinct patients for every full code and every prefix, merging the sparse registers of the codes
+    beginning with each prefix by their maximum
+
+    Inputs:
+    registers (dataframe): sparse registers (see sketch_registers)
+    lengths (list): prefix lengths to roll up to
+    shorter (bool): include codes shorter than each length as groups of their own (see prefix_segments)
+    p (int): register bits used by sketch_sql
+
+    Output:
+    patients (dataframe): "first_digits", "digits" (prefix length), "full" and "patients"
+    '''
+
+    codes, idx = np.unique(registers["first_digits"].values.astype(str), return_inverse=True)
+    frames = [pd.DataFrame({"first_digits": codes, "digits": np.char.str_len(codes), "full": True,
+                            "patients": sparse_estimate(idx, registers["rank"].values, p).values})]
+    for length in lengths:
+        keep, prefix, starts = prefix_segments(codes, length, shorter)
+        if len(prefix)==0:
+            continue
+        # position of each register's prefix (codes are sorted, so each prefix is a run of codes)
+        prefix_of = np.full(len(codes), -1)
+        prefix_of[keep] = np.searchsorted(starts, np.arange(keep.sum()), side="right") - 1
+        rows = prefix_of[idx]
+        merged = pd.DataFrame({"prefix": rows, "register": registers["register"].values, "rank": registers["rank"].values})
+        merged = merged.loc[rows>=0].groupby(["prefix", "register"])["rank"].max().reset_index()
+        estimates = sparse_estimate(merged["prefix"].values, merged["rank"].values, p)
+        frames.append(pd.DataFrame({"first_digits": prefix[estimates.index.values], "digits": length, "full": False,
+                                    "patients": estimates.values}))
+    patients = pd.concat(frames, ignore_index=True)
+    patients["patients"] = np.round(patients["patients"]).astype(int)
+    return patients
+
+
+def prefix_segments(codes, length, shorter=False):
+
+    '''
+    Find the runs of sorted codes sharing each prefix of a given length
+
+    Inputs:
+    codes (array): codes (dots removed) in sorted order
+    length (int): prefix length
+    shorter (bool): keep codes shorter than the prefix, each as a group of its own (as LEFT(CTV3Code, length) groups
+                    them in the discovery queries). Otherwise they do not belong to any prefix of this length
+
+    Outputs:
+    keep (array): mask of codes kept
+    prefixes (array): one prefix per run of kept codes
+    starts (array): position of the first kept code of each run
+    '''
+
+    codes = np.asarray(codes).astype(str)
+    keep = np.ones(len(codes), dtype=bool) if shorter else np.char.str_len(codes)>=length
+    prefix = np.array([c[:length] for c in codes[keep]], dtype=str)
+    first = np.ones(len(prefix), dtype=bool)
+    first[1:] = prefix[1:]!=prefix[:-1]
+    starts = np.flatnonzero(first)
+    return keep, prefix[starts], starts
+
+
+def rollup(codes, values, lengths=LENGTHS, reduce=np.add, shorter=False):
+
+    '''
+    Reduce values for full codes to every prefix
+
+    Inputs:
+    codes (array): full codes (dots removed) in sorted order
+    values (array): one value (or row, e.g. of registers) per code
+    lengths (list): prefix lengths to roll up to
+    reduce (ufunc): np.add for counts, np.maximum for HyperLogLog registers
+    shorter (bool): include codes shorter than each length as groups of their own (see prefix_segments)
+
+    Outputs:
+    prefixes (array): codes at every level
+    digits (array): prefix length of each
+    rolled (array): reduced values for each prefix
+    '''
+
+    values = np.asarray(values)
+    prefixes, digits, rolled = [], [], []
+    for length in lengths:
+        keep, prefix, starts = prefix_segments(codes, length, shorter)
+        if len(prefix)==0:
+            continue
+        prefixes.append(prefix)
+        digits.append(np.full(len(prefix), length))
+        rolled.append(reduce.reduceat(values[keep], starts, axis=0))
+    if not prefixes:
+        return np.array([], dtype=str), np.array([], dtype=int), values[:0]
+    return np.concatenate(prefixes), np.concatenate(digits), np.concatenate(rolled)
+
+
+def rollup_cube(cube, lengths=LENGTHS):
+
+    '''
+    Roll up an extract of full codes to every prefix, keeping the month and practice
+
+    Rows are sorted by month, practice and code once, so that each prefix within a month and practice is a
+    contiguous run for every level.
+
+    Inputs:
+    cube (dataframe): extract with "first_digits" (full codes), "month", "Practice_ID", "numerator" and "denominator"
+    lengths (list): prefix lengths to roll up to
+
+    Output:
+    rolled (dataframe): the same columns plus "digits", with "first_digits" the prefix, one row per prefix, month and
+                        practice where the prefix was used
+    '''
+
+    codes, code_idx = np.unique(cube["first_digits"].values.astype(str), return_inverse=True)
+    months, month_idx = np.unique(cube["month"].values, return_inverse=True)
+    practices, practice_idx = np.unique(cube["Practice_ID"].values, return_inverse=True)
+    order = np.lexsort((code_idx, practice_idx, month_idx))
+    code_idx, month_idx, practice_idx = code_idx[order], month_idx[order], practice_idx[order]
+    numerator = cube["numerator"].values[order]
+    denominator = cube["denominator"].values[order]
+    lens = np.char.str_len(codes)
+
+    frames = []
+    for length in lengths:
+        # prefix of each distinct code is its rank among the distinct prefixes (codes are sorted, so prefixes are too)
+        keep_codes, prefix, starts = prefix_segments(codes, length)
+        prefix_of = np.full(len(codes), -1)
+        prefix_of[keep_codes] = np.searchsorted(starts, np.arange(keep_codes.sum()), side="right") - 1
+        keep = lens[code_idx]>=length
+        p, m, pr = prefix_of[code_idx[keep]], month_idx[keep], practice_idx[keep]
+        if len(p)==0:
+            continue
+        first = np.ones(len(p), dtype=bool)
+        first[1:] = (p[1:]!=p[:-1]) | (m[1:]!=m[:-1]) | (pr[1:]!=pr[:-1])
+        runs = np.flatnonzero(first)
+        frames.append(pd.DataFrame({"first_digits": prefix[p[runs]],
+                                    "month": months[m[runs]],
+                                    "Practice_ID": practices[pr[runs]],
+                                    "numerator": np.add.reduceat(numerator[keep], runs),
+                                    "denominator": denominator[keep][runs],
+                                    "digits": length}))
+    rolled = pd.concat(frames, ignore_index=True)
+    rolled["first_digits"] = rolled["first_digits"].astype(object)
+    return rolled
+
+
+def rollup_counts(cube, registers=None, since="2020-01-01", lengths=LENGTHS, shorter=False):
+
+    '''
+    Total events (and approximate distinct patients) for every full code and every prefix
+
+    Inputs:
+    cube (dataframe): extract with "first_digits" (full codes), "month" and "numerator"
+    registers (dataframe): optional sparse patient registers of each full code (see sketch_registers)
+    since (str): first month to count
+    lengths (list): prefix lengths to roll up to
+    shorter (bool): include codes shorter than each length as groups of their own (see prefix_segments)
+
+    Output:
+    counts (dataframe): "first_digits", "digits" (prefix length), "full" (True for full codes, False for prefixes),
+                        "events" and "patients" (if registers are given)
+    '''
+
+    recent = cube.loc[pd.to_datetime(cube["month"])>=pd.Timestamp(since)]
+    events = recent.groupby("first_digits")["numerator"].sum()
+    events.index = events.index.astype(str)
+
+    full = events.sort_index()
+    prefixes, digits, rolled = rollup(full.index.values, full.values, lengths, shorter=shorter)
+    counts = pd.DataFrame({"first_digits": np.concatenate([full.index.values, prefixes]),
+                           "digits": np.concatenate([full.index.str.len().values, digits]),
+                           "full": np.r_[np.ones(len(full), dtype=bool), np.zeros(len(prefixes), dtype=bool)],
+                           "events": np.concatenate([full.values, rolled])})
+    if registers is None:
+        return counts
+
+    patients = prefix_patients(registers, lengths, shorter)
+    counts = counts.merge(patients, on=["first_digits", "digits", "full"], how="left")
+    counts["patients"] = counts["patients"].fillna(0).astype(int)
+    return counts
+
+
+def discovery_table(cube, registers, level, threshold):
+
+    '''
+    Local equivalent of discovery_sql, from rolled up counts rather than a scan for each level. Counts match the
+    query's when the cube counts all events (see cube_sql); an events_sql extract only counts registered patients.
+
+    Inputs:
+    cube (dataframe): extract of full codes (see cube_sql)
+    registers (dataframe): sparse patient registers of each full code (see sketch_registers), or None (no "patients"
+                           column)
+    level (str): "level2", "level3" or "uxy" (full codes beginning U, X or Y)
+    threshold (int): lower limit for activity numbers
+
+    Output:
+    df (dataframe): "first_digits" (dots removed), "events", "patients" and "level", as returned by discovery_sql
+                    (without latest_date, and with patients approximate)
+    '''
+
+    counts = rollup_counts(cube, registers, lengths=[2, 3], shorter=True)
+    if level=="level2":
+        df = counts.loc[~counts["full"] & (counts["digits"]==2)]
+    elif level=="level3":
+        df = counts.loc[~counts["full"] & (counts["digits"]==3)]
+    elif level=="uxy":
+        df = counts.loc[counts["full"]]
+    else:
+        raise ValueError(f"unknown level {level}")
+
+    # codes beginning with a dot are empty up to the first dot ("" rather than ".")
+    first = df["first_digits"].str[:1]
+    if level=="uxy":
+        df = df.loc[first.isin(["U", "X", "Y"])]
+    else:
+        df = df.loc[~first.isin(["", "0", "U", "X", "Y"]) & (df["first_digits"].str[:2]!="49")] # remove semen analysis
+    df = df.loc[df["events"]>threshold].drop(columns=["digits", "full"]).assign(level=level)
+    df = df.sort_values(by="first_digits" if level=="level2" else "events", ascending=(level=="level2"))
+    return df.head(500).reset_index(drop=True)
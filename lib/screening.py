@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Screening of changes across all CTV3 codes, to choose which codes to chart
+
+The topic notebooks only chart the codes with the most events in 2020, so codes with large relative
+drops but modest volume are never seen. Here a single grouped extraction returns, for every code above
+a minimum volume, each practice's event counts in the months used by classify_changes. Median
+practice-level rates (including zeros for practices which have used the code during the period, as in
+all_pracs) and the peak and recovery changes are then calculated for all codes at once. Codes are screened
+at each length in the codelist (all lengths in the same extraction), so that each code is ranked on all codes
+beginning with it (as it is charted), e.g.
+
+    screen = screen_codes(end_date, sorted(detailed_full["digits"].unique()), 1000, dbconn)
+    ranked = rank_codelist(detailed_full, screen)
+    plotting_all(ranked, code_dict, 50, threshold, end_date, dbconn)
+"""
+
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from functions import closing_connection, staging_sql, stage_code_lookup, sql_date, classify_position, classify_overall
+
+
+def key_months(end_date):
+
+    '''
+    Months compared by classify_changes
+
+    Inputs:
+    end_date (str): end date of study period
+
+    Output:
+    months (dict): first day of each month keyed by column name
+    '''
+
+    endmonth = datetime.strptime(end_date, "%Y%m%d").date().replace(day=1)
+    months = {"apr_2019": date(2019,4,1),
+              "endmonth_2019": endmonth + relativedelta(years=-1),
+              "feb_2020": date(2020,2,1),
+              "apr_2020": date(2020,4,1),
+              "endmonth": endmonth}
+    return months
+
+
+def screening_sql(end_date, digits, threshold):
+
+    '''
+    Query returning event counts per code and practice in each of the key months, for all codes with more than
+    a threshold number of events in 2020, at every number of digits in one scan of the events (each code in the
+    lookup is expanded to its prefix at each length, so events are read once and counted for each of their prefixes)
+
+    Inputs:
+    end_date (str): end date of study period
+    digits (list): numbers of digits to group codes by (1-5, of each code up to the first dot, as in events_sql).
+                   Codes shorter than a length are not counted at that length
+    threshold (int): lower limit for 2020 events per code
+
+    Outputs:
+    sql (str): sql query (requires #reg and #listsize from staging_sql, and #codes for every code from
+               stage_code_lookup) returning "first_digits", "digits", "Practice_ID", one column of events per key
+               month, "events" (2020 events) and "denominator"
+    params (list): query parameters
+    '''
+
+    # date ranges rather than functions of ConsultationDate, so an index on it can be used
+    counts = []
+    params = []
+    for name, month in key_months(end_date).items():
+        counts.append(f"SUM(CASE WHEN e.ConsultationDate >= ? AND e.ConsultationDate < ? THEN 1 ELSE 0 END) AS {name}")
+        params += [month, month + relativedelta(months=1)]
+    counts = ",\n            ".join(counts)
+
+    sql = f'''-- events per code and practice in key months (practices with any events during the period)
+    SELECT c.*, l.list_size AS denominator
+    FROM (
+        SELECT *, SUM(events) OVER (PARTITION BY first_digits, digits) AS code_events
+        FROM (
+            SELECT
+            p.first_digits,
+            p.digits,
+            r.Practice_ID,
+            {counts},
+            SUM(CASE WHEN e.ConsultationDate >= '20200101' THEN 1 ELSE 0 END) AS events
+            FROM CodedEvent e
+            -- prefix of each code at each length (lengths bound as one comma-separated parameter)
+            INNER JOIN (
+                SELECT k.CTV3Code, d.n AS digits, LEFT(k.first_digits, d.n) AS first_digits
+                FROM #codes k
+                CROSS APPLY (SELECT CAST(value AS INT) AS n FROM STRING_SPLIT(?, ',')) d
+                WHERE LEN(k.first_digits) >= d.n
+            ) p ON e.CTV3Code = p.CTV3Code
+            INNER JOIN #reg r ON e.Patient_ID = r.Patient_ID AND r.registration_date_rank = 1
+            WHERE
+            e.ConsultationDate >= '20190101'
+            AND e.ConsultationDate <= ?
+            GROUP BY p.first_digits, p.digits, r.Practice_ID
+        ) practice_counts
+    ) c
+    INNER JOIN #listsize l ON c.Practice_ID = l.Practice_ID
+    WHERE c.code_events > ?'''
+    lengths = ",".join(str(int(n)) for n in digits)
+    return sql, params + [lengths, sql_date(end_date), int(threshold)]
+
+
+def screen_changes(counts, end_date):
+
+    '''
+    Calculate median practice-level rates at the key months and classify changes for every code at once
+
+    Inputs:
+    counts (dataframe): output of screening_sql (one row per code, number of digits and practice)
+    end_date (str): end date of study period
+
+    Output:
+    screen (dataframe): one row per code and number of digits with practices, 2020 events, medians, percentage
+                        changes and classifications (as in classify_changes), sorted by peak change
+    '''
+
+    names = list(key_months(end_date))
+    keys = ["first_digits", "digits"]
+    rates = counts[keys].copy()
+    for name in names:
+        rates[name] = 1000*counts[name].values/counts["denominator"].values
+    medians = rates.groupby(keys)[names].median()
+
+    screen = counts.groupby(keys).agg(practices=("Practice_ID", "size"), events=("events", "sum"))
+    screen = screen.join(medians)
+
+    screen["peak"] = pct_changes(screen["apr_2020"].values, screen["apr_2019"].values)
+    screen["recovery"] = pct_changes(screen["endmonth"].values, screen["endmonth_2019"].values)
+    screen["april_position"] = classify_position(screen["peak"].values)
+    screen["endmonth_position"] = classify_position(screen["recovery"].values)
+    screen["overall_position"] = classify_overall(screen["peak"].values, screen["recovery"].values,
+                                                  screen["april_position"].values, screen["endmonth_position"].values)
+    screen = screen.sort_values(by=["peak", "events"], ascending=[True, False]).reset_index()
+    return screen
+
+
+def pct_changes(a, b):
+
+    '''
+    Percentage changes from b to a, vectorised version of pct_change (100% where b is zero and a is not)
+    '''
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.where(b>0, 100*(a-b)/b, np.where(a>0, 100, 0))
+    return out
+
+
+def screen_codes(end_date, digits, threshold, dbconn):
+
+    '''
+    Screen changes for all codes with more than a threshold number of events in 2020, at every number of digits in
+    one query
+
+    Inputs:
+    end_date (str): end date of study period
+    digits (int or list): number(s) of digits to group codes by (e.g. each length in a codelist)
+    threshold (int): lower limit for 2020 events per code
+    dbconn (str): SQL credentials
+
+    Output:
+    screen (dataframe): see screen_changes
+    '''
+
+    if np.ndim(digits)==0:
+        digits = [digits]
+    with closing_connection(dbconn) as connection:
+        for sql, params in staging_sql(end_date): # patient registrations and practice list size
+            connection.execute(sql, *params)
+        stage_code_lookup(connection, end_date, codelist=False)
+        sql, params = screening_sql(end_date, digits, threshold)
+        counts = pd.read_sql(sql, connection, params=params)
+    return screen_changes(counts, end_date)
+
+
+def rank_codelist(codelist, screen, positions=None):
+
+    '''
+    Order a codelist by the screened peak change (largest drops first), to pass to plotting_all
+
+    Each code is matched to the screen at its own number of digits, i.e. to all codes beginning with it.
+
+    Inputs:
+    codelist (dataframe): codelist (e.g. combined_codelist csv) with "first_digits" and "digits"
+    screen (dataframe): output of screen_changes / screen_codes
+    positions (list): optional overall classifications to keep (e.g. ["Sustained drop"])
+
+    Output:
+    ranked (dataframe): codelist with the screened changes, ranked by peak change (codes not in the screen, e.g.
+                        below its threshold or screened at other lengths, are kept at the end without changes)
+    '''
+
+    cols = ["first_digits", "digits", "peak", "recovery", "overall_position"]
+    ranked = codelist.merge(screen[cols], on=["first_digits", "digits"], how="left")
+    if positions is not None:
+        ranked = ranked.loc[ranked["overall_position"].isin(positions)]
+    ranked = ranked.sort_values(by=["peak", "2020 events (mill)"], ascending=[True, False]).reset_index(drop=True)
+    return ranked
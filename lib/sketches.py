@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable percentile sketches for decile charts
+
+Practice-level rates for each code and month are summarised as a small set of weighted centroids
+(a t-digest), so that deciles can be refreshed from persisted summaries and sketches from separate
+extracts (e.g. different months, code ranges or runs) can be merged without re-collecting the
+practice-level rows.
+
+Zeros are not stored in the digests. As in all_pracs, every practice which has ever used a code
+counts as zero in any month it did not use it, so the practices using each code are kept alongside
+the centroids and the zeros are added back when the deciles are calculated. This keeps the
+sketches mergeable when a practice only starts using a code in a later extract.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+COMPRESSION = 100
+KEYS = ["first_digits", "month"]
+
+
+def compress(centroids, compression=COMPRESSION):
+
+    '''
+    Merge centroids within each code and month using the t-digest k1 scale function, so that
+    centroids are small in the tails and larger around the median
+
+    Inputs:
+    centroids (dataframe): "first_digits", "month", "mean" and "weight" columns
+    compression (int): maximum number of centroids per code and month
+
+    Output:
+    out (dataframe): compressed centroids
+    '''
+
+    df = centroids.sort_values(by=KEYS + ["mean"]).reset_index(drop=True)
+    total = df.groupby(KEYS)["weight"].transform("sum")
+    q = (df.groupby(KEYS)["weight"].cumsum() - df["weight"]/2)/total
+
+    df["bucket"] = np.floor(compression*(np.arcsin(2*q - 1)/np.pi + 0.5)).astype(int)
+    df["weighted"] = df["mean"]*df["weight"]
+    out = df.groupby(KEYS + ["bucket"])[["weighted", "weight"]].sum().reset_index()
+    out["mean"] = out["weighted"]/out["weight"]
+    return out[KEYS + ["mean", "weight"]]
+
+
+def build_sketches(df0, codes, compression=COMPRESSION):
+
+    '''
+    Build sketches of practice-level rates for each code and month from an events extract
+
+    Inputs:
+    df0 (dataframe): time series data for all codes in codelist (as returned by events_sql)
+    codes (list): full or truncated CTV3 codes (all full codes beginning with each code are included)
+    compression (int): maximum number of centroids per code and month
+
+    Output:
+    sketches (dict): "centroids" (first_digits, month, mean, weight),
+                     "practices" (first_digits, Practice_ID: practices which have used each code) and
+                     "totals" (first_digits, month, numerator)
+    '''
+
+    frames = []
+    for code in codes:
+        df = df0.loc[df0["first_digits"].str[:len(code)]==code]
+        df = df.groupby(["month", "Practice_ID", "denominator"])["numerator"].sum().reset_index()
+        df["first_digits"] = code
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+
+    centroids = df[KEYS].copy()
+    centroids["mean"] = 1000*df["numerator"]/df["denominator"]
+    centroids["weight"] = 1
+
+    sketches = {"centroids": compress(centroids, compression),
+                "practices": df[["first_digits", "Practice_ID"]].drop_duplicates().reset_index(drop=True),
+                "totals": df.groupby(KEYS)["numerator"].sum().reset_index()}
+    return sketches
+
+
+def merge_sketches(sketch_list, compression=COMPRESSION, replace=False):
+
+    '''
+    Merge sketches built from separate extracts (e.g. partitioned by month or code, or from previous runs)
+
+    Each code and month must only be summarised once: merging the same month twice (e.g. re-merging a run, or
+    reloading a month incrementally) would count its practices twice.
+
+    Inputs:
+    sketch_list (list): sketches (dicts from build_sketches or load_sketches)
+    compression (int): maximum number of centroids per code and month
+    replace (bool): if True, a code and month in more than one sketch is taken from the last of them (e.g. to
+                    refresh recent months); otherwise overlapping codes and months raise a ValueError
+
+    Output:
+    sketches (dict): merged sketches
+    '''
+
+    centroids, totals = [], []
+    seen = pd.DataFrame(columns=KEYS)
+    for s in reversed(sketch_list): # later sketches first, so that they replace earlier ones
+        keys = pd.concat([s["centroids"][KEYS], s["totals"][KEYS]]).drop_duplicates()
+        overlap = keys.merge(seen, on=KEYS)
+        if len(overlap) and not replace:
+            raise ValueError(f"{len(overlap)} codes and months are in more than one sketch, "
+                             f"e.g. {overlap.iloc[0].tolist()} (use replace=True to keep the latest)")
+        centroids.append(s["centroids"].merge(overlap, on=KEYS, how="left", indicator=True)
+                         .query("_merge=='left_only'").drop(columns="_merge"))
+        totals.append(s["totals"].merge(overlap, on=KEYS, how="left", indicator=True)
+                      .query("_merge=='left_only'").drop(columns="_merge"))
+        seen = pd.concat([seen, keys], ignore_index=True)
+
+    centroids = pd.concat(centroids, ignore_index=True)
+    practices = pd.concat([s["practices"] for s in sketch_list], ignore_index=True)
+    totals = pd.concat(totals, ignore_index=True)
+
+    sketches = {"centroids": compress(centroids, compression),
+                "practices": practices.drop_duplicates().reset_index(drop=True),
+                "totals": totals.groupby(KEYS)["numerator"].sum().reset_index()}
+    return sketches
+
+
+def save_sketches(sketches, path):
+
+    '''
+    Save sketches as compressed csvs within a folder
+    '''
+
+    os.makedirs(path, exist_ok=True)
+    for name, df in sketches.items():
+        df.to_csv(os.path.join(path, f"{name}.csv.gz"), index=False, compression="gzip")
+
+
+def load_sketches(path):
+
+    '''
+    Load sketches saved using save_sketches
+    '''
+
+    sketches = {}
+    for name in ["centroids", "practices", "totals"]:
+        df = pd.read_csv(os.path.join(path, f"{name}.csv.gz"), dtype={"first_digits": str})
+        if "month" in df.columns:
+            df["month"] = pd.to_datetime(df["month"]).dt.date
+        sketches[name] = df
+    return sketches
+
+
+def sketch_quantiles(means, weights, zeros, quantiles):
+
+    '''
+    Estimate quantiles from sorted centroids plus a number of zero values. Matches PERCENTILE_CONT / pandas
+    linear interpolation exactly while every centroid has a weight of one.
+
+    Inputs:
+    means, weights (arrays): centroids sorted by mean
+    zeros (int): number of practices with no events
+    quantiles (list): quantiles to estimate (0-1)
+
+    Output:
+    (array): estimated values
+    '''
+
+    n = weights.sum() + zeros
+    if n==0:
+        return np.full(len(quantiles), np.nan)
+    pos = np.asarray(quantiles)*(n - 1) - zeros # position within the non-zero values
+    if len(means)==0:
+        return np.zeros(len(quantiles))
+
+    centres = np.cumsum(weights) - weights/2 - 0.5
+    values = np.interp(pos, centres, means)
+    # positions falling within the zeros, or between the last zero and the first non-zero value
+    values = np.where(pos<=-1, 0, np.where(pos<0, (pos + 1)*np.interp(0, centres, means), values))
+    return values
+
+
+def sketch_results(sketches, code, quantiles=None):
+
+    '''
+    Calculate deciles and practice coverage for a single code from sketches, in the same form as pushdown_results
+
+    Inputs:
+    sketches (dict): output of build_sketches / merge_sketches / load_sketches
+    code (str): code to select
+
+    Outputs:
+    deciles (dataframe): "month", "percentile" and "value" columns
+    practice_count_thou (float): number of practices included
+    practices_percent (float): percent of all practices included
+    total_events (float): sum of events across all months
+    (None if code is not in sketches)
+    '''
+
+    if quantiles is None:
+        quantiles = [p/10 for p in range(1, 10)]
+
+    practices = sketches["practices"]
+    practice_count = (practices["first_digits"]==code).sum()
+    if practice_count==0:
+        return None
+
+    centroids = sketches["centroids"]
+    centroids = centroids.loc[centroids["first_digits"]==code].sort_values(by=["month", "mean"])
+    totals = sketches["totals"]
+    totals = totals.loc[totals["first_digits"]==code]
+
+    records = []
+    # all months covered by the sketches, as in all_pracs
+    for month in sorted(sketches["centroids"]["month"].unique()):
+        c = centroids.loc[centroids["month"]==month]
+        weights = c["weight"].values
+        zeros = practice_count - weights.sum()
+        if zeros<0: # more centroid weight than practices, so the month has been counted more than once
+            raise ValueError(f"sketches for {code} in {month} have more values than practices using the code")
+        values = sketch_quantiles(c["mean"].values, weights, zeros, quantiles)
+        for q, value in zip(quantiles, values):
+            records.append([month, int(round(100*q)), value])
+    deciles = pd.DataFrame(records, columns=["month", "percentile", "value"])
+
+    practice_count_thou = round(practice_count/1000, 1)
+    practices_percent = round(100*practice_count/practices["Practice_ID"].nunique(), 1)
+    total_events = totals["numerator"].sum()
+    return deciles, practice_count_thou, practices_percent, total_events
+
+
+def sketch_error(sketches, exact):
+
+    '''
+    Compare deciles estimated from sketches with exact deciles
+
+    Inputs:
+    sketches (dict): sketches to assess
+    exact (dict): exact deciles (e.g. from calculate_deciles) keyed by code
+
+    Output:
+    report (dataframe): absolute error per code (maximum and mean across months and deciles),
+                        and maximum error relative to the inter-decile range
+    '''
+
+    records = []
+    for code, deciles in exact.items():
+        res = sketch_results(sketches, code)
+        if res is None:
+            continue
+        df = deciles.merge(res[0], on=["month", "percentile"], suffixes=["_exact", "_sketch"])
+        df["error"] = (df["value_sketch"] - df["value_exact"]).abs()
+        idr = deciles.pivot(index="month", columns="percentile", values="value")
+        idr = (idr[90] - idr[10]).max()
+        records.append([code, df["error"].max(), df["error"].mean(),
+                        100*df["error"].max()/idr if idr>0 else 0])
+    report = pd.DataFrame(records, columns=["first_digits", "max_abs_error", "mean_abs_error", "max_error_pct_of_idr"])
+    return report
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Decile charts broken down by patient age band and sex
+
+Events are extracted once for every stratum: each registered patient's practice, age band (at the end date) and sex
+are staged in #strata (from #reg and Patient), and the events query groups by age band and sex as well as by code,
+month and practice. List sizes for each practice and stratum are fetched separately, so that strata can be combined
+locally (e.g. by sex only) and practices using a code are included with no events in strata where they had none.
+
+Practice-level rates for all strata of a code are calculated together, with the deciles of every stratum from one
+grouped quantile, and each stratum is classified as in classify_changes. Used by plotting_all(..., strata=[...]),
+which displays each code's strata side by side.
+"""
+
+import pandas as pd
+
+from functions import display, Markdown, classify_changes, sql_date
+
+
+AGE_BANDS = [0, 18, 40, 65, 80] # lower limit of each band
+SEXES = ["F", "M", "U"]
+COLUMNS = 3 # charts per row
+
+
+def age_band_labels():
+
+    '''
+    Labels of the age bands, e.g. "0-17", ..., "80+"
+    '''
+
+    upper = [str(a - 1) for a in AGE_BANDS[1:]]
+    return [f"{a}-{u}" for a, u in zip(AGE_BANDS, upper)] + [f"{AGE_BANDS[-1]}+"]
+
+
+def age_band_sql(age):
+
+    '''
+    Sql expression converting an age in years to its age band label
+    '''
+
+    labels = age_band_labels()
+    cases = "\n        ".join(f"WHEN {age} < {limit} THEN '{label}'" for limit, label in zip(AGE_BANDS[1:], labels))
+    return f'''CASE
+        {cases}
+        ELSE '{labels[-1]}' END'''
+
+
+def strata_staging_sql(end_date):
+
+    '''
+    Queries staging each registered patient's practice, age band and sex
+
+    Inputs:
+    end_date (str): end date of study period (age is calculated at this date)
+
+    Output:
+    list of (sql, params) to execute in turn (after staging_sql)
+    '''
+
+    sql_table = '''-- practice and stratum of each registered patient
+    CREATE TABLE #strata (Patient_ID BIGINT PRIMARY KEY, Practice_ID INT, age_band VARCHAR(10), sex CHAR(1));
+    '''
+
+    sql_fill = f'''INSERT INTO #strata (Patient_ID, Practice_ID, age_band, sex)
+    SELECT
+    Patient_ID,
+    Practice_ID,
+    {age_band_sql("age")} AS age_band,
+    CASE WHEN Sex IN ('F', 'M') THEN Sex ELSE 'U' END AS sex
+    FROM (
+        SELECT
+        r.Patient_ID,
+        r.Practice_ID,
+        p.Sex,
+        -- whole years of age at the end date
+        DATEDIFF(YEAR, p.DateOfBirth, ?) - CASE WHEN DATEADD(YEAR, DATEDIFF(YEAR, p.DateOfBirth, ?), p.DateOfBirth) > ? THEN 1 ELSE 0 END AS age
+        FROM #reg r
+        INNER JOIN Patient p ON r.Patient_ID = p.Patient_ID
+        WHERE r.registration_date_rank = 1
+    ) a
+    '''
+
+    end = sql_date(end_date)
+    return [(sql_table, []), (sql_fill, [end, end, end])]
+
+
+def strata_listsize_sql():
+
+    '''
+    Query for the list size of each practice in each stratum (requires #strata)
+    '''
+
+    sql = '''select
+    Practice_ID,
+    age_band,
+    sex,
+    COUNT(*) AS list_size
+    FROM #strata
+    GROUP BY Practice_ID, age_band, sex'''
+    return sql
+
+
+def strata_events_sql(end_date):
+
+    '''
+    Query to extract monthly event counts per practice and stratum for all codes in the codelist staged by
+    stage_codelist and stage_code_lookup (as events_sql, but grouped by age band and sex too, and without denominators)
+
+    Inputs:
+    end_date (str): end date of study period
+
+    Outputs:
+    sql (str): sql query (requires #strata, #calendar from staging_sql and #codes from stage_code_lookup)
+    params (list): query parameters
+    '''
+
+    sql = '''select
+        k.first_digits,
+        c.period_start AS month,
+        s.Practice_ID,
+        s.age_band,
+        s.sex,
+        COUNT(e.Patient_ID) as numerator
+        FROM CodedEvent e
+        INNER JOIN #codes k ON e.CTV3Code = k.CTV3Code
+        INNER JOIN #calendar c ON e.ConsultationDate >= c.period_start AND e.ConsultationDate < c.next_start
+        INNER JOIN #strata s ON e.Patient_ID = s.Patient_ID
+        WHERE
+        e.ConsultationDate >= '20190101'
+        AND e.ConsultationDate <= ?
+        GROUP BY k.first_digits, c.period_start, s.Practice_ID, s.age_band, s.sex
+        ORDER BY month'''
+    return sql, [sql_date(end_date)]
+
+
+def combined_extract(extract, sizes):
+
+    '''
+    Events extract summed over strata, with practice list sizes as denominators (as returned by events_sql, e.g. to
+    find top child codes)
+    '''
+
+    df0 = extract.groupby(["first_digits", "month", "Practice_ID"])["numerator"].sum().reset_index()
+    listsize = sizes.groupby("Practice_ID")["list_size"].sum().rename("denominator").reset_index()
+    return df0.merge(listsize, on="Practice_ID", how="inner")
+
+
+def stratum_order(by):
+
+    '''
+    Order of the strata for columns in by ("age_band" and/or "sex"), as labels
+    '''
+
+    levels = {"age_band": age_band_labels(), "sex": SEXES}
+    labels = [""]
+    for column in by:
+        labels = [f"{label} {level}".strip() for label in labels for level in levels[column]]
+    return labels
+
+
+def stratum_series(extract, sizes, code, by, months=None):
+
+    '''
+    Practice-level time series of a code for every stratum together
+
+    Practices which used the code in any stratum are included in every stratum in which they have registered
+    patients (with no events where they had none), so that each stratum's deciles are across the same practices.
+
+    Inputs:
+    extract (dataframe): output of strata_events_sql
+    sizes (dataframe): output of strata_listsize_sql
+    code (str): full or truncated CTV3 code
+    by (list): columns to stratify by ("age_band" and/or "sex")
+    months (list): optional months to include (defaults to all months in extract)
+
+    Output:
+    out (dataframe): "stratum", "month", "Practice_ID", "numerator", "denominator" and "value" (rate per 1000),
+                     or None if the code was not used
+    '''
+
+    df = extract.loc[extract["first_digits"].str[:len(code)]==code]
+    if len(df)==0:
+        return None
+
+    # denominators of every practice using the code, for each stratum
+    denominators = sizes.loc[sizes["Practice_ID"].isin(df["Practice_ID"].unique())]
+    denominators = denominators.groupby(["Practice_ID"] + by)["list_size"].sum().rename("denominator").reset_index()
+    if months is None:
+        months = extract["month"].drop_duplicates()
+    cross = pd.DataFrame({"month": list(months), "key": 1}).merge(denominators.assign(key=1), on="key").drop(columns="key")
+
+    numerators = df.groupby(["month", "Practice_ID"] + by)["numerator"].sum().reset_index()
+    out = cross.merge(numerators, on=["month", "Practice_ID"] + by, how="left")
+    out["numerator"] = out["numerator"].fillna(0)
+    out["value"] = 1000*out["numerator"]/out["denominator"]
+    stratum = out[by[0]].astype(str)
+    for column in by[1:]:
+        stratum = stratum + " " + out[column].astype(str)
+    out.insert(0, "stratum", stratum)
+    return out.drop(columns=by)
+
+
+def stratum_results(out):
+
+    '''
+    Deciles (of all strata in one grouped quantile) and classification of each stratum
+
+    Inputs:
+    out (dataframe): output of stratum_series
+
+    Output:
+    results (dict): result for each stratum ("deciles", "stats", "practice_count" and "total_events", as in
+                    compute_code), with strata in order of stratum labels
+    '''
+
+    deciles = out.groupby(["stratum", "month"])["value"].quantile([p/10 for p in range(1, 10)]).reset_index()
+    deciles = deciles.rename(columns={"level_2": "percentile"})
+    deciles["percentile"] = (100*deciles["percentile"]).round().astype(int)
+    totals = out.groupby("stratum")["numerator"].sum()
+    practices = out.groupby("stratum")["Practice_ID"].nunique()
+
+    results = {}
+    for stratum, stratum_deciles in deciles.groupby("stratum", sort=False):
+        stratum_deciles = stratum_deciles.drop(columns="stratum").reset_index(drop=True)
+        results[stratum] = {"deciles": stratum_deciles,
+                            "stats": classify_changes(stratum_deciles),
+                            "practice_count": round(practices[stratum]/1000, 1),
+                            "total_events": round(totals[stratum], 1)}
+    return results
+
+
+def strata_table(results):
+
+    '''
+    Table of medians and classifications for each stratum of a code
+    '''
+
+    rows = []
+    for stratum, result in results.items():
+        s = result["stats"]
+        rows.append({"Stratum": stratum,
+                     "Practices (k)": result["practice_count"],
+                     "Events": result["total_events"],
+                     "Feb median": s["feb_median"],
+                     "April median": s["apr_median"],
+                     f"{s['endmonthname']} median": s["endmonth_median"],
+                     "April change (%)": s["peak"],
+                     f"{s['endmonthname']} change (%)": s["recovery"],
+                     "Classification": s["overall_position"]})
+    return pd.DataFrame(rows)
+
+
+def display_strata(subset, cats, extract, sizes, by, label=None, columns=COLUMNS):
+
+    '''
+    Display a table of classifications and the decile charts of each stratum side by side, for each category and code
+
+    Inputs:
+    subset (dataframe): codelist to display
+    cats (series): categories to display, in order
+    extract (dataframe): output of strata_events_sql
+    sizes (dataframe): output of strata_listsize_sql
+    by (list): columns to stratify by ("age_band" and/or "sex")
+    label (str): optional label for each chart (e.g. for previews)
+    columns (int): charts per row
+    '''
+
+    from render import render_panels
+
+    order = stratum_order(by)
+    for cat in cats:
+        subset_cat = subset.loc[subset["concept_desc"]==cat]
+        display(Markdown(f"# --- \n # Category: {cat}"))
+        display(Markdown(f"Total events: {round(subset_cat['2020 events (mill)'].sum(), 2)} m"))
+
+        for code, desc in zip(subset_cat["first_digits"], subset_cat["Description"].fillna("Unknown")):
+            desc = desc.replace("'","") # replace apostrophes
+            out = stratum_series(extract, sizes, code, by)
+            if out is None:
+                continue
+            results = stratum_results(out)
+            results = {s: results[s] for s in order if s in results and results[s]["total_events"]>10}
+            display(Markdown(f"## \"{code}\" - {desc}"))
+            if not results:
+                display(Markdown(f"### {desc}: _Too few events to plot_"))
+                continue
+            display(strata_table(results))
+            titles = [s if label is None else f"{s} ({label})" for s in results]
+            render_panels([(r["deciles"], t) for r, t in zip(results.values(), titles)], columns)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent monthly summary of events per code and practice
+
+Every analysis aggregates CodedEvent rows up to code x practice x month. This maintains that aggregate as a
+table in a scratch database (dotless full code, month, practice and number of events, clustered on code first so
+that codelists are matched by prefix seeks), which is built once and then topped up with new months.
+
+Using it is an explicit opt-in: plotting_all, extract_events and get_subcodes extract events from it instead of
+CodedEvent when it is passed as summary=..., and discovery_sql can rank codes from it in the same way.
+
+Events are attributed to the practice the patient was registered with on the date of the event (so that months
+already loaded do not change), rather than the practice at the end date as in events_sql, while denominators are
+still list sizes at the end date. Events of patients who moved practice during the period (or who are no longer
+registered) are therefore counted differently, so published charts should be checked against CodedEvent before
+switching. Distinct patients cannot be counted from the summary.
+
+Build or update from the command line (DBCONN as for the notebooks), e.g. against the test database:
+
+    python lib/summary_table.py Test_OPENCoronaExport.dbo.CodeSummary [--rebuild]
+
+tests/test_summary_table.py checks the table against CodedEvent in the mssql container (see mssql/load_synthetic.py).
+"""
+
+import os
+import sys
+from datetime import date
+
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from functions import closing_connection, sql_date
+
+
+START = date(2019, 1, 1)
+REFRESH_MONTHS = 2
+
+
+def find_summary(connection, table):
+
+    '''
+    Check that a summary table opted into exists
+
+    Inputs:
+    connection: open database connection
+    table (str): summary table, or None to use CodedEvent
+
+    Output:
+    table (str): the summary table, or None (raises ValueError if it does not exist)
+    '''
+
+    if table is None:
+        return None
+    exists = pd.read_sql("SELECT OBJECT_ID(?, 'U') AS id", connection, params=[table])["id"][0]
+    if pd.isnull(exists):
+        raise ValueError(f"summary table {table} does not exist (see summary_table.py to build it)")
+    return table
+
+
+def summary_label(table):
+
+    '''
+    Label for charts of events extracted from a summary table, which are attributed differently from CodedEvent
+    '''
+
+    return f"Summary table {table}: practice at time of event"
+
+
+def create_sql(table):
+
+    '''
+    Query creating the summary table, clustered on code, month and practice
+    '''
+
+    name = table.split(".")[-1]
+    sql = f'''-- monthly events per code and practice
+    CREATE TABLE {table} (
+        first_digits VARCHAR(5) NOT NULL,
+        month DATE NOT NULL,
+        Practice_ID INT NOT NULL,
+        events INT NOT NULL,
+        CONSTRAINT PK_{name} PRIMARY KEY CLUSTERED (first_digits, month, Practice_ID)
+    )'''
+    return sql
+
+
+def load_sql(table, start):
+
+    '''
+    Queries replacing the months of the summary table from a start month onwards
+
+    Inputs:
+    table (str): summary table
+    start (date): first month to load
+
+    Output:
+    list of (sql, params) to execute in turn
+    '''
+
+    sql_delete = f'''DELETE FROM {table} WHERE month >= ?'''
+
+    sql_insert = f'''-- events per code, practice (at the time of the event) and month
+    INSERT INTO {table} (first_digits, month, Practice_ID, events)
+    SELECT
+    REPLACE(e.CTV3Code,'.','') AS first_digits,
+    DATEFROMPARTS(YEAR(e.ConsultationDate),MONTH(e.ConsultationDate),1) AS month,
+    r.Organisation_ID AS Practice_ID,
+    COUNT(*) AS events
+    FROM CodedEvent e
+    CROSS APPLY (
+        SELECT TOP 1 Organisation_ID
+        FROM RegistrationHistory h
+        WHERE h.Patient_ID = e.Patient_ID
+        AND h.StartDate <= e.ConsultationDate
+        AND h.EndDate >= e.ConsultationDate
+        ORDER BY h.StartDate DESC, h.EndDate DESC
+    ) r
+    WHERE
+    e.ConsultationDate IS NOT NULL
+    AND e.ConsultationDate >= ?
+    AND e.ConsultationDate <= GETDATE()
+    GROUP BY REPLACE(e.CTV3Code,'.',''), DATEFROMPARTS(YEAR(e.ConsultationDate),MONTH(e.ConsultationDate),1), r.Organisation_ID'''
+
+    return [(sql_delete, [start]), (sql_insert, [start])]
+
+
+def update_summary(dbconn, table, rebuild=False, refresh_months=REFRESH_MONTHS):
+
+    '''
+    Build the summary table, or reload its latest months (which may have been loaded part way through, or had events
+    recorded late) and add any new months
+
+    Inputs:
+    dbconn (str): SQL credentials
+    table (str): summary table, e.g. "OPENCoronaTempTables.dbo.CodeSummary"
+    rebuild (bool): drop and rebuild the whole table
+    refresh_months (int): number of months before the latest month loaded to reload
+
+    Output:
+    start (date): first month loaded
+    '''
+
+    with closing_connection(dbconn) as connection:
+        exists = pd.read_sql("SELECT OBJECT_ID(?, 'U') AS id", connection, params=[table])["id"][0]
+        latest = None
+        if pd.notnull(exists) and rebuild:
+            connection.execute(f"DROP TABLE {table}")
+        elif pd.notnull(exists):
+            latest = pd.read_sql(f"SELECT MAX(month) AS latest FROM {table}", connection)["latest"][0]
+        if pd.isnull(exists) or rebuild:
+            connection.execute(create_sql(table))
+
+        start = START
+        if pd.notnull(latest):
+            start = max(START, pd.Timestamp(latest).date() + relativedelta(months=-refresh_months))
+        for sql, params in load_sql(table, start):
+            connection.execute(sql, *params)
+        connection.commit()
+    return start
+
+
+def summary_code_filter():
+
+    '''
+    Sql condition matching summary rows (alias s) against the codelist staged by stage_codelist, as a range seek on the
+    code prefix
+    '''
+
+    return """EXISTS (SELECT 1 FROM #codelist c WHERE s.first_digits LIKE c.code + '%'
+        AND (c.exact = 0 OR s.first_digits = c.code))"""
+
+
+def summary_events_sql(table, subset, end_date):
+
+    '''
+    Equivalent of events_sql from the summary table
+
+    Inputs:
+    table (str): summary table
+    subset (dataframe): codelist staged by stage_codelist (None for all codes)
+    end_date (str): end date of study period
+
+    Outputs:
+    sql (str): sql query (requires #listsize from staging_sql and the codelist from stage_codelist)
+    params (list): query parameters
+    '''
+
+    code_filter = f"AND {summary_code_filter()}" if subset is not None else ""
+    sql = f'''select
+        s.first_digits,
+        s.month,
+        s.Practice_ID,
+        s.events as numerator,
+        l.list_size as denominator
+        FROM {table} s
+        INNER JOIN #listsize l ON s.Practice_ID = l.Practice_ID
+        WHERE
+        s.month >= '20190101'
+        AND s.month <= ?
+        {code_filter}
+        ORDER BY s.month'''
+    return sql, [sql_date(end_date)]
+
+
+def summary_estimate_sql(table, end_date):
+
+    '''
+    Equivalent of estimate_sql from the summary table (number of rows per month, which events_sql returns at most)
+    '''
+
+    sql = f'''select
+        s.month,
+        COUNT_BIG(*) AS events
+        FROM {table} s
+        WHERE
+        s.month >= '20190101'
+        AND s.month <= ?
+        AND {summary_code_filter()}
+        GROUP BY s.month
+        ORDER BY s.month'''
+    return sql, [sql_date(end_date)]
+
+
+def summary_subcodes_sql(table, end_date, threshold):
+
+    '''
+    Equivalent of the get_subcodes query from the summary table (full codes of the staged codelist with their 2020 events)
+    '''
+
+    sql = f'''select
+    s.first_digits,
+    SUM(s.events) as events
+    FROM {table} s
+    WHERE
+    {summary_code_filter()}
+    AND s.month >= '20200101'
+    AND s.month <= ?
+    GROUP BY s.first_digits
+    HAVING SUM(s.events) > ?'''
+    return sql, [sql_date(end_date), int(threshold)]
+
+
+def summary_discovery_sql(table, level, end_date, threshold, group, condition, top):
+
+    '''
+    Equivalent of discovery_sql from the summary table, given the level and its grouping and conditions on CTV3Code. Patients are
+    not counted (fetch exact counts for a shortlist with exact_patients) and the latest date is the latest month
+    '''
+
+    group = group.replace("CTV3Code", "first_digits")
+    condition = condition.replace("CTV3Code", "first_digits")
+    latest = ", MAX(month) AS latest_date" if level=="level2" else ""
+    sql = f'''select {top}{group} AS first_digits, SUM(events) as events, CAST(NULL AS INT) as patients{latest}, '{level}' AS level
+    FROM {table}
+    WHERE
+    {condition}
+    AND month >= '20200101'
+    AND month <= ?
+    GROUP BY {group}
+    HAVING SUM(events) > ?
+    ORDER BY {"first_digits" if level=="level2" else "events DESC"}'''
+    return sql, [sql_date(end_date), int(threshold)]
+
+
+def main():
+    if len(sys.argv)<2:
+        sys.exit(__doc__)
+    dbconn = os.environ.get("DBCONN", "").strip('"')
+    start = update_summary(dbconn, sys.argv[1], rebuild="--rebuild" in sys.argv[2:])
+    print(f"{sys.argv[1]} loaded from {start}")
+
+
+if __name__ == "__main__":
+    main()
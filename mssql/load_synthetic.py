@@ -0,0 +1,349 @@
+"""
+Load synthetic data into the test database created by setup.sql, to benchmark the queries used by the notebooks
+
+Creates CodedEvent, RegistrationHistory, Patient, Organisation and CTV3Dictionary with the columns used here (as in
+the TPP database) and fills them at a chosen scale:
+
+- CTV3Dictionary: hierarchical 5 character codes (padded with dots), whose descriptions include the topic keywords
+  in data/topics.json so that the codelists can be filtered as in the notebooks
+- RegistrationHistory: patients registered with practices of varying list size, some moving practice during 2019-2020
+- Patient: date of birth and sex (for charts by age band and sex, see lib/strata.py)
+- Organisation: STP and region of each practice (for charts across areas, see lib/hierarchy.py)
+- CodedEvent: events with a skewed code frequency, practice-level variation in activity, seasonality and a drop in
+  activity in spring 2020
+
+Events are generated and loaded in chunks, so hundreds of millions of events only need one chunk in memory. They are
+loaded with bcp if it is installed (see install_mssql.sh), otherwise with pyodbc's fast_executemany. Indexes are
+built after loading.
+
+Usage (DBCONN as for the notebooks, e.g. for the mssql container:
+"DRIVER={ODBC Driver 17 for SQL Server};SERVER=localhost,1433;DATABASE=Test_OPENCoronaExport;UID=SA;PWD=Your_password123!"):
+
+    python mssql/load_synthetic.py --events 10000000 [--patients N] [--practices N] [--method bcp|executemany] [--seed 0]
+    python mssql/load_synthetic.py --events 10000000 --dry-run   # generate without loading, to check sizes
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+
+START = date(2019, 1, 1)
+END = date(2021, 3, 31)
+CURRENT = "9999-12-31" # EndDate of registrations which are still live
+CHUNK = 1000000
+TOPICS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "topics.json")
+
+TABLES = {
+    "CTV3Dictionary": '''CREATE TABLE CTV3Dictionary (
+        CTV3Code VARCHAR(5) NOT NULL,
+        Description VARCHAR(255) NOT NULL
+    )''',
+    "Patient": '''CREATE TABLE Patient (
+        Patient_ID BIGINT NOT NULL,
+        DateOfBirth DATETIME NOT NULL,
+        Sex CHAR(1) NOT NULL
+    )''',
+    "Organisation": '''CREATE TABLE Organisation (
+        Organisation_ID INT NOT NULL,
+        STPCode VARCHAR(10) NOT NULL,
+        Region VARCHAR(50) NOT NULL
+    )''',
+    "RegistrationHistory": '''CREATE TABLE RegistrationHistory (
+        Registration_ID BIGINT NOT NULL,
+        Patient_ID BIGINT NOT NULL,
+        Organisation_ID INT NOT NULL,
+        StartDate DATETIME NOT NULL,
+        EndDate DATETIME NOT NULL
+    )''',
+    "CodedEvent": '''CREATE TABLE CodedEvent (
+        CodedEvent_ID BIGINT NOT NULL,
+        Patient_ID BIGINT NOT NULL,
+        CTV3Code VARCHAR(50) NOT NULL,
+        NumericValue REAL NOT NULL,
+        ConsultationDate DATETIME NULL
+    )''',
+}
+
+INDEXES = [
+    "ALTER TABLE CTV3Dictionary ADD CONSTRAINT PK_CTV3Dictionary PRIMARY KEY CLUSTERED (CTV3Code)",
+    "ALTER TABLE Organisation ADD CONSTRAINT PK_Organisation PRIMARY KEY CLUSTERED (Organisation_ID)",
+    "ALTER TABLE Patient ADD CONSTRAINT PK_Patient PRIMARY KEY CLUSTERED (Patient_ID)",
+    "ALTER TABLE RegistrationHistory ADD CONSTRAINT PK_RegistrationHistory PRIMARY KEY CLUSTERED (Registration_ID)",
+    "CREATE INDEX IX_RegistrationHistory_Patient ON RegistrationHistory (Patient_ID, StartDate, EndDate) INCLUDE (Organisation_ID)",
+    "CREATE INDEX IX_RegistrationHistory_Dates ON RegistrationHistory (StartDate, EndDate) INCLUDE (Patient_ID, Organisation_ID)",
+    "ALTER TABLE CodedEvent ADD CONSTRAINT PK_CodedEvent PRIMARY KEY CLUSTERED (CodedEvent_ID)",
+    "CREATE INDEX IX_CodedEvent_Code ON CodedEvent (CTV3Code, ConsultationDate) INCLUDE (Patient_ID)",
+    "CREATE INDEX IX_CodedEvent_Date ON CodedEvent (ConsultationDate) INCLUDE (Patient_ID, CTV3Code)",
+]
+
+CHARS = list("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+
+
+def dictionary(n_codes, rng):
+
+    '''
+    Hierarchical CTV3-like codes: each code's parent is the code with its last character replaced by a dot
+
+    Inputs:
+    n_codes (int): approximate number of codes
+    rng (Generator): random numbers
+
+    Output:
+    codes (dataframe): "CTV3Code" (5 characters, padded with dots) and "Description"
+    '''
+
+    # branching at each level so that there are about n_codes in total
+    branching = max(2, int(round(n_codes**(1/5))))
+    level = [""]
+    codes = []
+    for depth in range(5):
+        children = []
+        for parent in level:
+            first = ["X", "Y", "U"] if depth==0 else []
+            options = [c for c in CHARS if c not in ".0" and (depth>0 or c not in first)] # 0 and . are excluded from analyses
+            picked = list(rng.choice(options, size=min(branching, len(options)), replace=False))
+            if depth==0:
+                picked += first # local (X, Y, U) codes
+            children += [parent + c for c in picked]
+        codes += children
+        level = children
+
+    keywords = []
+    if os.path.exists(TOPICS):
+        with open(TOPICS) as f:
+            for topic in json.load(f).values():
+                keywords += [k.strip() for k in topic["keywords"]]
+    words = keywords + ["examination", "procedure", "history", "observation", "administration", "test", "review"]
+    descriptions = [f"{rng.choice(words).capitalize()} {rng.choice(words)} {i}" for i in range(len(codes))]
+    return pd.DataFrame({"CTV3Code": [c.ljust(5, ".") for c in codes], "Description": descriptions})
+
+
+def registrations(n_patients, n_practices, rng):
+
+    '''
+    Registrations of patients with practices (list sizes vary), with 5% of patients moving practice during 2019-2020
+
+    Output:
+    reg (dataframe): RegistrationHistory rows
+    '''
+
+    sizes = rng.lognormal(0, 0.6, n_practices)
+    practice = rng.choice(n_practices, size=n_patients, p=sizes/sizes.sum()) + 1
+    start = pd.Timestamp("1990-01-01") + pd.to_timedelta(rng.integers(0, 365*30, n_patients), unit="D")
+    start = start.where(start<pd.Timestamp(START), pd.Timestamp(START) - pd.Timedelta(days=1))
+    reg = pd.DataFrame({"Patient_ID": np.arange(1, n_patients+1), "Organisation_ID": practice,
+                        "StartDate": start, "EndDate": pd.Timestamp("2262-01-01")}) # placeholder for CURRENT
+
+    moved = rng.random(n_patients)<0.05
+    move = pd.Timestamp(START) + pd.to_timedelta(rng.integers(0, 730, moved.sum()), unit="D")
+    second = reg.loc[moved].copy()
+    second["Organisation_ID"] = rng.choice(n_practices, size=moved.sum(), p=sizes/sizes.sum()) + 1
+    second["StartDate"] = move + pd.Timedelta(days=1)
+    reg.loc[moved, "EndDate"] = move.values
+
+    reg = pd.concat([reg, second], ignore_index=True)
+    reg.insert(0, "Registration_ID", np.arange(1, len(reg)+1))
+    return reg, practice
+
+
+def organisations(n_practices, rng):
+
+    '''
+    STP and region of each practice (up to 42 STPs, each within one of 7 regions)
+
+    Output:
+    orgs (dataframe): Organisation rows
+    '''
+
+    regions = np.array(["East", "London", "Midlands", "North East and Yorkshire", "North West", "South East", "South West"])
+    n_stps = min(42, max(1, n_practices//150))
+    stp_region = regions[np.arange(n_stps) % len(regions)]
+    stp = rng.integers(0, n_stps, n_practices)
+    return pd.DataFrame({"Organisation_ID": np.arange(1, n_practices+1),
+                         "STPCode": [f"E54{s:06d}" for s in stp],
+                         "Region": stp_region[stp]})
+
+
+def patients(n_patients, rng):
+
+    '''
+    Patients with a date of birth (first of the month, as in TPP) and sex, with an age distribution roughly like the
+    registered population
+
+    Output:
+    patient (dataframe): Patient rows
+    '''
+
+    age = np.clip(rng.gamma(2.2, 19, n_patients), 0, 105)
+    born = pd.Timestamp(END) - pd.to_timedelta((age*365.25).astype(int), unit="D")
+    sex = rng.choice(["F", "M", "U"], size=n_patients, p=[0.505, 0.494, 0.001])
+    return pd.DataFrame({"Patient_ID": np.arange(1, n_patients+1),
+                         "DateOfBirth": born.to_period("M").to_timestamp(),
+                         "Sex": sex})
+
+
+def month_weights(months):
+
+    '''
+    Relative activity in each month: mild seasonality, with a drop in spring 2020 and partial recovery
+    '''
+
+    covid = {(2020, 3): 0.8, (2020, 4): 0.45, (2020, 5): 0.55, (2020, 6): 0.7, (2020, 7): 0.8, (2020, 8): 0.85,
+             (2020, 9): 0.9, (2020, 10): 0.92, (2020, 11): 0.88, (2020, 12): 0.9, (2021, 1): 0.8}
+    weights = np.array([(1 + 0.1*np.cos(2*np.pi*(m.month-1)/12))*covid.get((m.year, m.month), 1) for m in months])
+    return weights*np.array([m.days_in_month for m in months])
+
+
+def events(n_events, codes, practice, rng, chunk_size=CHUNK):
+
+    '''
+    Generate events in chunks
+
+    Inputs:
+    n_events (int): number of events
+    codes (dataframe): dictionary (see dictionary)
+    practice (array): practice of each patient (Patient_ID = position + 1)
+    rng (Generator): random numbers
+    chunk_size (int): events per chunk
+
+    Yields:
+    chunk (dataframe): CodedEvent rows
+    '''
+
+    # codes used in records are mostly at the most detailed levels, with a skewed (Zipf-like) frequency
+    used = codes["CTV3Code"].values[codes["CTV3Code"].str.count(r"\.").values<=2]
+    code_p = 1/np.arange(1, len(used)+1)**1.1
+    code_p = code_p[rng.permutation(len(used))]
+    code_p = code_p/code_p.sum()
+
+    # practice-level variation in activity (recording rates)
+    activity = rng.lognormal(0, 0.5, practice.max()+1)
+    patient_cum = np.cumsum(activity[practice])
+    patient_cum = patient_cum/patient_cum[-1]
+
+    months = pd.date_range(START, END, freq="MS")
+    month_p = month_weights(months)
+    month_p = month_p/month_p.sum()
+
+    done = 0
+    while done<n_events:
+        n = min(chunk_size, n_events-done)
+        month = rng.choice(len(months), size=n, p=month_p)
+        day = (rng.random(n)*months.days_in_month.values[month]).astype(int)
+        when = months.values[month] + day.astype("timedelta64[D]") + rng.integers(8*60, 18*60, n).astype("timedelta64[m]")
+        yield pd.DataFrame({"CodedEvent_ID": np.arange(done+1, done+n+1),
+                            "Patient_ID": np.searchsorted(patient_cum, rng.random(n)) + 1,
+                            "CTV3Code": rng.choice(used, size=n, p=code_p),
+                            "NumericValue": np.zeros(n),
+                            "ConsultationDate": when})
+        done += n
+
+
+def connection_args(dbconn):
+
+    '''
+    Server, database and credentials for bcp from an ODBC connection string
+    '''
+
+    parts = dict(p.split("=", 1) for p in dbconn.strip('"').split(";") if "=" in p)
+    parts = {k.strip().upper(): v.strip() for k, v in parts.items()}
+    args = ["-S", parts["SERVER"], "-d", parts.get("DATABASE", "Test_OPENCoronaExport")]
+    if "UID" in parts:
+        args += ["-U", parts["UID"], "-P", parts.get("PWD", "")]
+    else:
+        args += ["-T"]
+    return args
+
+
+def load(df, table, connection, method, dbconn):
+
+    '''
+    Bulk insert a dataframe into a table, with bcp (via a tab-separated file) or fast executemany
+    '''
+
+    df = df.copy()
+    for col in df.columns:
+        if np.issubdtype(df[col].dtype, np.datetime64):
+            df[col] = df[col].dt.strftime("%Y-%m-%d %H:%M:%S").replace("2262-01-01 00:00:00", CURRENT)
+
+    if method=="bcp":
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, f"{table}.tsv")
+            df.to_csv(path, sep="\t", header=False, index=False)
+            subprocess.run(["bcp", table, "in", path, "-c", "-t", "\\t", "-b", "100000", "-h", "TABLOCK"] + connection_args(dbconn),
+                           check=True, stdout=subprocess.DEVNULL)
+    else:
+        cursor = connection.cursor()
+        cursor.fast_executemany = True
+        cursor.executemany(f"INSERT INTO {table} ({', '.join(df.columns)}) VALUES ({', '.join(['?']*len(df.columns))})",
+                           list(df.itertuples(index=False, name=None)))
+        connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load synthetic data into the test database")
+    parser.add_argument("--events", type=int, default=1000000, help="number of coded events")
+    parser.add_argument("--patients", type=int, help="number of patients (default: events/20)")
+    parser.add_argument("--practices", type=int, help="number of practices (default: patients/8000, at least 50)")
+    parser.add_argument("--codes", type=int, default=20000, help="approximate number of codes in the dictionary")
+    parser.add_argument("--method", choices=["bcp", "executemany"], help="default: bcp if installed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dry-run", action="store_true", help="generate the data without loading it")
+    args = parser.parse_args()
+
+    n_patients = args.patients or max(1000, args.events//20)
+    n_practices = args.practices or max(50, n_patients//8000)
+    method = args.method or ("bcp" if shutil.which("bcp") else "executemany")
+    rng = np.random.default_rng(args.seed)
+
+    dbconn = os.environ.get("DBCONN", "")
+    connection = None
+    if not args.dry_run:
+        import pyodbc
+        if not dbconn:
+            sys.exit("Set DBCONN to the connection string of the test database")
+        connection = pyodbc.connect(dbconn.strip('"'), autocommit=True)
+        for table, sql in TABLES.items():
+            connection.execute(f"IF OBJECT_ID('{table}', 'U') IS NOT NULL DROP TABLE {table}")
+            connection.execute(sql)
+
+    t = time.time()
+    codes = dictionary(args.codes, rng)
+    reg, practice = registrations(n_patients, n_practices, rng)
+    patient = patients(n_patients, rng)
+    orgs = organisations(n_practices, rng)
+    print(f"{len(codes)} codes, {n_patients} patients ({len(reg)} registrations), {n_practices} practices")
+    if connection is not None:
+        load(codes, "CTV3Dictionary", connection, method, dbconn)
+        load(reg, "RegistrationHistory", connection, method, dbconn)
+        load(patient, "Patient", connection, method, dbconn)
+        load(orgs, "Organisation", connection, method, dbconn)
+
+    loaded = 0
+    for chunk in events(args.events, codes, practice, rng):
+        if connection is not None:
+            load(chunk, "CodedEvent", connection, method, dbconn)
+        loaded += len(chunk)
+        print(f"{loaded} events ({time.time()-t:.0f}s)", end="\r")
+    print()
+
+    if connection is not None:
+        print("building indexes")
+        for sql in INDEXES:
+            connection.execute(sql)
+        connection.close()
+    print(f"done in {time.time()-t:.0f}s ({method if connection is not None else 'dry run'})")
+
+
+if __name__ == "__main__":
+    main()
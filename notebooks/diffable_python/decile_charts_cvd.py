@@ -38,7 +38,7 @@ else:
 import sys
 sys.path.append('../lib/')
     
-from functions import closing_connection, load_filter_codelists, filter_codelists, plotting_all
+from functions import closing_connection, load_filter_codelists, filter_codelists, plotting_all, extract_events
 
 
 # global variables 
@@ -97,14 +97,17 @@ detailed["concept_desc"] = "Cardiovascular"
 # Jump to [detailed codes](#detailed)
 
 N = min(len(highlevel), 25) # number of charts to plot
-plotting_all(highlevel, codes, N, threshold, end_date, dbconn, True)
+N_detailed = min(len(detailed), 75) # number of detailed charts to plot
+# extract events once for both the high level and detailed codes
+df0 = extract_events([highlevel.head(N), detailed.head(N_detailed)], end_date, dbconn)
+plotting_all(highlevel, codes, N, threshold, end_date, dbconn, True, df0=df0)
 
 # # Detailed codes <a id="detailed"></a>
 # Jump back to [high-level codes](#highlevel)
 
 N = min(len(detailed), 75) # number of charts to plot
 pd.set_option('display.max_rows', 100) # display full contents table
-plotting_all(detailed, codes, N, threshold, end_date, dbconn, False)
+plotting_all(detailed, codes, N, threshold, end_date, dbconn, False, df0=df0)
 
 # +
 
@@ -39,7 +39,7 @@ else:
 import sys
 sys.path.append('../lib/')
     
-from functions import closing_connection, load_filter_codelists, filter_codelists, plotting_all
+from functions import closing_connection, load_filter_codelists, filter_codelists, plotting_all, extract_events
 
 
 # global variables 
@@ -103,9 +103,12 @@ detailed["concept_desc"] = "Womens/reproductive health"
 # Jump to [detailed codes](#detailed)
 
 N = min(len(highlevel), 25) # number of charts to plot
-plotting_all(highlevel, codes, N, threshold, end_date, dbconn, True)
+N_detailed = min(len(detailed), 75) # number of detailed charts to plot
+# extract events once for both the high level and detailed codes
+df0 = extract_events([highlevel.head(N), detailed.head(N_detailed)], end_date, dbconn)
+plotting_all(highlevel, codes, N, threshold, end_date, dbconn, True, df0=df0)
 
 # # Detailed codes <a id="detailed"></a>
 
 N = min(len(detailed), 75) # number of charts to plot
-plotting_all(detailed, codes, N, threshold, end_date, dbconn, False)
+plotting_all(detailed, codes, N, threshold, end_date, dbconn, False, df0=df0)
@@ -2,41 +2,95 @@
 browser on the correct port, and handle shutdowns gracefully
 
 """
+import hashlib
 import os
 import signal
 import subprocess
 import socket
 import sys
 import time
+import urllib.error
 import urllib.request
 import webbrowser
 
 tag = "datalab-notebook"
+container_name = "datalab-notebook"
 current_dir = os.getcwd()
 target_dir = "/home/app/notebook"
 
+# files which the image is built from (a change to any of them needs a rebuild)
+build_inputs = ["Dockerfile", "requirements.txt", "config"]
 
-def await_jupyter_http(port):
-    """Wait up to 10 seconds for Jupyter to be available
+
+def await_jupyter_http(port, timeout=120):
+    """Wait for Jupyter to be available, retrying connection errors and
+    server errors (5xx) with exponential backoff (from 0.1 up to 2 seconds
+    between attempts) for up to `timeout` seconds
     """
     print(f"Waiting for Jupyter to be ready on port {port}")
-    timeout = 10
-    increment = 0.1
-    counter = 0
     url = f"http://localhost:{port}"
-    while counter < (timeout / increment):
+    delay = 0.1
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         try:
-            with urllib.request.urlopen(url, timeout=timeout):
+            with urllib.request.urlopen(url, timeout=5):
                 return
-        except ConnectionResetError:
-            counter += 1
-            time.sleep(increment)
-        except socket.timeout:
-            break
+        except urllib.error.HTTPError as e:
+            if e.code < 500:
+                return  # Jupyter is up and answering (e.g. asking for a token)
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
 
     raise SystemError(f"Unable to reach Jupyter at {url}")
 
 
+def content_hash(paths):
+    """Return a short hash of the contents of the given files (and all files
+    within the given directories)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        digest.update(path.replace(os.sep, "/").encode("utf8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def image_exists(image):
+    """Return whether a docker image with this name:tag exists locally
+    """
+    completed_process = subprocess.run(
+        ["docker", "image", "inspect", image], capture_output=True
+    )
+    return completed_process.returncode == 0
+
+
+def running_container(name):
+    """Return the id and image of the running container with this name, or
+    (None, None) if there isn't one
+    """
+    completed_process = subprocess.run(
+        ["docker", "ps", "--filter", f"name=^/{name}$", "--format", "{{.ID}} {{.Image}}"],
+        check=True,
+        capture_output=True,
+    )
+    output = completed_process.stdout.decode("utf8").split()
+    if not output:
+        return None, None
+    return output[0], output[1]
+
+
 def stream_subprocess_output(cmd):
     """Stream stdout and stderr of `cmd` in a subprocess to stdout
     """
@@ -54,17 +108,47 @@ def stream_subprocess_output(cmd):
             raise subprocess.CalledProcessError(cmd=cmd, returncode=p.returncode)
 
 
-def docker_build(tag):
-    """Build container for Dockerfile in current directory
+def docker_build(tag, image):
+    """Build container for Dockerfile in current directory, tagged with both
+    `tag` and `image` (tag plus content hash)
     """
     print(
         "Building docker image. This may take some time (particularly on the first run)..."
     )
-    buildcmd = ["docker", "build", "-t", tag, "-f", "Dockerfile", "."]
+    buildcmd = ["docker", "build", "-t", tag, "-t", image, "-f", "Dockerfile", "."]
     stream_subprocess_output(buildcmd)
 
 
-def docker_run(tag):
+def remove_old_images(image):
+    """Remove images tagged with an earlier content hash than `image`, which
+    each rebuild would otherwise leave behind. Images still used by a
+    container are kept (docker refuses to remove them)
+    """
+    repository, current = image.split(":")
+    completed_process = subprocess.run(
+        ["docker", "images", repository, "--format", "{{.Tag}}"],
+        check=True,
+        capture_output=True,
+    )
+    for old in completed_process.stdout.decode("utf8").split():
+        if old not in (current, "latest", "<none>"):
+            print(f"Removing out of date image {repository}:{old}")
+            subprocess.run(["docker", "rmi", f"{repository}:{old}"], capture_output=True)
+
+
+def install_stop_handler(container_id):
+    """Install signal handler to stop the container on Ctrl+C
+    """
+
+    def stop_handler(sig, frame):
+        print("Stopping docker...")
+        subprocess.run(["docker", "kill", container_id], check=True)
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop_handler)
+
+
+def docker_run(image):
     """Run docker in background, and install signal handler to stop it
     again
 
@@ -77,23 +161,18 @@ def docker_run(tag):
         "run",
         "--detach",  # in the background, so we can find out the port it's bound to
         "--rm",  # clean up the container after it's stopped
+        "--name",
+        container_name,  # so that it can be found and reattached to by the next run
         "--env-file",
         "environ.txt",
         "--mount",
         f"source={current_dir},dst={target_dir},type=bind",
         "--publish-all",
-        tag,
+        image,
     ]
     completed_process = subprocess.run(runcmd, check=True, capture_output=True)
     container_id = completed_process.stdout.decode("utf8").strip()
-
-    def stop_handler(sig, frame):
-        print("Stopping docker...")
-        subprocess.run(["docker", "kill", container_id], check=True)
-        sys.exit(0)
-
-    signal.signal(signal.SIGINT, stop_handler)
-
+    install_stop_handler(container_id)
     return container_id
 
 
@@ -109,8 +188,27 @@ def docker_port(container_id):
 
 
 def main():
-    docker_build(tag)
-    container_id = docker_run(tag)
+    image = f"{tag}:{content_hash(build_inputs)}"
+    built = not image_exists(image)
+    if built:
+        docker_build(tag, image)
+    else:
+        print(f"Docker image {image} is up to date, skipping build")
+
+    container_id, container_image = running_container(container_name)
+    if container_id is not None and container_image == image:
+        print(f"Reattaching to running container {container_name}")
+        install_stop_handler(container_id)
+    else:
+        if container_id is not None:
+            print(f"Stopping container {container_name} running an out of date image")
+            subprocess.run(["docker", "kill", container_id], check=True)
+            # wait for it to be removed (--rm) so that its name can be reused
+            subprocess.run(["docker", "wait", container_id], capture_output=True)
+        container_id = docker_run(image)
+    if built:
+        # after any container running an out of date image has been stopped
+        remove_old_images(image)
     port = docker_port(container_id)
     await_jupyter_http(port)
     webbrowser.open(f"http://localhost:{port}", new=2)  # Open in a new tab
@@ -3,6 +3,12 @@
 # A python warning filter.  For this one, see #20
 WARNING_FILTER="ignore:KernelManager._kernel_spec_manager_changed:DeprecationWarning"
 
+# Importing lib/functions.py must stay fast (heavy packages are imported lazily)
+python check_import_time.py || exit 1
+
+# Tests of the numeric code in lib/ against brute-force calculations
+PYTHONPATH=$(pwd) python -m pytest tests -W $WARNING_FILTER || exit 1
+
 # This awkward testing of exit codes is to get around the case where
 # no tests are found, which has exit code of 5 in pytest, but we don't
 # want to treat as a failure
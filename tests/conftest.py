@@ -0,0 +1,72 @@
+# Tests of the numeric code in lib/, each comparing against the brute-force pandas calculation on a small
+# synthetic extract
+
+import os
+import sys
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+
+MONTHS = [date(2019, m, 1) for m in range(1, 13)] + [date(2020, m, 1) for m in range(1, 13)]
+CODES = ["22", "22K", "22K1", "22A", "7L1H", "7L1K", "XaBVJ", "XaBVK", "Y1234"] # up to the first dot, as extracted
+
+
+def random_extract(rng, practices=40, rows=3000):
+
+    '''
+    Events extract as returned by events_sql: monthly event counts per full code and practice, with list sizes
+    '''
+
+    df0 = pd.DataFrame({"first_digits": rng.choice(CODES, size=rows),
+                        "month": rng.choice(np.array(MONTHS, dtype=object), size=rows),
+                        "Practice_ID": rng.integers(1, practices + 1, rows),
+                        "numerator": rng.integers(1, 30, rows)})
+    df0 = df0.groupby(["first_digits", "month", "Practice_ID"])["numerator"].sum().reset_index()
+    # list sizes with distinct rates, so that no two practices tie
+    df0["denominator"] = 1000 + 37*df0["Practice_ID"] + df0["Practice_ID"]**2
+    return df0
+
+
+def naive_series(df0, code):
+
+    '''
+    Practice-level rates of a code every month, counting every practice which has used the code (in any month)
+    as zero in months it did not
+    '''
+
+    df = df0.loc[df0["first_digits"].str.startswith(code)]
+    practices = df[["Practice_ID", "denominator"]].drop_duplicates()
+    rows = []
+    for month in sorted(df0["month"].unique()):
+        for practice, denominator in zip(practices["Practice_ID"], practices["denominator"]):
+            numerator = df.loc[(df["month"]==month) & (df["Practice_ID"]==practice), "numerator"].sum()
+            rows.append([month, practice, numerator, denominator, 1000*numerator/denominator])
+    return pd.DataFrame(rows, columns=["month", "Practice_ID", "numerator", "denominator", "value"])
+
+
+def naive_deciles(out):
+
+    '''
+    Deciles of practice-level rates every month, with numpy's linear interpolation
+    '''
+
+    rows = []
+    for month, df in out.groupby("month"):
+        for p in range(10, 100, 10):
+            rows.append([month, p, np.percentile(df["value"], p)])
+    return pd.DataFrame(rows, columns=["month", "percentile", "value"])
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def df0(rng):
+    return random_extract(rng)
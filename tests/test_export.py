@@ -0,0 +1,72 @@
+import os
+from datetime import date
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from export import DECILES_SCHEMA, SUMMARY_SCHEMA, read_results, result_tables, write_results
+from functions import compute_results, top_subcodes
+
+
+END_DATE = "20201231"
+
+
+@pytest.fixture
+def tables(df0):
+    # numeric-looking codes check that first_digits is not read back as a number
+    df0 = df0.assign(first_digits=df0["first_digits"].replace({"22K1": "2201"}))
+    codes = ["22", "220", "7L1", "XaB"]
+    code_dict = pd.DataFrame({"first_digits": sorted(df0["first_digits"].unique()), "Description": "Code"})
+    subcodes = top_subcodes(df0, codes, code_dict, END_DATE, 0)
+    subset = pd.DataFrame({"first_digits": codes, "digits": [len(c) for c in codes], "Description": "Code"})
+    results = compute_results(df0, subset, subcodes, second_chart=True)
+    return [result_tables(code, "Code", len(code), results[code]) for code in codes]
+
+
+def test_round_trip(tmp_path, tables):
+    path = str(tmp_path)
+    write_results(tables, path, "cvd", END_DATE, "High level")
+    write_results(tables[:2], path, "resp", "20200930")
+
+    # hive-style partitions, one file per codelist type
+    assert os.path.exists(os.path.join(path, "deciles", "topic=cvd", f"end_date={END_DATE}", "high_level.parquet"))
+    assert os.path.exists(os.path.join(path, "summary", "topic=resp", "end_date=20200930", "all.parquet"))
+    schema = pq.read_schema(os.path.join(path, "deciles", "topic=cvd", f"end_date={END_DATE}", "high_level.parquet"))
+    assert schema.remove_metadata().equals(DECILES_SCHEMA)
+    schema = pq.read_schema(os.path.join(path, "summary", "topic=cvd", f"end_date={END_DATE}", "high_level.parquet"))
+    assert schema.remove_metadata().equals(SUMMARY_SCHEMA)
+
+    deciles = read_results(path, "deciles", topic="cvd", end_date=END_DATE)
+    assert all(isinstance(m, date) for m in deciles["month"])
+    assert all(isinstance(c, str) for c in deciles["first_digits"])
+    assert set(deciles["codelist_type"])=={"High level"}
+    expected = pd.concat([t[0] for t in tables], ignore_index=True)
+    keys = ["first_digits", "parent_code", "month", "percentile"]
+    deciles = deciles.sort_values(keys).reset_index(drop=True)
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(deciles[expected.columns], expected, check_dtype=False)
+
+    summary = read_results(path, "summary", end_date="20200930", columns=["first_digits", "digits", "overall_position"])
+    assert list(summary["first_digits"])==["22", "220"]
+    assert list(summary["digits"])==[2, 3]
+    assert list(summary["overall_position"])==[t[1]["overall_position"] for t in tables[:2]]
+    assert len(read_results(path, "summary"))==len(tables) + 2
+
+
+def test_rewrite_replaces_partition(tmp_path, tables):
+    path = str(tmp_path)
+    write_results(tables, path, "cvd", END_DATE, "Detailed")
+    write_results(tables, path, "cvd", END_DATE, "High level")
+    # the same topic, end date and codelist type again, with fewer codes
+    write_results(tables[:1], path, "cvd", END_DATE, "Detailed")
+
+    summary = read_results(path, "summary", topic="cvd", end_date=END_DATE)
+    assert list(summary.loc[summary["codelist_type"]=="Detailed", "first_digits"])==["22"]
+    assert len(summary.loc[summary["codelist_type"]=="High level"])==len(tables)
+    deciles = read_results(path, "deciles", topic="cvd", end_date=END_DATE)
+    detailed = deciles.loc[deciles["codelist_type"]=="Detailed"]
+    assert len(detailed)==len(tables[0][0])
+    assert set(detailed["parent_code"])=={"22"}
@@ -0,0 +1,50 @@
+import pandas as pd
+
+from conftest import random_extract
+from hierarchy import hierarchy_cube, organisation_sql
+
+
+def random_areas(rng, practices=60):
+
+    '''
+    Output of organisation_sql: every practice with registered patients (more than appear in the extract), its list
+    size and its STP and region, with some practices not mapped to an area
+    '''
+
+    ids = range(1, practices + 1)
+    stp = rng.choice(["E54000001", "E54000002", "E54000003", None], size=practices)
+    region = pd.Series(stp).map({"E54000001": "North", "E54000002": "North", "E54000003": "South"})
+    return pd.DataFrame({"Practice_ID": list(ids),
+                         "list_size": [1000 + 37*p + p**2 for p in ids],
+                         "stp": stp, "region": region})
+
+
+def test_organisation_sql_joins_listsize():
+    sql = organisation_sql(["stp", "region"])
+    assert "FROM #listsize l" in sql
+    assert "o.STPCode AS stp" in sql and "o.Region AS region" in sql
+
+
+def test_cube_matches_brute_force(rng):
+    df0 = random_extract(rng)
+    orgs = random_areas(rng)
+    cube = hierarchy_cube(df0, orgs, ["stp", "region"])
+
+    for level in ["stp", "region"]:
+        areas = orgs.assign(area=orgs[level].fillna("Unknown"))
+        for area, practices in areas.groupby("area"):
+            df = cube[level].loc[cube[level]["Practice_ID"]==area]
+            # denominator of every practice in the area, including those with no events
+            assert (df["denominator"]==practices["list_size"].sum()).all()
+            events = df0.loc[df0["Practice_ID"].isin(practices["Practice_ID"])]
+            expected = events.groupby(["first_digits", "month"])["numerator"].sum()
+            assert df.set_index(["first_digits", "month"])["numerator"].sort_index().to_dict()==expected.sort_index().to_dict()
+
+
+def test_practices_missing_from_listsize(rng):
+    df0 = random_extract(rng)
+    orgs = random_areas(rng).loc[lambda x: x["Practice_ID"]!=3]
+    cube = hierarchy_cube(df0, orgs, ["stp"])
+    unknown = cube["stp"].loc[cube["stp"]["Practice_ID"]=="Unknown", "denominator"]
+    expected = orgs.loc[orgs["stp"].isna(), "list_size"].sum() + df0.loc[df0["Practice_ID"]==3, "denominator"].iloc[0]
+    assert (unknown==expected).all()
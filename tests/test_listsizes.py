@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import MONTHS
+from functions import registration_changes, monthly_listsizes, apply_listsizes
+
+
+def random_registrations(rng, n=2000, practices=30):
+
+    '''
+    Registration periods starting and ending at random, some before the study and some still live
+    '''
+
+    starts = np.datetime64("2017-06-01") + rng.integers(0, 1400, n).astype("timedelta64[D]")
+    ends = starts + rng.integers(0, 900, n).astype("timedelta64[D]")
+    ends = np.where(rng.random(n)<0.3, np.datetime64("2200-01-01"), ends) # still registered
+    return pd.DataFrame({"Practice_ID": rng.integers(1, practices + 1, n),
+                         "StartDate": pd.to_datetime(starts), "EndDate": pd.to_datetime(ends)})
+
+
+def naive_listsizes(reg, end_date, months):
+
+    '''
+    Patients registered with each practice at the end of each month (or at the end date in the last month)
+    '''
+
+    end = pd.Timestamp(end_date)
+    counts = {}
+    for month in months:
+        day = min(pd.Timestamp(month) + pd.offsets.MonthEnd(0), end)
+        live = reg.loc[(reg["StartDate"]<=day) & (reg["EndDate"]>=day)]
+        counts[month] = live.groupby("Practice_ID").size()
+    return pd.DataFrame(counts).fillna(0).astype(int)
+
+
+@pytest.mark.parametrize("end_date", ["20201231", "20201215", "20200930"])
+def test_monthly_listsizes(rng, end_date):
+    reg = random_registrations(rng)
+    months = [m for m in MONTHS if m<=pd.Timestamp(end_date).date()]
+    listsizes = monthly_listsizes(registration_changes(reg, end_date), months)
+    expected = naive_listsizes(reg, end_date, months)
+    expected = expected.reindex(listsizes.index, fill_value=0)
+    assert (listsizes.loc[expected.index]==expected).all().all()
+    # practices without registrations in the period are all zero
+    assert (listsizes.drop(expected.loc[expected.sum(axis=1)>0].index)==0).all().all()
+
+
+def test_apply_listsizes(rng):
+    reg = random_registrations(rng)
+    listsizes = monthly_listsizes(registration_changes(reg, "20201231"), MONTHS)
+    out = pd.DataFrame({"Practice_ID": [1, 2, 1, 999], "month": [MONTHS[0], MONTHS[5], MONTHS[-1], MONTHS[3]],
+                        "denominator": 1})
+    out = apply_listsizes(out, listsizes)
+    for practice, month, denominator in zip(out["Practice_ID"][:3], out["month"][:3], out["denominator"][:3]):
+        assert denominator==listsizes.loc[practice, month]
+    assert np.isnan(out["denominator"].iloc[3]) # no registered patients
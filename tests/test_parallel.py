@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+
+from functions import compute_results, top_subcodes
+
+
+END_DATE = "20201231"
+
+
+def assert_same_results(parallel, serial):
+
+    '''
+    Check compact results (see compact_result) are equal code by code
+    '''
+
+    assert list(parallel)==list(serial)
+    for code, expected in serial.items():
+        result = parallel[code]
+        if expected is None:
+            assert result is None
+            continue
+        pd.testing.assert_frame_equal(result["deciles"], expected["deciles"])
+        assert result["stats"]==expected["stats"]
+        for key in ["practice_count", "practices_percent", "total_events", "practices"]:
+            assert result[key]==expected[key], key
+        if expected["child"] is None:
+            assert result["child"] is None
+        else:
+            assert result["child"]["code"]==expected["child"]["code"]
+            pd.testing.assert_frame_equal(result["child"]["deciles"], expected["child"]["deciles"])
+
+
+@pytest.fixture
+def subcodes(df0):
+    code_dict = pd.DataFrame({"first_digits": sorted(df0["first_digits"].unique()), "Description": "Code"})
+    return top_subcodes(df0, ["22", "22K", "7L1", "XaB"], code_dict, END_DATE, 0)
+
+
+@pytest.mark.parametrize("codes", [["22", "22K", "7L1", "XaB", "ZZZ"], ["22"], []])
+def test_parallel_matches_serial(df0, subcodes, codes):
+    subset = pd.DataFrame({"first_digits": codes, "digits": [len(c) for c in codes]}, dtype=object)
+    serial = compute_results(df0, subset, subcodes, second_chart=True)
+    parallel = compute_results(df0, subset, subcodes, second_chart=True, workers=2)
+    assert_same_results(parallel, serial)
+
+
+def test_top_subcodes_empty_codelist(df0, subcodes):
+    code_dict = pd.DataFrame({"first_digits": sorted(df0["first_digits"].unique()), "Description": "Code"})
+    empty = top_subcodes(df0, [], code_dict, END_DATE, 0)
+    assert len(empty)==0
+    assert list(empty.columns)==list(subcodes.columns)
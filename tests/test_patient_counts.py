@@ -0,0 +1,88 @@
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions
+from functions import code_counts, exact_patients
+from hll import hll_registers, hll_estimate, hll_count_distinct, sparse_registers, sparse_estimate
+
+
+def random_events(rng, n=200000):
+
+    '''
+    Events with full CTV3 codes (some with dots) and patients, as in CodedEvent
+    '''
+
+    codes = np.array(["22K..", "22K1.", "22...", "2....", "7L1H.", "7L...", "XaBVJ", "X....", "Y1234"])
+    weights = np.array([30, 10, 5, 2, 20, 8, 15, 4, 6], dtype=float)
+    return pd.DataFrame({"CTV3Code": rng.choice(codes, size=n, p=weights/weights.sum()),
+                         "Patient_ID": rng.integers(0, 60000, n)})
+
+
+@pytest.mark.parametrize("digits", [2, 3, None])
+def test_code_counts(rng, digits):
+    events = random_events(rng)
+    codes = events["CTV3Code"] if digits is None else events["CTV3Code"].str[:digits]
+    exact = code_counts(events, digits).set_index("first_digits")
+    assert exact["events"].to_dict()==codes.value_counts().to_dict()
+    assert exact["patients"].to_dict()==events.groupby(codes)["Patient_ID"].nunique().to_dict()
+
+    approx = code_counts(events, digits, approx=True).set_index("first_digits")
+    error = (approx["patients"]/exact["patients"] - 1).abs()
+    assert error.max() < 0.03 # 0.8% standard error
+
+
+def test_hll_merge(rng):
+    # registers merged by maximum count the union, as used to roll up child codes
+    values = rng.integers(0, 10**6, 50000)
+    keys = rng.integers(0, 2, len(values))
+    _, registers = hll_registers(keys, values)
+    merged = hll_estimate(registers.max(axis=0))[0]
+    assert abs(merged/len(np.unique(values)) - 1) < 0.03
+    assert hll_count_distinct(np.zeros(3), [1, 1, 2]).iloc[0]==2
+
+
+@pytest.mark.parametrize("p", [10, 12, 14])
+def test_sparse_estimate(rng, p):
+    # sparse registers give exactly the dense estimate, for keys with few and many values
+    keys = rng.choice(["22K", "7L1H", "XaBVJ"], size=60000, p=[0.98, 0.0195, 0.0005])
+    values = rng.integers(0, 10**6, len(keys))
+    unique_keys, registers = hll_registers(keys, values, p)
+    sparse = sparse_registers(keys, values, p)
+    assert len(sparse)==(registers>0).sum()
+    estimates = sparse_estimate(sparse["key"], sparse["rank"], p)
+    assert list(estimates.index)==list(unique_keys)
+    assert np.allclose(estimates.values, hll_estimate(registers))
+
+
+def test_exact_patients_by_level(rng, monkeypatch):
+    events = random_events(rng)
+
+    # discovery_sql with shortlist=True, counting the staged codes at their own level
+    groups = {"level2": lambda c: c.str[:2], "level3": lambda c: c.str[:3], "uxy": lambda c: c}
+    staged = {}
+    def read_sql(sql, connection, params):
+        level = sql.split("AS level")[0].split("'")[-2]
+        events_level = events.loc[events["CTV3Code"].str[0].isin(["U", "X", "Y"])==(level=="uxy")]
+        group = groups[level](events_level["CTV3Code"])
+        counts = events_level.groupby(group)["Patient_ID"].nunique().rename("patients").reset_index()
+        counts = counts.rename(columns={"CTV3Code": "first_digits"})
+        counts = counts.loc[counts["first_digits"].str.replace(".", "", regex=False).isin(staged["codes"])]
+        return counts.assign(level=level)
+    monkeypatch.setattr(functions, "closing_connection", lambda dbconn: nullcontext())
+    monkeypatch.setattr(functions, "stage_codelist", lambda connection, subset: staged.update(codes=list(subset["first_digits"])))
+    monkeypatch.setattr(functions.pd, "read_sql", read_sql)
+
+    df = pd.DataFrame({"first_digits": ["22K", "22", "2", "7L", "XaBVJ", "X"],
+                       "level": ["level3", "level3", "level2", "level3", "uxy", "uxy"],
+                       "patients": -1})
+    out = exact_patients(df, "20201231", 0, None)
+    expected = {"22K": events["CTV3Code"].str[:3]=="22K", "22": events["CTV3Code"].str[:3]=="22.",
+                "2": events["CTV3Code"].str[:2]=="2.", "7L": events["CTV3Code"].str[:3]=="7L.",
+                "XaBVJ": events["CTV3Code"]=="XaBVJ", "X": events["CTV3Code"]=="X...."}
+    for code, patients in zip(out["first_digits"], out["patients"]):
+        assert patients==events.loc[expected[code], "Patient_ID"].nunique()
+
+    assert len(exact_patients(df.iloc[:0], "20201231", 0, None))==0
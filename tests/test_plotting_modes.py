@@ -0,0 +1,39 @@
+import pandas as pd
+import pytest
+
+from functions import check_modes, plotting_all
+
+
+@pytest.mark.parametrize("options", [
+    {"df0": pd.DataFrame(), "preview": 0.1},
+    {"strata": ["sex"], "stream": True},
+    {"strata": ["sex"], "pushdown": True},
+    {"strata": ["sex"], "sweep": ["2020-06-30"]},
+    {"strata": ["sex"], "export_path": "results"},
+    {"hierarchy": ["stp"], "export_path": "results"},
+    {"hierarchy": ["stp"], "memory_budget": 500},
+    {"hierarchy": ["region"], "monthly_denominators": True},
+    {"summary": "SummaryEvents", "pushdown": True},
+    {"summary": "SummaryEvents", "sketches": {}},
+    {"sketches": {}, "pushdown": True},
+])
+def test_unsupported_options_raise(options):
+    with pytest.raises(ValueError, match="cannot be used together"):
+        check_modes(options)
+
+
+@pytest.mark.parametrize("options", [
+    {"df0": pd.DataFrame(), "second_chart": False, "export_path": "results"},
+    {"df0": pd.DataFrame(), "hierarchy": ["stp"]},
+    {"stream": True, "preview": 0.1, "monthly_denominators": True, "summary": "SummaryEvents"},
+    {"strata": ["age_band", "sex"], "preview": 0.1, "memory_budget": 500},
+    {"sweep": ["2020-06-30"], "hierarchy": ["region"], "pushdown": False, "sketches": None},
+])
+def test_supported_options(options):
+    check_modes(options)
+
+
+def test_plotting_all_raises_before_extracting():
+    # no connection is made (dbconn is not valid) as the options are checked first
+    with pytest.raises(ValueError, match="preview and df0"):
+        plotting_all(pd.DataFrame(), None, 10, 5, "2020-12-31", None, df0=pd.DataFrame(), preview=0.1)
@@ -0,0 +1,113 @@
+# The Polars versions of the dataframe transforms (lib/polars_engine.py) return the same results as the pandas
+# versions in lib/functions.py, on random data shaped like the discovery and events extracts
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("polars")
+
+import functions
+import polars_engine
+from rollup import rollup_cube
+
+
+CHARS = list("0123456789ABXYUabc")
+CONCEPTS = ["Clinical findings", "Procedure", "Laboratory test", "Administration", "Observable entity"]
+MONTHS = [date(2019, m, 1) for m in range(1, 13)] + [date(2020, m, 1) for m in range(1, 13)]
+
+
+@pytest.fixture(scope="module")
+def inputs():
+
+    '''
+    Code dictionary, discovery output, concept tables and events extract with random codes and counts
+    '''
+
+    rng = np.random.default_rng(0)
+    full = np.unique(["".join(rng.choice(CHARS, size=5)) for _ in range(300)])
+    words = ["Depression", "imaging", "X-ray", "review", "test", "history"]
+    prefixes = np.unique([c[:n] for c in full for n in [1, 2, 3]])
+    codes = pd.DataFrame({"first_digits": np.r_[prefixes, full]})
+    codes["Description"] = [f"{rng.choice(words)} {i}" for i in range(len(codes))]
+    codes.loc[rng.random(len(codes))<0.05, "Description"] = np.nan
+
+    discovered = rng.choice(codes["first_digits"], size=len(codes)//2, replace=False)
+    df = pd.DataFrame({"first_digits": [c.ljust(5, ".") if len(c)==5 else c for c in discovered],
+                       "events": rng.integers(1, 10**7, len(discovered)),
+                       "patients": rng.integers(1, 10**6, len(discovered))})
+    df.loc[:10, "events"] = 15000 # rounding half to even
+
+    concepts = []
+    for _ in range(3):
+        concepts.append(pd.DataFrame({"descendant_clean": rng.choice(codes["first_digits"], size=len(codes)//3),
+                                      "concept_desc": rng.choice(CONCEPTS + ["Laboratory test observations"], size=len(codes)//3)}))
+
+    n = 20*len(full)
+    df0 = pd.DataFrame({"first_digits": rng.choice(full, size=n),
+                        "month": rng.choice(np.array(MONTHS, dtype=object), size=n),
+                        "Practice_ID": rng.integers(1, 200, n),
+                        "numerator": rng.integers(1, 50, n)})
+    df0["denominator"] = 1000 + 37*df0["Practice_ID"]
+    df0 = df0.groupby(["first_digits", "month", "Practice_ID", "denominator"])["numerator"].sum().reset_index()
+    df0 = df0[["first_digits", "month", "Practice_ID", "numerator", "denominator"]]
+
+    processed = functions.process_df(df.copy(), codes)
+    joined = functions.join_concept_descriptions(processed.copy(), *concepts)
+    return {"codes": codes, "df": df, "concepts": concepts, "df0": df0, "rolled": rollup_cube(df0),
+            "processed": processed, "joined": joined, "rng": rng}
+
+
+@pytest.fixture(autouse=True)
+def pandas_engine(monkeypatch):
+    monkeypatch.setattr(functions, "ENGINE", "pandas")
+
+
+def test_process_df(inputs):
+    pd.testing.assert_frame_equal(inputs["processed"], polars_engine.process_df(inputs["df"].copy(), inputs["codes"]),
+                                  check_dtype=False)
+
+
+def test_join_concept_descriptions(inputs):
+    joined = polars_engine.join_concept_descriptions(inputs["processed"].copy(), *inputs["concepts"])
+    pd.testing.assert_frame_equal(inputs["joined"], joined, check_dtype=False)
+
+
+@pytest.mark.parametrize("keywords", [["depress"], ["Imag", "x-ray"], ["nomatch"], None])
+@pytest.mark.parametrize("concepts", [None, CONCEPTS[:2], ["none"]])
+@pytest.mark.parametrize("in_or_out", ["in", "out"])
+def test_filter_codelists(inputs, keywords, concepts, in_or_out):
+    joined = inputs["joined"].drop_duplicates(subset=["first_digits"])
+    joined.index = np.random.default_rng(1).permutation(len(joined)) # filter_codelists keeps the index
+    expected = functions.filter_codelist_frame(joined, keywords, concepts, in_or_out)
+    out = polars_engine.filter_codelists(joined, keywords, concepts, in_or_out)
+    # pandas sorts unstably, so compare rows with equal keys in the same order
+    pd.testing.assert_frame_equal(expected.sort_index(), out.sort_index(), check_dtype=False)
+
+
+def codes_to_check(df0):
+    return sorted(set(df0["first_digits"].str[:2]))[:10] + list(df0["first_digits"][:10]) + ["zzz"]
+
+
+@pytest.mark.parametrize("extract", ["df0", "rolled"])
+@pytest.mark.parametrize("months", [None, MONTHS[6:]])
+def test_code_series(inputs, extract, months):
+    for code in codes_to_check(inputs["df0"]):
+        expected = functions.code_series(inputs[extract], code, months)
+        out, count, percent = polars_engine.code_series(inputs[extract], code, months)
+        if expected[0] is None or out is None:
+            assert expected[0] is None and out is None
+            continue
+        out["value"] = 1000*out["numerator"]/out["denominator"]
+        pd.testing.assert_frame_equal(expected[0], out, check_dtype=False)
+        assert expected[1:]==(count, percent)
+
+
+def test_all_pracs(inputs):
+    df0 = inputs["df0"]
+    for code in codes_to_check(df0)[:-1]:
+        df = df0.loc[df0["first_digits"].str[:len(code)]==code]
+        pd.testing.assert_frame_equal(functions.all_pracs(df0, df, code)[0], polars_engine.all_pracs(df0, df, code)[0],
+                                      check_dtype=False)
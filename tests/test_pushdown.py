@@ -0,0 +1,71 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from functions import calculate_deciles, code_series, pushdown_results, restrict_extract
+
+
+CODELIST = ["22", "22K", "7L1", "XaBVJ", "ZZZ"]
+
+
+def local_pushdown(df0, codes):
+
+    '''
+    Local equivalent of the pushdown_sql queries on an events extract: events per codelist code, practice and
+    month, every practice which has used a code in every month of the extract (with zeros), and the deciles of their
+    rates with linear interpolation (as PERCENTILE_CONT)
+
+    Outputs:
+    wide (dataframe): as returned by the deciles query
+    practices_total (int): as returned by the total practices query
+    '''
+
+    events = []
+    for code in codes:
+        df = df0.loc[df0["first_digits"].str[:len(code)]==code]
+        events.append(df.groupby(["month", "Practice_ID"])["numerator"].sum().reset_index().assign(first_digits=code))
+    events = pd.concat(events, ignore_index=True)
+    months = sorted(events["month"].unique())
+    listsize = df0[["Practice_ID", "denominator"]].drop_duplicates()
+
+    rows = []
+    for code, df in events.groupby("first_digits"):
+        practices = listsize.loc[listsize["Practice_ID"].isin(df["Practice_ID"])]
+        for month in months:
+            rates = practices.merge(df.loc[df["month"]==month], on="Practice_ID", how="left").fillna({"numerator": 0})
+            values = 1000*rates["numerator"]/rates["denominator"]
+            row = {"first_digits": code, "month": month}
+            row.update({f"p{p}": np.percentile(values, p) for p in range(10, 100, 10)})
+            row.update({"practices": len(rates), "numerator": rates["numerator"].sum()})
+            rows.append(row)
+    return pd.DataFrame(rows), events["Practice_ID"].nunique()
+
+
+@pytest.fixture
+def extract(df0):
+    # no events at all in one month, and none for one code in others
+    df0 = df0.loc[df0["month"]!=date(2020, 5, 1)]
+    gaps = df0["first_digits"].str.startswith("7L1") & df0["month"].isin([date(2019, 3, 1), date(2020, 4, 1)])
+    return restrict_extract(df0.loc[~gaps], CODELIST).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("code", CODELIST)
+def test_pushdown_matches_local_deciles(extract, code):
+    wide, practices_total = local_pushdown(extract, CODELIST)
+    result = pushdown_results(wide, code, practices_total)
+    out, practice_count, practices_percent = code_series(extract, code)
+    if out is None:
+        assert result is None # code without events
+        return
+
+    deciles, practice_count_thou, percent, total_events = result
+    expected = calculate_deciles(out)
+    keys = ["month", "percentile"]
+    deciles = deciles.sort_values(keys).reset_index(drop=True)
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(deciles[expected.columns], expected, check_dtype=False)
+    assert date(2020, 5, 1) not in set(deciles["month"])
+    assert (practice_count_thou, percent) == (practice_count, practices_percent)
+    assert total_events==out["numerator"].sum()
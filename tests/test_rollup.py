@@ -0,0 +1,80 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from functions import code_series
+from hll import sparse_registers
+from rollup import SKETCH_P, rollup_cube, rollup_counts, discovery_table, sketch_registers
+
+
+def test_rollup_cube(df0):
+    rolled = rollup_cube(df0)
+    for code in ["2", "22", "22K", "22K1", "7L1", "XaBVJ"]:
+        expected = code_series(df0, code)[0]
+        out = code_series(rolled, code, months=sorted(df0["month"].unique()))[0]
+        keys = ["month", "Practice_ID"]
+        expected, out = expected.sort_values(keys).reset_index(drop=True), out.sort_values(keys).reset_index(drop=True)
+        pd.testing.assert_frame_equal(out[expected.columns], expected, check_dtype=False)
+
+
+def test_rollup_counts(df0):
+    counts = rollup_counts(df0, since="2019-01-01")
+    prefixes = counts.loc[~counts["full"]].set_index(["first_digits", "digits"])
+    for code in ["2", "22", "22K", "7L1H"]:
+        expected = df0.loc[df0["first_digits"].str[:len(code)]==code, "numerator"].sum()
+        assert prefixes.loc[(code, len(code)), "events"]==expected
+    full = counts.loc[counts["full"]].set_index("first_digits")["events"]
+    assert full.to_dict()==df0.groupby("first_digits")["numerator"].sum().to_dict()
+
+
+@pytest.fixture
+def events(rng):
+
+    '''
+    Events in 2020 with full CTV3 codes (dots included), as in CodedEvent, including codes with a leading or an
+    internal dot
+    '''
+
+    codes = np.array(["22K..", "22K1.", "22...", "2....", "7L1H.", "7L...", "7L.1H", "XaBVJ", "X....", "49A..", "0123.",
+                      ".8Q2.", ".8Q.."])
+    n = 100000
+    return pd.DataFrame({"CTV3Code": rng.choice(codes, size=n),
+                         "Patient_ID": rng.integers(0, 30000, n),
+                         "month": rng.choice(np.array([date(2020, m, 1) for m in range(1, 13)], dtype=object), size=n)})
+
+
+def naive_discovery(events, level):
+
+    '''
+    Local equivalent of the discovery query for a level, grouping by LEFT(CTV3Code, n) with dots removed after
+    '''
+
+    first = events["CTV3Code"].str[0]
+    if level=="uxy":
+        df, group = events.loc[first.isin(["U", "X", "Y"])], events["CTV3Code"]
+    else:
+        df = events.loc[~first.isin([".", "0", "U", "X", "Y"]) & (events["CTV3Code"].str[:2]!="49")]
+        group = events["CTV3Code"].str[:2 if level=="level2" else 3]
+    group = group.loc[df.index].str.replace(".", "", regex=False)
+    return df.groupby(group).agg(events=("Patient_ID", "size"), patients=("Patient_ID", "nunique"))
+
+
+@pytest.mark.parametrize("level", ["level2", "level3", "uxy"])
+def test_discovery_table(events, level):
+    # cube of all events and sparse patient registers per full code, both keyed up to the first dot (as #codes), as
+    # returned by cube_sql and sketch_sql
+    full = events["CTV3Code"].str.split(".").str[0]
+    cube = events.groupby([full, "month"]).size().rename("numerator").reset_index()
+    cube = cube.rename(columns={"CTV3Code": "first_digits"})
+    rows = sparse_registers(full.values, events["Patient_ID"].values, SKETCH_P).rename(columns={"key": "first_digits"})
+    registers = sketch_registers(rows)
+    assert len(registers) < len(full.unique())*2**SKETCH_P
+
+    df = discovery_table(cube, registers, level, 0).set_index("first_digits")
+    expected = naive_discovery(events, level)
+    assert sorted(df.index)==sorted(expected.index) # including codes shorter than the level, e.g. "22" in level3
+    assert (df["events"]==expected["events"].reindex(df.index)).all()
+    assert ((df["patients"]/expected["patients"].reindex(df.index) - 1).abs()<0.05).all() # 1.6% standard error
+    assert (df["level"]==level).all()
@@ -0,0 +1,58 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import naive_series
+from screening import key_months, screen_changes, rank_codelist
+
+
+END_DATE = "20201231"
+
+
+def screening_counts(df0, digits):
+
+    '''
+    Local equivalent of screening_sql (without a threshold) on an events extract, for one number of digits
+    '''
+
+    df = df0.loc[df0["first_digits"].str.len()>=digits] # shorter codes are not counted at this length
+    df = df.assign(first_digits=df["first_digits"].str[:digits])
+    keys = ["first_digits", "Practice_ID", "denominator"]
+    counts = df[keys].drop_duplicates()
+    for name, month in key_months(END_DATE).items():
+        month_counts = df.loc[df["month"]==month].groupby(keys)["numerator"].sum().rename(name)
+        counts = counts.merge(month_counts.reset_index(), on=keys, how="left")
+    events = df.loc[df["month"]>=date(2020, 1, 1)].groupby(keys)["numerator"].sum().rename("events")
+    counts = counts.merge(events.reset_index(), on=keys, how="left").fillna(0)
+    return counts.assign(digits=digits)
+
+
+@pytest.fixture
+def screen(df0):
+    return screen_changes(pd.concat([screening_counts(df0, n) for n in [2, 3, 4, 5]], ignore_index=True), END_DATE)
+
+
+@pytest.mark.parametrize("code", ["22", "22K", "7L1H", "XaBVJ"])
+def test_medians(df0, screen, code):
+    out = naive_series(df0, code)
+    row = screen.set_index(["first_digits", "digits"]).loc[(code, len(code))]
+    for name, month in key_months(END_DATE).items():
+        assert row[name]==pytest.approx(np.median(out.loc[out["month"]==month, "value"]))
+    assert row["practices"]==out["Practice_ID"].nunique()
+
+
+def test_rank_at_own_length(df0, screen):
+    codelist = pd.DataFrame({"first_digits": ["22K", "XaBVJ", "22", "ZZZ"], "digits": [3, 5, 2, 3],
+                             "2020 events (mill)": [1.0, 2.0, 3.0, 4.0]})
+    ranked = rank_codelist(codelist, screen)
+    assert len(ranked)==len(codelist)
+    assert ranked["peak"].iloc[-1:].isna().all() and ranked["first_digits"].iloc[-1]=="ZZZ"
+
+    # each code is ranked on all codes beginning with it
+    screened = screen.set_index(["first_digits", "digits"])
+    for code, peak in zip(ranked["first_digits"][:3], ranked["peak"][:3]):
+        assert peak==screened.loc[(code, len(code)), "peak"]
+    assert screened.loc[("22K", 3), "events"]==df0.loc[(df0["first_digits"].str[:3]=="22K")
+                                                        & (df0["month"]>=date(2020, 1, 1)), "numerator"].sum()
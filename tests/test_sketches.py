@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import naive_series, naive_deciles
+from sketches import build_sketches, merge_sketches, sketch_results
+
+
+CODES = ["22K", "7L1", "XaBVJ", "X"]
+EXACT = 10**6 # compression at which every practice keeps its own centroid, so deciles are exact
+
+
+def assert_deciles(sketches, df0, code):
+    deciles = sketch_results(sketches, code)[0]
+    expected = naive_deciles(naive_series(df0, code))
+    np.testing.assert_allclose(deciles["value"].values, expected["value"].values, atol=1e-9)
+
+
+@pytest.mark.parametrize("code", CODES)
+def test_exact_deciles(df0, code):
+    assert_deciles(build_sketches(df0, CODES, compression=EXACT), df0, code)
+
+
+def test_totals_and_practices(df0):
+    res = sketch_results(build_sketches(df0, CODES), "22K")
+    df = df0.loc[df0["first_digits"].str.startswith("22K")]
+    assert res[3]==df["numerator"].sum()
+    assert res[1]==round(df["Practice_ID"].nunique()/1000, 1)
+
+
+def test_compressed_deciles_close(df0):
+    sketches = build_sketches(df0, CODES, compression=20)
+    deciles = sketch_results(sketches, "X")[0]
+    expected = naive_deciles(naive_series(df0, "X"))
+    idr = expected.loc[expected["percentile"]==90, "value"].max() - expected.loc[expected["percentile"]==10, "value"].min()
+    assert (deciles["value"] - expected["value"]).abs().max() < 0.1*idr
+
+
+def test_merge_partitions(df0):
+    # sketches of separate months merge to the sketch of the whole extract
+    early = df0["month"]<df0["month"].sort_values().iloc[len(df0)//2]
+    parts = [build_sketches(df0.loc[early], CODES, compression=EXACT),
+             build_sketches(df0.loc[~early], CODES, compression=EXACT)]
+    merged = merge_sketches(parts, compression=EXACT)
+    for code in CODES:
+        assert_deciles(merged, df0, code)
+
+
+def test_merge_overlap_rejected(df0):
+    sketches = build_sketches(df0, CODES)
+    with pytest.raises(ValueError):
+        merge_sketches([sketches, sketches])
+
+
+def test_merge_overlap_replaced(df0):
+    # reloading the last month replaces it rather than counting it twice
+    last = df0["month"]==df0["month"].max()
+    stale = df0.loc[last].assign(numerator=1)
+    parts = [build_sketches(pd.concat([df0.loc[~last], stale]), CODES, compression=EXACT),
+             build_sketches(df0.loc[last], CODES, compression=EXACT)]
+    merged = merge_sketches(parts, compression=EXACT, replace=True)
+    for code in CODES:
+        assert_deciles(merged, df0, code)
+    assert sketch_results(merged, "X")[3]==df0.loc[df0["first_digits"].str.startswith("X"), "numerator"].sum()
+
+
+def test_double_counted_weights_rejected(df0):
+    sketches = build_sketches(df0, CODES)
+    sketches["centroids"] = pd.concat([sketches["centroids"]]*2, ignore_index=True)
+    with pytest.raises(ValueError):
+        sketch_results(sketches, "22K")
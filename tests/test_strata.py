@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import CODES, MONTHS, naive_deciles
+from strata import SEXES, age_band_labels, combined_extract, stratum_order, stratum_results, stratum_series
+
+
+def random_strata_extract(rng, practices=30, rows=6000):
+
+    '''
+    Stratified extract and list sizes as returned by strata_events_sql and strata_listsize_sql, with some practices
+    having no registered patients in some strata (and so no events in them)
+    '''
+
+    sizes = pd.MultiIndex.from_product([range(1, practices + 1), age_band_labels(), SEXES],
+                                       names=["Practice_ID", "age_band", "sex"]).to_frame(index=False)
+    sizes = sizes.loc[rng.random(len(sizes))<0.8].reset_index(drop=True)
+    sizes["list_size"] = rng.integers(20, 600, len(sizes))
+    events = sizes.iloc[rng.integers(0, len(sizes), rows)][["Practice_ID", "age_band", "sex"]].reset_index(drop=True)
+    events["first_digits"] = rng.choice(CODES, size=rows)
+    events["month"] = rng.choice(np.array(MONTHS, dtype=object), size=rows)
+    events["numerator"] = rng.integers(1, 20, rows)
+    extract = events.groupby(["first_digits", "month", "Practice_ID", "age_band", "sex"])["numerator"].sum().reset_index()
+    return extract, sizes[["Practice_ID", "age_band", "sex", "list_size"]]
+
+
+def naive_stratum_series(extract, sizes, code, by):
+
+    '''
+    Practice-level rates of a code in each stratum every month, counting every practice which has used the code (in
+    any stratum) as zero in the strata and months it did not, where it has registered patients
+    '''
+
+    df = extract.loc[extract["first_digits"].str.startswith(code)]
+    stratum = lambda d: d[by].astype(str).agg(" ".join, axis=1)
+    df = df.assign(stratum=stratum(df))
+    sizes = sizes.loc[sizes["Practice_ID"].isin(df["Practice_ID"])]
+    sizes = sizes.assign(stratum=stratum(sizes)).groupby(["stratum", "Practice_ID"])["list_size"].sum()
+    numerators = df.groupby(["stratum", "month", "Practice_ID"])["numerator"].sum()
+    rows = []
+    for (s, practice), denominator in sizes.items():
+        for month in sorted(extract["month"].unique()):
+            numerator = numerators.get((s, month, practice), 0)
+            rows.append([s, month, practice, numerator, denominator, 1000*numerator/denominator])
+    return pd.DataFrame(rows, columns=["stratum", "month", "Practice_ID", "numerator", "denominator", "value"])
+
+
+@pytest.fixture
+def strata_extract(rng):
+    return random_strata_extract(rng)
+
+
+@pytest.mark.parametrize("by", [["sex"], ["age_band"], ["age_band", "sex"]])
+@pytest.mark.parametrize("code", ["22", "22K1", "7L1", "Y1234"])
+def test_stratum_deciles(strata_extract, code, by):
+    extract, sizes = strata_extract
+    out = stratum_series(extract, sizes, code, by)
+    results = stratum_results(out)
+    expected = naive_stratum_series(extract, sizes, code, by)
+    assert set(results) == set(expected["stratum"])
+    assert set(results) <= set(stratum_order(by))
+
+    for stratum, df in expected.groupby("stratum"):
+        result = results[stratum]
+        deciles = naive_deciles(df)
+        pd.testing.assert_frame_equal(result["deciles"][deciles.columns], deciles, check_dtype=False)
+        assert result["practice_count"]==round(df["Practice_ID"].nunique()/1000, 1)
+        assert result["total_events"]==df["numerator"].sum()
+
+
+def test_stratum_series_unused_code(strata_extract):
+    extract, sizes = strata_extract
+    assert stratum_series(extract, sizes, "ZZZ", ["sex"]) is None
+
+
+def test_combined_extract(strata_extract):
+    extract, sizes = strata_extract
+    df0 = combined_extract(extract, sizes)
+    assert df0["numerator"].sum()==extract["numerator"].sum()
+    listsize = sizes.groupby("Practice_ID")["list_size"].sum()
+    assert (df0["denominator"].values==listsize.loc[df0["Practice_ID"]].values).all()
@@ -0,0 +1,88 @@
+# Checks of the summary table against CodedEvent in the test database. Skipped unless DBCONN is set, e.g. for the
+# mssql container (created by mssql/setup.sql) after loading synthetic data:
+#
+#     python mssql/load_synthetic.py --events 200000
+#     DBCONN="DRIVER={ODBC Driver 17 for SQL Server};SERVER=localhost,1433;DATABASE=Test_OPENCoronaExport;UID=SA;PWD=Your_password123!" \
+#         python -m pytest tests/test_summary_table.py
+
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyodbc")
+if not os.environ.get("DBCONN"):
+    pytest.skip("DBCONN is not set", allow_module_level=True)
+
+from functions import closing_connection, staging_sql, stage_codelist
+from summary_table import update_summary, summary_events_sql, find_summary
+
+
+DBCONN = os.environ["DBCONN"].strip('"')
+TABLE = os.environ.get("SUMMARY_TEST_TABLE", "Test_OPENCoronaExport.dbo.CodeSummaryTest")
+END_DATE = "20201231"
+KEYS = ["first_digits", "month", "Practice_ID"]
+
+
+def read(sql, params=None):
+    with closing_connection(DBCONN) as connection:
+        return pd.read_sql(sql, connection, params=params)
+
+
+def naive_summary():
+
+    '''
+    Events per code, month and practice at the time of each event, from CodedEvent and RegistrationHistory in pandas
+    '''
+
+    events = read("SELECT Patient_ID, CTV3Code, ConsultationDate FROM CodedEvent WHERE ConsultationDate >= '20190101'")
+    events["event"] = range(len(events))
+    reg = read("SELECT Patient_ID, Organisation_ID, StartDate, EndDate FROM RegistrationHistory")
+    df = events.merge(reg, on="Patient_ID")
+    df = df.loc[(df["StartDate"]<=df["ConsultationDate"]) & (df["EndDate"]>=df["ConsultationDate"])]
+    df = df.sort_values(["event", "StartDate", "EndDate"], ascending=[True, False, False]).drop_duplicates("event")
+    df["first_digits"] = df["CTV3Code"].str.replace(".", "", regex=False)
+    df["month"] = pd.to_datetime(df["ConsultationDate"]).dt.to_period("M").dt.to_timestamp().dt.date
+    df = df.rename(columns={"Organisation_ID": "Practice_ID"})
+    return df.groupby(KEYS).size().rename("events")
+
+
+@pytest.fixture(scope="module")
+def summary():
+    update_summary(DBCONN, TABLE, rebuild=True)
+    yield read(f"SELECT * FROM {TABLE}").assign(month=lambda df: pd.to_datetime(df["month"]).dt.date).set_index(KEYS)["events"]
+    with closing_connection(DBCONN) as connection:
+        connection.execute(f"DROP TABLE {TABLE}")
+        connection.commit()
+
+
+def test_summary_matches_coded_event(summary):
+    expected = naive_summary()
+    assert summary.sort_index().to_dict()==expected.sort_index().to_dict()
+
+
+def test_update_reloads_the_same(summary):
+    update_summary(DBCONN, TABLE)
+    updated = read(f"SELECT * FROM {TABLE}").assign(month=lambda df: pd.to_datetime(df["month"]).dt.date)
+    assert updated.set_index(KEYS)["events"].sort_index().to_dict()==summary.sort_index().to_dict()
+
+
+def test_summary_events_sql(summary):
+    # summary rows up to the end date for practices with registered patients, with their list sizes
+    subset = pd.DataFrame({"first_digits": list("0123456789ABXYU"), "digits": 1})
+    with closing_connection(DBCONN) as connection:
+        assert find_summary(connection, TABLE)==TABLE
+        with pytest.raises(ValueError):
+            find_summary(connection, TABLE + "Missing")
+        for sql, params in staging_sql(END_DATE):
+            connection.execute(sql, *params)
+        stage_codelist(connection, subset)
+        sql, params = summary_events_sql(TABLE, subset, END_DATE)
+        df0 = pd.read_sql(sql, connection, params=params)
+        listsize = pd.read_sql("SELECT * FROM #listsize", connection).set_index("Practice_ID")["list_size"]
+
+    df0["month"] = pd.to_datetime(df0["month"]).dt.date
+    expected = summary.reset_index()
+    expected = expected.loc[(pd.to_datetime(expected["month"])<=pd.Timestamp(END_DATE)) & expected["Practice_ID"].isin(listsize.index)]
+    assert df0.set_index(KEYS)["numerator"].sort_index().to_dict()==expected.set_index(KEYS)["events"].sort_index().to_dict()
+    assert (df0["denominator"]==df0["Practice_ID"].map(listsize)).all()
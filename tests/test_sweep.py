@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import CODES, MONTHS
+from functions import (apply_listsizes, compute_results, monthly_listsizes, registration_changes, snapshot_extract,
+                       sweep_table)
+
+
+END_DATES = ["20200630", "20200930", "20201231"]
+
+
+def random_patients(rng, n=1500, practices=20):
+
+    '''
+    Patient registrations starting and ending at random, some patients moving to another practice the day after
+    their first registration ends, and one moving on the last day of a snapshot month
+    '''
+
+    starts = np.datetime64("2018-01-01") + rng.integers(0, 1000, n).astype("timedelta64[D]")
+    ends = starts + rng.integers(0, 800, n).astype("timedelta64[D]")
+    ends = np.where(rng.random(n)<0.3, np.datetime64("2200-01-01"), ends) # still registered
+    reg = pd.DataFrame({"Patient_ID": np.arange(n), "Practice_ID": rng.integers(1, practices + 1, n),
+                        "StartDate": starts, "EndDate": ends})
+    moved = reg.loc[(rng.random(n)<0.4) & (reg["EndDate"]<np.datetime64("2200-01-01"))].copy()
+    moved["Practice_ID"] = moved["Practice_ID"] % practices + 1
+    moved["StartDate"] = moved["EndDate"] + np.timedelta64(1, "D")
+    moved["EndDate"] = np.datetime64("2200-01-01")
+    # registered at practice 1 up to the end of the first snapshot, and practice 2 from the day after
+    edge = pd.DataFrame({"Patient_ID": n, "Practice_ID": [1, 2],
+                         "StartDate": np.array(["2018-05-01", "2020-07-01"], dtype="datetime64[D]"),
+                         "EndDate": np.array(["2020-06-30", "2200-01-01"], dtype="datetime64[D]")})
+    reg = pd.concat([reg, moved, edge], ignore_index=True)
+    reg["StartDate"] = pd.to_datetime(reg["StartDate"])
+    reg["EndDate"] = pd.to_datetime(reg["EndDate"])
+    return reg
+
+
+def random_events(rng, reg, rows=8000):
+
+    '''
+    Coded events (one per row) of registered patients, including the patient moving on the last day of a month
+    '''
+
+    patients = np.append(rng.choice(reg["Patient_ID"].unique(), size=rows - 30), np.full(30, reg["Patient_ID"].max()))
+    return pd.DataFrame({"Patient_ID": patients,
+                         "first_digits": rng.choice(CODES, size=rows),
+                         "month": rng.choice(np.array(MONTHS, dtype=object), size=rows)})
+
+
+def live_registrations(reg, end_date):
+
+    '''
+    Each patient's latest registration live at end_date (as in sweep_sql and staging_sql)
+    '''
+
+    day = pd.Timestamp(end_date)
+    live = reg.loc[(reg["StartDate"]<=day) & (reg["EndDate"]>=day)]
+    live = live.sort_values(["StartDate", "EndDate"], ascending=False)
+    return live.drop_duplicates("Patient_ID")
+
+
+def local_sweep(reg, events, end_dates):
+
+    '''
+    Local equivalent of the sweep_sql queries: events grouped by practice and bitmask of end dates, and list sizes at
+    each end date
+    '''
+
+    snapshots = pd.concat([live_registrations(reg, e)[["Patient_ID", "Practice_ID"]].assign(snapshot=2**i)
+                           for i, e in enumerate(end_dates)])
+    reg_sweep = snapshots.groupby(["Patient_ID", "Practice_ID"])["snapshot"].sum().rename("snapshots").reset_index()
+    extract = events.merge(reg_sweep, on="Patient_ID")
+    extract = extract.groupby(["first_digits", "month", "Practice_ID", "snapshots"]).size().rename("numerator").reset_index()
+
+    sizes = []
+    for i, e in enumerate(end_dates):
+        day = pd.Timestamp(e)
+        live = reg.loc[(reg["StartDate"]<=day) & (reg["EndDate"]>=day)]
+        size = live.groupby("Practice_ID")["Patient_ID"].nunique().rename("list_size").reset_index()
+        sizes.append(size.assign(snapshot=2**i))
+    return extract, pd.concat(sizes, ignore_index=True)
+
+
+def naive_extract(reg, events, end_date):
+
+    '''
+    Events extract for a single end date, attributing events to practices at end_date, with list sizes at end_date
+    from monthly_listsizes
+    '''
+
+    end = pd.Timestamp(end_date).date()
+    df = events.loc[events["month"]<=end].merge(live_registrations(reg, end_date)[["Patient_ID", "Practice_ID"]],
+                                                on="Patient_ID")
+    df = df.groupby(["first_digits", "month", "Practice_ID"]).size().rename("numerator").reset_index()
+    months = [m for m in MONTHS if m<=end]
+    listsizes = monthly_listsizes(registration_changes(reg, end_date), months)
+    # list size in the end date's month, which is the list size at end_date as it is the last day of the month
+    sizes = apply_listsizes(pd.DataFrame({"Practice_ID": listsizes.index, "month": months[-1]}), listsizes)
+    df = df.merge(sizes[["Practice_ID", "denominator"]].dropna(), on="Practice_ID")
+    df["denominator"] = df["denominator"].astype(int)
+    return df
+
+
+@pytest.fixture
+def sweep(rng):
+    reg = random_patients(rng)
+    events = random_events(rng, reg)
+    return reg, events, local_sweep(reg, events, END_DATES)
+
+
+@pytest.mark.parametrize("i", range(len(END_DATES)))
+def test_snapshot_extract(sweep, i):
+    reg, events, (extract, listsizes) = sweep
+    keys = ["first_digits", "month", "Practice_ID"]
+    df0 = snapshot_extract(extract, listsizes, i, END_DATES[i]).sort_values(keys).reset_index(drop=True)
+    expected = naive_extract(reg, events, END_DATES[i]).sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df0[expected.columns], expected, check_dtype=False)
+
+
+def test_moved_on_last_day_of_month(sweep):
+    reg, events, _ = sweep
+    patient = reg["Patient_ID"].max()
+    reg, events = reg.loc[reg["Patient_ID"]==patient], events.loc[events["Patient_ID"]==patient]
+    extract, listsizes = local_sweep(reg, events, END_DATES)
+    # at practice 1 at the first end date (the last day of its registration), and practice 2 at the others
+    for i, (e, practice) in enumerate(zip(END_DATES, [1, 2, 2])):
+        df0 = snapshot_extract(extract, listsizes, i, e)
+        assert set(df0["Practice_ID"])=={practice}
+        assert df0["numerator"].sum()==(events["month"]<=pd.Timestamp(e).date()).sum()
+        assert (df0["denominator"]==1).all()
+    listsizes = monthly_listsizes(registration_changes(reg, END_DATES[-1]), MONTHS)
+    assert listsizes.loc[1, MONTHS[17]]==1 and listsizes.loc[1, MONTHS[18]]==0 # June and July 2020
+    assert listsizes.loc[2, MONTHS[17]]==0 and listsizes.loc[2, MONTHS[18]]==1
+
+
+def test_sweep_table_matches_separate_extracts(sweep):
+    reg, events, (extract, listsizes) = sweep
+    subset = pd.DataFrame({"first_digits": ["22", "22K", "7L1", "XaB", "ZZZ"], "digits": [2, 3, 3, 3, 3],
+                           "Description": "Code"})
+    results = {e: compute_results(snapshot_extract(extract, listsizes, i, e), subset, subcodes=None)
+               for i, e in enumerate(END_DATES)}
+    expected = {e: compute_results(naive_extract(reg, events, e), subset, subcodes=None) for e in END_DATES}
+    pd.testing.assert_frame_equal(sweep_table(subset, results), sweep_table(subset, expected))
+    assert sweep_table(subset, results)["classification changed"].dtype==bool